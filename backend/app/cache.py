@@ -1,9 +1,20 @@
 from __future__ import annotations
 from collections import OrderedDict
-import threading
-from typing import Hashable, Any, Callable
+import os, json, hashlib, threading, time
+from typing import Hashable, Any, Callable, Dict, List
+
+from .indexer import index_manager
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local")  # local | redis
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")  # memory:// = in-process stand-in
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))  # redis entries only
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "pkm")
 
 class LRU:
+    """
+    Entry-count bounded LRU for values that must stay in-process
+    (e.g. FAISS selectors).
+    """
     def __init__(self, size=256):
         self.size = size
         self._d: OrderedDict[Hashable, Any] = OrderedDict()
@@ -15,7 +26,7 @@ class LRU:
                 self._d.move_to_end(k)
                 return self._d[k]
             return None
-    
+
     def set(self, k, v):
         with self._lock:
             self._d[k] = v
@@ -23,7 +34,216 @@ class LRU:
             if len(self._d) > self.size:
                 self._d.popitem(last=False)
 
-embed_cache = LRU(256)
-qa_cache = LRU(128)
-search_cache = LRU(128)
+class LocalBackend:
+    """
+    In-process byte-bounded LRU of serialized values. Values larger than
+    max_bytes are not stored.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._d: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            blob = self._d.get(key)
+            if blob is not None:
+                self._d.move_to_end(key)
+            return blob
+
+    def set(self, key: str, blob: bytes) -> int:
+        """
+        Store blob; returns how many entries were evicted to make room.
+        Blobs larger than max_bytes are not stored (nothing is evicted).
+        """
+        if len(blob) > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._d[key] = blob
+            self.bytes += len(blob)
+            while self.bytes > self.max_bytes and self._d:
+                _, b = self._d.popitem(last=False)
+                self.bytes -= len(b)
+                evicted += 1
+        return evicted
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._d)
+            self._d.clear()
+            self.bytes = 0
+        return n
+
+    def __len__(self):
+        return len(self._d)
+
+class LocalRedis:
+    """
+    In-process stand-in for the handful of Redis commands RedisBackend uses
+    (GET, SET with EX, DELETE, FLUSHDB, PING). Lets the shared-cache path run
+    without a server: CACHE_BACKEND=redis CACHE_REDIS_URL=memory://
+    """
+    def __init__(self):
+        self._d: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def ping(self):
+        return True
+
+    def get(self, key):
+        with self._lock:
+            item = self._d.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.time():
+                del self._d[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._d[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for k in keys if self._d.pop(k, None) is not None)
+
+    def flushdb(self):
+        with self._lock:
+            self._d.clear()
+        return True
+
+class RedisBackend:
+    """
+    Shared across uvicorn workers. Entries expire after CACHE_TTL; the memory
+    bound is the server's maxmemory/eviction policy, so evictions are not
+    counted here. Values larger than max_bytes are not stored.
+    """
+    def __init__(self, client, namespace: str, max_bytes: int, ttl: int = CACHE_TTL):
+        self.client = client
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(f"{self.namespace}:{key}")
+
+    def set(self, key: str, blob: bytes) -> int:
+        if len(blob) <= self.max_bytes:
+            self.client.set(f"{self.namespace}:{key}", blob, ex=self.ttl)
+        return 0
+
+    def clear(self) -> int:
+        # keys of older generations are unreachable and age out via TTL
+        return 0
+
+    def __len__(self):
+        return 0
+
+_redis_client = None
+
+def redis_client():
+    global _redis_client
+    if _redis_client is None:
+        if CACHE_REDIS_URL.startswith("memory://"):
+            _redis_client = LocalRedis()
+        else:
+            import redis  # optional dependency, only for CACHE_BACKEND=redis
+            _redis_client = redis.Redis.from_url(CACHE_REDIS_URL)
+    return _redis_client
+
+def _make_backend(name: str, max_bytes: int):
+    if CACHE_BACKEND == "redis":
+        try:
+            client = redis_client()
+            client.ping()
+            return RedisBackend(client, f"{CACHE_PREFIX}:{name}", max_bytes)
+        except Exception as e:
+            print(f"[CACHE ERROR] redis backend unavailable for {name}, using local: {e}")
+    return LocalBackend(max_bytes)
+
+class Cache:
+    """
+    Byte-bounded cache of JSON-serializable values with hit/miss/eviction
+    counts. Values are stored as JSON, never pickled: a shared backend is
+    only as trusted as whoever can write to it.
+    With `generation` (a callable returning the current index generation)
+    entries are tagged with the generation they were stored under and are
+    never served once it moves on.
+    """
+    def __init__(self, name: str, max_bytes: int, generation: Callable[[], int] | None = None, backend=None):
+        self.name = name
+        self.generation = generation
+        self.backend = backend if backend is not None else _make_backend(name, max_bytes)
+        self._gen = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, k) -> str:
+        gen = self.generation() if self.generation else 0
+        if gen != self._gen:
+            if self._gen is not None:
+                self.invalidations += self.backend.clear()
+            self._gen = gen
+        digest = hashlib.sha256(repr(k).encode("utf-8")).hexdigest()
+        return f"{gen}:{digest}"
+
+    def get(self, k):
+        try:
+            blob = self.backend.get(self._key(k))
+        except Exception as e:
+            print(f"[CACHE ERROR] get {self.name}: {e}")
+            blob = None
+        if blob is not None:
+            try:
+                value = json.loads(blob)
+            except ValueError as e:
+                print(f"[CACHE ERROR] unreadable entry in {self.name}: {e}")
+                blob = None
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, k, v):
+        try:
+            blob = json.dumps(v, separators=(",", ":")).encode("utf-8")
+            self.evictions += self.backend.set(self._key(k), blob)
+        except Exception as e:
+            print(f"[CACHE ERROR] set {self.name}: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        label = f'{{cache="{self.name}"}}'
+        return {
+            f"cache_hits_total{label}": self.hits,
+            f"cache_misses_total{label}": self.misses,
+            f"cache_evictions_total{label}": self.evictions,
+            f"cache_invalidations_total{label}": self.invalidations,
+            f"cache_entries{label}": len(self.backend),
+            f"cache_bytes{label}": self.backend.bytes,
+        }
+
+def _index_generation() -> int:
+    return index_manager.generation
+
+embed_cache = Cache("embed", int(os.getenv("EMBED_CACHE_BYTES", str(16 << 20))))
+qa_cache = Cache("qa", int(os.getenv("QA_CACHE_BYTES", str(8 << 20))), generation=_index_generation)
+search_cache = Cache("search", int(os.getenv("SEARCH_CACHE_BYTES", str(16 << 20))), generation=_index_generation)
+caches: List[Cache] = [embed_cache, qa_cache, search_cache]
 
+def cache_stats() -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for c in caches:
+        out.update(c.stats())
+    return out
@@ -1,12 +1,15 @@
 from __future__ import annotations
 import re
-from typing import Iterable, List, Tuple, Optional
+from functools import lru_cache
+from typing import List, Tuple
 import tiktoken
 
 _BLOCK_SEP_RE = re.compile(r"\n{2,}")  # paragraphs separated by blank lines
 _CODE_FENCE_RE = re.compile(r"(^```.*?^```)", re.M | re.S)  # capture fenced code blocks
 _WS_RE = re.compile(r"[ \t]+")
 
+PIECE_SEP = "\n\n"  # between pieces (e.g. PDF pages) in the stored text
+
 def _normalize(text: str) -> str:
     # normalize whitespace but keep newlines (structure)
     text = text.replace("\r\n", "\n").replace("\r", "\n")
@@ -15,30 +18,224 @@ def _normalize(text: str) -> str:
     text = re.sub(r"\n{3,}", "\n\n", text)
     return text.strip()
 
-def _split_into_blocks(text: str) -> List[str]:
+@lru_cache(maxsize=None)
+def get_encoder(enc_name: str = "cl100k_base"):
+    return tiktoken.get_encoding(enc_name)
+
+def _strip_span(text: str, s: int, e: int) -> Tuple[int, int]:
+    while s < e and text[s].isspace():
+        s += 1
+    while e > s and text[e - 1].isspace():
+        e -= 1
+    return s, e
+
+def _block_spans(text: str) -> List[Tuple[int, int]]:
     """
-    Split text into logical blocks: fenced code blocks stay intact;
+    Logical blocks as (start, end) offsets: fenced code blocks stay intact;
     everything else is split on paragraph boundaries (blank lines).
     """
-    parts: List[str] = []
+    spans: List[Tuple[int, int]] = []
+
+    def paragraphs(s, e):
+        pos = s
+        for m in _BLOCK_SEP_RE.finditer(text, s, e):
+            spans.append(_strip_span(text, pos, m.start()))
+            pos = m.end()
+        spans.append(_strip_span(text, pos, e))
+
     pos = 0
     for m in _CODE_FENCE_RE.finditer(text):
-        before = text[pos:m.start()]
-        fence = m.group(1)
-        if before.strip():
-            parts.extend([b for b in _BLOCK_SEP_RE.split(before) if b.strip()])
-        parts.append(fence.strip())
+        paragraphs(pos, m.start())
+        spans.append(_strip_span(text, m.start(), m.end()))
         pos = m.end()
-    tail = text[pos:]
-    if tail.strip():
-        parts.extend([b for b in _BLOCK_SEP_RE.split(tail) if b.strip()])
-    return parts
+    paragraphs(pos, len(text))
+    return [(s, e) for s, e in spans if e > s]
+
+class _Block:
+    __slots__ = ("start", "end", "tokens")
+
+    def __init__(self, start, end, tokens):
+        self.start, self.end, self.tokens = start, end, tokens
+
+    def offset(self, enc, i: int) -> int:
+        """Absolute char offset where token i of this block starts."""
+        if i <= 0:
+            return self.start
+        if i >= len(self.tokens):
+            return self.end
+        # a token ending mid-character counts up to the last whole one
+        return self.start + len(enc.decode_bytes(self.tokens[:i]).decode("utf-8", errors="ignore"))
+
+class SpanChunker:
+    """
+    Token-budgeted chunker that returns (start_char, end_char) spans into the
+    normalized document text instead of decoded chunk strings.
+
+    Feed text pieces in order (a whole document, or PDF pages as they are
+    extracted); pieces are normalized and joined with blank lines into
+    `text`. Blocks are packed up to target_tokens, code fences stay intact,
+    oversized blocks are split on token boundaries, and each chunk starts
+    overlap_tokens before the previous one ends. Spans are returned as soon
+    as they can no longer change; only the last chunk is held back.
+
+    `chunks(spans)` slices returned spans out of the text; after `release()`
+    only the text a pending chunk can still reach is kept, and `text` is
+    no longer the whole document.
+    """
+
+    def __init__(self, target_tokens: int = 350, overlap_tokens: int = 50,
+                 min_chunk_tokens: int = 40, enc_name: str = "cl100k_base"):
+        self.target = target_tokens
+        self.overlap = overlap_tokens
+        self.min_tokens = min_chunk_tokens
+        self.enc = get_encoder(enc_name)
+        # (offset, text) of the pieces and separators still held
+        self._parts: List[Tuple[int, str]] = []
+        self._len = 0
+        # finished chunks not yet returned: [start, end, ntokens, blocks]
+        self._chunks: List[list] = []
+        self._cur: list | None = None
+
+    @property
+    def text(self) -> str:
+        return "".join(p for _, p in self._parts)
+
+    def _slice(self, s: int, e: int) -> str:
+        return "".join(p[max(0, s - off):e - off] for off, p in self._parts if off < e and off + len(p) > s)
+
+    def chunks(self, spans: List[Tuple[int, int]]) -> List[str]:
+        return [self._slice(s, e) for s, e in spans]
+
+    def release(self):
+        """Drop text that ends before every chunk not yet returned."""
+        starts = [c[0] for c in self._chunks] + ([self._cur[0]] if self._cur is not None else [])
+        keep = min(starts, default=self._len)
+        while self._parts and self._parts[0][0] + len(self._parts[0][1]) <= keep:
+            self._parts.pop(0)
+
+    def _flush(self):
+        cur, self._cur = self._cur, None
+        if cur is None:
+            return
+        if cur[2] >= self.min_tokens or not self._chunks:
+            self._chunks.append(cur)
+        else:
+            # too small: merge into the previous chunk (spans are contiguous)
+            prev = self._chunks[-1]
+            prev[1] = cur[1]
+            prev[2] += cur[2]
+            prev[3] = prev[3] + cur[3]
+
+    def _overlap_start(self) -> Tuple[int, int] | None:
+        """(char offset, tokens) where the overlap into the next chunk starts."""
+        if self.overlap <= 0 or not self._chunks:
+            return None
+        need = self.overlap
+        start = None
+        for b in reversed(self._chunks[-1][3]):
+            n = len(b.tokens)
+            if n >= need:
+                start = b.offset(self.enc, n - need)
+                need = 0
+                break
+            need -= n
+            start = b.start
+        return start, self.overlap - need
 
-def _encode(enc, s: str) -> List[int]:
-    return enc.encode(s)
+    def _hard_split(self, b: _Block):
+        n = len(b.tokens)
+        i = 0
+        while i < n:
+            end = min(i + self.target, n)
+            seg_from = max(0, i - self.overlap) if i > 0 else 0
+            s, e = b.offset(self.enc, seg_from), b.offset(self.enc, end)
+            seg = _Block(s, e, b.tokens[seg_from:end])
+            self._chunks.append([s, e, len(seg.tokens), [seg]])
+            i = end
 
-def _decode(enc, toks: List[int]) -> str:
-    return enc.decode(toks)
+    def _add(self, b: _Block):
+        n = len(b.tokens)
+        if n > self.target * 2:
+            self._flush()
+            self._hard_split(b)
+            return
+        if self._cur is not None and self._cur[2] + n <= self.target:
+            self._cur[1] = b.end
+            self._cur[2] += n
+            self._cur[3].append(b)
+            return
+        self._flush()
+        ov = self._overlap_start()
+        if ov is not None:
+            self._cur = [ov[0], b.end, ov[1] + n, [b]]
+        elif n > self.target:
+            self._hard_split(b)
+        else:
+            self._cur = [b.start, b.end, n, [b]]
+
+    def _take(self, keep_last: bool) -> List[Tuple[int, int]]:
+        keep = 1 if keep_last else 0
+        out = [(c[0], c[1]) for c in self._chunks[:len(self._chunks) - keep]]
+        del self._chunks[:len(self._chunks) - keep]
+        return out
+
+    def feed(self, piece: str) -> List[Tuple[int, int]]:
+        piece = _normalize(piece or "")
+        if not piece:
+            return []
+        if self._len:
+            self._parts.append((self._len, PIECE_SEP))
+            self._len += len(PIECE_SEP)
+        base = self._len
+        self._parts.append((base, piece))
+        self._len += len(piece)
+
+        # one native encode per block; encode_ordinary_batch's thread pool
+        # costs more than it saves on paragraph-sized inputs
+        encode = self.enc.encode_ordinary
+        for s, e in _block_spans(piece):
+            self._add(_Block(base + s, base + e, encode(piece[s:e])))
+        # the last chunk may still absorb a small remainder or seed overlap
+        return self._take(keep_last=True)
+
+    def close(self) -> List[Tuple[int, int]]:
+        self._flush()
+        return self._take(keep_last=False)
+
+def chunk_tails(spans, chunks, prev_end: int | None = None):
+    """
+    Each chunk's text past the end of the one before it (all of it when
+    they do not overlap). `chunks` are the texts of `spans`, in order;
+    `prev_end` is where the chunk before the first one ends, if any.
+    """
+    tails = []
+    for (start, _), body in zip(spans, chunks):
+        tails.append(body[max(0, prev_end - start):] if prev_end is not None else body)
+        prev_end = start + len(body)
+    return tails
+
+def join_tails(spans, tails) -> List[str]:
+    """
+    Chunk texts back from chunk_tails output. Chunks start in order, so each
+    overlap is the end of the text rebuilt so far.
+    """
+    chunks, buf, buf_start = [], "", 0
+    for (start, _), tail in zip(spans, tails):
+        if start >= buf_start + len(buf):
+            buf, buf_start = "", start
+        body = buf[start - buf_start:] + tail
+        chunks.append(body)
+        buf, buf_start = body, start
+    return chunks
+
+def chunk_spans(text: str, target_tokens: int = 350, overlap_tokens: int = 50,
+                min_chunk_tokens: int = 40, enc_name: str = "cl100k_base") -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    (normalized text, [(start_char, end_char)]) for one document.
+    """
+    c = SpanChunker(target_tokens, overlap_tokens, min_chunk_tokens, enc_name)
+    spans = c.feed(text) + c.close()
+    return c.text, spans
 
 def chunk_text(
     text: str,
@@ -51,77 +248,5 @@ def chunk_text(
     Pack blocks into chunks up to target_tokens, keep code fences intact,
     and add token overlap between adjacent chunks. Returns non-empty chunks.
     """
-    if not text or not text.strip():
-        return []
-
-    text = _normalize(text)
-    blocks = _split_into_blocks(text)
-    enc = tiktoken.get_encoding(enc_name)
-
-    chunks: List[List[int]] = []
-    cur: List[int] = []
-
-    def flush():
-        nonlocal cur
-        if not cur:
-            return
-        if len(cur) >= min_chunk_tokens:
-            chunks.append(cur)
-        else:
-            # if too small, merge into previous if exists
-            if chunks:
-                chunks[-1].extend(cur)
-            else:
-                chunks.append(cur)  # first and tiny – still keep it
-        cur = []
-
-    for block in blocks:
-        btoks = _encode(enc, block)
-        # If single block is huge, hard-split on token count boundaries
-        if len(btoks) > target_tokens * 2:
-            start = 0
-            while start < len(btoks):
-                end = min(start + target_tokens, len(btoks))
-                segment = btoks[start:end]
-                # if there is a remainder and not first segment, add overlap
-                if start > 0 and overlap_tokens > 0:
-                    prev_tail = btoks[max(0, start - overlap_tokens):start]
-                    segment = prev_tail + segment
-                # push current if accumulating something
-                if cur:
-                    flush()
-                chunks.append(segment)
-                start = end
-            continue
-
-        # Try to pack block into current buffer
-        if len(cur) + len(btoks) <= target_tokens:
-            cur.extend(btoks)
-        else:
-            # flush current with overlap into next
-            flush()
-            if overlap_tokens > 0 and chunks:
-                # seed cur with overlap from previous chunk tail
-                tail = chunks[-1][-overlap_tokens:]
-                cur.extend(tail)
-            # add the block (might still exceed, handled next iteration)
-            if len(btoks) > target_tokens and not cur:
-                # very large block that didn't hit >2*target (rare):
-                # split it reasonably
-                start = 0
-                while start < len(btoks):
-                    end = min(start + target_tokens, len(btoks))
-                    seg = btoks[start:end]
-                    if start > 0 and overlap_tokens > 0:
-                        seg = btoks[max(0, start - overlap_tokens):start] + seg
-                    chunks.append(seg)
-                    start = end
-            else:
-                cur.extend(btoks)
-
-    flush()
-
-    # decode, strip empties
-    out = [_decode(enc, c).strip() for c in chunks]
-    out = [c for c in out if c and not c.isspace()]
-    return out
\ No newline at end of file
+    norm, spans = chunk_spans(text, target_tokens, overlap_tokens, min_chunk_tokens, enc_name)
+    return [norm[s:e] for s, e in spans]
@@ -1,22 +1,60 @@
-import os
+import os, asyncio, functools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, Float, ForeignKey, DateTime, func
+    create_engine, event, Column, Integer, String, Text, Float, ForeignKey, DateTime, Index, func, inspect, text,
+    and_, or_, select, insert, update, delete, bindparam, MetaData, Table,
 )
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base, deferred, aliased
+
+from .chunking import chunk_tails
 
 ## DB path setup
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_DIR = os.path.join(BASE_DIR, "..", "data")
+DB_DIR = os.getenv("DB_DIR", os.path.join(BASE_DIR, "..", "data"))
 os.makedirs(DB_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DB_DIR, "pkm.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 
+# async routes run DB calls on this many threads (see run_db); the
+# connection pool is sized to match so no thread waits for a connection
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+
 engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+    DATABASE_URL, connect_args={"check_same_thread": False},
+    pool_size=DB_THREADS, max_overflow=DB_THREADS,
 )
 
+# WAL lets searches read while an indexing batch writes; NORMAL sync is
+# durable across app crashes (a power cut may lose the last batch)
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_KB", "65536")),  # negative = KiB
+    "mmap_size": int(os.getenv("SQLITE_MMAP_BYTES", str(256 << 20))),
+    "temp_store": "MEMORY",
+}
+
+@event.listens_for(engine, "connect")
+def _set_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Run a blocking DB call on the DB thread pool so the event loop (and
+    every other in-flight request) keeps going while SQLite works.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
 Base = declarative_base()
 
 class Document(Base):
@@ -27,20 +65,43 @@ class Document(Base):
     modified = Column(DateTime, server_default=func.now(), onupdate=func.now())
     type = Column(String)
     size = Column(Integer, default=0)
+    mtime = Column(Float, nullable=True)
+    raw_hash = Column(String, nullable=True)
     tags = Column(String, default="") 
+    # normalized extracted text of documents chunked before chunk tails;
+    # moved into the tails by init_db, NULL since
+    text = deferred(Column(Text, nullable=True))
 
     chunks = relationship("Chunk", back_populates="document", cascade="all, delete-orphan")
 
 class Chunk(Base):
     __tablename__ = "chunks"
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"))
+    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
     position = Column(Integer, index=True)
-    text = Column(Text)
+    text = Column(Text, nullable=True)  # only set on rows from before spans
+    # span in the normalized document text, and the part of it past the
+    # previous chunk's end: tails hold the text once, overlaps are rebuilt
+    start_char = Column(Integer, nullable=True)
+    end_char = Column(Integer, nullable=True)
+    tail = Column(Text, nullable=True)
+    # sha256 of the chunk text; chunks with equal text share one embedding_id
+    text_hash = Column(String, index=True, nullable=True)
     embedding_id = Column(Integer, index=True, nullable=True)
 
     document = relationship("Document", back_populates="chunks")
 
+    # context windows are position ranges within one document
+    __table_args__ = (Index("ix_chunks_document_position", "document_id", "position"),)
+
+
+# a full reindex writes its chunk rows here and swaps them in once it
+# succeeds (swap_in_chunk_stage); live searches keep reading chunks
+ChunkStage = Table(
+    "chunks_next", MetaData(),
+    *(Column(c.name, c.type) for c in Chunk.__table__.columns if c.name != "id"),
+    Index("ix_chunks_next_text_hash", "text_hash"),
+)
 
 class Embedding(Base):
     __tablename__ = "embeddings"
@@ -49,9 +110,114 @@ class Embedding(Base):
     dim = Column(Integer)
     vector_path = Column(String)
 
-def get_chunks_by_ids(faiss_ids):
+class EmbeddingCache(Base):
+    """
+    Content-addressed embedding cache keys; vectors live in data/embed_store.
+    """
+    __tablename__ = "embedding_store"
+    model = Column(String, primary_key=True)
+    text_hash = Column(String, primary_key=True)
+    row = Column(Integer)
+
+# columns chunk_texts needs to rebuild a chunk's text from tails
+TEXT_COLUMNS = (Chunk.id, Chunk.document_id, Chunk.position, Chunk.start_char, Chunk.end_char, Chunk.tail, Chunk.text)
+# rows read before a chunk for its overlap; more are fetched when a run of
+# small chunks is shorter than the overlap
+PREFIX_ROWS = int(os.getenv("CHUNK_PREFIX_ROWS", "2"))
+_OR_BATCH = 300  # (document, position) ranges per query
+
+def _rebuild(rows, pos):
+    """
+    Text of the chunk at `pos` from `rows` ({position: row} of one document),
+    or None when a row holding part of its overlap is not in `rows`.
+    """
+    r = rows[pos]
+    if r.start_char is None:
+        return r.text
+    parts, begin = [r.tail or ""], r.end_char - len(r.tail or "")
+    while begin > r.start_char:
+        prev = rows.get(pos - 1)
+        if prev is None:
+            return None
+        pos -= 1
+        parts.append(prev.tail or "")
+        begin = prev.end_char - len(prev.tail or "")
+    return "".join(reversed(parts))[r.start_char - begin:]
+
+def _ranges(db, ranges):
+    """
+    TEXT_COLUMNS rows for [(document_id, first position, last position)].
+    """
+    rows = []
+    for i in range(0, len(ranges), _OR_BATCH):
+        part = ranges[i:i + _OR_BATCH]
+        rows.extend(
+            db.query(*TEXT_COLUMNS)
+            .filter(or_(*(
+                and_(Chunk.document_id == doc_id, Chunk.position.between(lo, hi))
+                for doc_id, lo, hi in part
+            )))
+            .all()
+        )
+    return rows
+
+def chunk_texts(db, wanted, rows=None):
+    """
+    {(document_id, position): text} for the chunks in `wanted`. `rows` are
+    TEXT_COLUMNS rows already read (e.g. a context window and the
+    PREFIX_ROWS before it); otherwise each chunk and its PREFIX_ROWS are
+    read here. A longer overlap costs one more query.
+    """
+    wanted = list(dict.fromkeys(wanted))
+    if rows is None:
+        rows = _ranges(db, [(d, p - PREFIX_ROWS, p) for d, p in wanted])
+    by_doc = {}
+    for r in rows:
+        by_doc.setdefault(r.document_id, {})[r.position] = r
+    out, short = {}, []
+    for d, p in wanted:
+        doc = by_doc.get(d, {})
+        if p in doc:
+            out[(d, p)] = _rebuild(doc, p)
+            if out[(d, p)] is None:
+                short.append((d, p))
+    if short:
+        # earlier rows that still end inside the chunk
+        for i in range(0, len(short), _OR_BATCH):
+            part = short[i:i + _OR_BATCH]
+            for r in db.query(*TEXT_COLUMNS).filter(or_(*(
+                and_(Chunk.document_id == d, Chunk.position < min(by_doc[d]),
+                     Chunk.end_char > by_doc[d][p].start_char)
+                for d, p in part
+            ))):
+                by_doc[r.document_id].setdefault(r.position, r)
+        for d, p in short:
+            out[(d, p)] = _rebuild(by_doc[d], p)
+    return out
+
+def document_filter(file_type=None, tag=None, modified_after=None):
+    """
+    SQL conditions on Document for the search filters; empty when none is set.
+    """
+    conds = []
+    if file_type:
+        conds.append(func.lower(Document.type) == file_type.lower())
+    if tag:
+        conds.append(func.lower(Document.tags).contains(tag.lower(), autoescape=True))
+    if modified_after:
+        try:
+            dt = datetime.fromisoformat(modified_after)
+            conds.append(or_(Document.modified.is_(None), Document.modified >= dt))
+        except Exception as e:
+            print(f"[WARN] Invalid modified_after param: {e}")
+    return conds
+
+def get_chunks_by_ids(faiss_ids, file_type=None, tag=None, modified_after=None):
     """
-    Get chunks from DB by their embedding IDs.
+    Get chunks from DB by their embedding IDs, one row per ID. Chunks with
+    identical text share an ID; the row describes the first of them and
+    `documents` lists every document that contains it. With filters, only
+    documents that pass them are considered.
     """
     if not faiss_ids:
         return []
@@ -59,30 +225,169 @@ def get_chunks_by_ids(faiss_ids):
     db = SessionLocal()
     try:
         results = (
-            db.query(Chunk, Document)
+            db.query(Chunk.embedding_id, Chunk.id, Chunk.document_id, Chunk.position,
+                     Document.path, Document.tags, Document.type, Document.modified)
             .join(Document, Chunk.document_id == Document.id)
-            .filter(Chunk.embedding_id.in_(faiss_ids))
-            .order_by(Chunk.position)
+            .filter(Chunk.embedding_id.in_(faiss_ids), *document_filter(file_type, tag, modified_after))
+            .order_by(Chunk.position, Chunk.document_id)
             .all()
         )
 
-        formatted = []
-        for chunk, doc in results:
-            formatted.append({
-                "embedding_id": chunk.embedding_id,
-                "chunk_id": chunk.id,
-                "position": chunk.position,
-                "doc_path": doc.path,
-                "text": chunk.text,
-                "text_preview": chunk.text.strip().replace("\n\n", "\n")[:500]
-            })
-        return formatted
+        by_id = {}
+        for eid, chunk_id, doc_id, pos, path, tags, type_, modified in results:
+            ref = {"doc_path": path, "chunk_id": chunk_id, "position": pos}
+            row = by_id.get(eid)
+            if row is not None:
+                row["documents"].append(ref)
+                continue
+            by_id[eid] = {
+                "embedding_id": eid,
+                "chunk_id": chunk_id,
+                "position": pos,
+                "doc_path": path,
+                "tags": tags,
+                "type": type_,
+                "modified": str(modified),
+                "documents": [ref],
+                "_at": (doc_id, pos),
+            }
+        # only the representative rows' texts are read
+        texts = chunk_texts(db, [row["_at"] for row in by_id.values()])
+        for row in by_id.values():
+            body = texts.get(row.pop("_at")) or ""
+            row["text"] = body
+            row["text_preview"] = body.strip().replace("\n\n", "\n")[:500]
+        return list(by_id.values())
     except Exception as e:
         print(f"[DB ERROR] Failed to get chunks for IDs {faiss_ids}: {e}")
         return []
     finally:
         db.close()
 
+async def get_chunks_by_ids_async(faiss_ids, file_type=None, tag=None, modified_after=None):
+    return await run_db(get_chunks_by_ids, faiss_ids, file_type, tag, modified_after)
+
+def _add_missing_columns():
+    """
+    create_all() does not alter existing tables; add columns and indexes
+    introduced after a DB was first created.
+    """
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in have:
+                    coltype = col.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {coltype}"))
+            for idx in table.indexes:
+                idx.create(bind=conn, checkfirst=True)
+
+# BM25 keyword index over chunk text, rowid = chunks.id. Contentless: it
+# keeps only the index. The writer passes the chunk texts it already has
+# (index_chunks) and deletes go through delete_chunks, which rebuilds the
+# indexed text from the tails, as a contentless delete must be given it.
+FTS_TABLE = "CREATE VIRTUAL TABLE chunks_fts USING fts5(text, content='', tokenize='unicode61 remove_diacritics 2')"
+_FTS_INSERT = text("INSERT INTO chunks_fts(rowid, text) VALUES (:id, :body)")
+_FTS_DELETE = text("INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', :id, :body)")
+# earlier versions kept the index in step with triggers reading documents.text
+_OLD_FTS_TRIGGERS = ("chunks_fts_ai", "chunks_fts_ad", "chunks_fts_au")
+
+def _doc_texts(rows):
+    """
+    [(chunk id, text)] for TEXT_COLUMNS rows covering whole documents.
+    """
+    by_doc = {}
+    for r in rows:
+        by_doc.setdefault(r.document_id, {})[r.position] = r
+    return [(r.id, _rebuild(doc, pos)) for doc in by_doc.values() for pos, r in doc.items()]
+
+def index_chunks(conn, items):
+    """
+    Add [(chunk id, text)] to the keyword index.
+    """
+    if items:
+        conn.execute(_FTS_INSERT, [{"id": i, "body": t or ""} for i, t in items])
+
+def delete_chunks(conn, document_ids):
+    """
+    Delete every chunk of `document_ids` and its keyword index entry.
+    """
+    document_ids = list(document_ids)
+    if not document_ids:
+        return
+    rows = conn.execute(select(*TEXT_COLUMNS).where(Chunk.document_id.in_(document_ids))).all()
+    if rows:
+        conn.execute(_FTS_DELETE, [{"id": i, "body": t or ""} for i, t in _doc_texts(rows)])
+    conn.execute(delete(Chunk).where(Chunk.document_id.in_(document_ids)))
+
+def reset_chunk_stage():
+    """
+    Start an empty ChunkStage (dropping one a failed reindex left behind).
+    """
+    with engine.begin() as conn:
+        ChunkStage.drop(conn, checkfirst=True)
+        ChunkStage.create(conn)
+
+def drop_chunk_stage():
+    with engine.begin() as conn:
+        ChunkStage.drop(conn, checkfirst=True)
+
+def swap_in_chunk_stage(conn):
+    """
+    Replace every chunk and keyword index entry with the staged rows, inside
+    the caller's transaction, and drop the stage.
+    """
+    conn.execute(text("INSERT INTO chunks_fts(chunks_fts) VALUES ('delete-all')"))
+    conn.execute(delete(Chunk))
+    cols = [c.name for c in ChunkStage.columns]
+    conn.execute(insert(Chunk).from_select(cols, select(*ChunkStage.columns)))
+    index_chunks(conn, _doc_texts(conn.execute(select(*TEXT_COLUMNS)).all()))
+    ChunkStage.drop(conn)
+
+def _fill_tails():
+    """
+    Chunks stored as bare spans into documents.text: cut their tails from
+    it, then drop the document text.
+    """
+    with engine.begin() as conn:
+        doc_ids = conn.execute(
+            select(Chunk.document_id).where(Chunk.start_char.isnot(None), Chunk.tail.is_(None)).distinct()
+        ).scalars().all()
+        for doc_id in doc_ids:
+            body = conn.execute(select(Document.text).where(Document.id == doc_id)).scalar() or ""
+            rows = conn.execute(
+                select(Chunk.id, Chunk.start_char, Chunk.end_char)
+                .where(Chunk.document_id == doc_id).order_by(Chunk.position)
+            ).all()
+            spans = [(s, e) for _, s, e in rows]
+            tails = chunk_tails(spans, [body[s:e] for s, e in spans])
+            conn.execute(
+                update(Chunk).where(Chunk.id == bindparam("b_id")).values(tail=bindparam("b_tail")),
+                [{"b_id": r.id, "b_tail": t} for r, t in zip(rows, tails)],
+            )
+            conn.execute(update(Document).where(Document.id == doc_id).values(text=None))
+        if doc_ids:
+            print(f"[DB] moved the text of {len(doc_ids)} documents into chunk tails")
+
+def _create_fts():
+    with engine.begin() as conn:
+        for name in _OLD_FTS_TRIGGERS:
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        row = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='chunks_fts'"
+        )).first()
+        if row is not None and "content=''" in row[0]:
+            return
+        # missing, or the earlier full-text-copy table: (re)build
+        conn.execute(text("DROP TABLE IF EXISTS chunks_fts"))
+        conn.execute(text(FTS_TABLE))
+        index_chunks(conn, _doc_texts(conn.execute(select(*TEXT_COLUMNS)).all()))
+
 def init_db():
     Base.metadata.create_all(bind=engine)
-    
\ No newline at end of file
+    _add_missing_columns()
+    _fill_tails()
+    _create_fts()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+import os, re, threading
+import numpy as np
+from typing import Dict, List, Sequence
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .db import SessionLocal, EmbeddingCache
+from .mmap_matrix import MmapMatrix
+
+STORE_DIR = os.path.join("data", "embed_store")
+
+def _safe(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+class EmbeddingStore:
+    """
+    Content-addressed embedding cache: (model, sha256(text)) -> float32 vector.
+    Keys live in SQLite, vectors in one memory-mapped file per model.
+    """
+
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+        self._files: Dict[str, MmapMatrix] = {}
+        self._lock = threading.Lock()
+
+    def _file(self, model: str) -> MmapMatrix:
+        with self._lock:
+            if model not in self._files:
+                self._files[model] = MmapMatrix(os.path.join(self.root, _safe(model) + ".f32"))
+            return self._files[model]
+
+    def get_many(self, model: str, hashes: Sequence[str]) -> Dict[str, np.ndarray]:
+        if not hashes:
+            return {}
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(EmbeddingCache.text_hash, EmbeddingCache.row)
+                .filter(EmbeddingCache.model == model, EmbeddingCache.text_hash.in_(set(hashes)))
+                .all()
+            )
+        except Exception as e:
+            print(f"[EMBED STORE ERROR] lookup failed: {e}")
+            return {}
+        finally:
+            db.close()
+        if not rows:
+            return {}
+        try:
+            vecs = self._file(model).read([r for _, r in rows])
+        except Exception as e:
+            print(f"[EMBED STORE ERROR] read failed: {e}")
+            return {}
+        return {h: vecs[i] for i, (h, _) in enumerate(rows)}
+
+    def put_many(self, model: str, hashes: Sequence[str], vecs: List[List[float]]):
+        if not hashes:
+            return
+        start = self._file(model).append(np.asarray(vecs, dtype="float32"))
+        db = SessionLocal()
+        try:
+            stmt = sqlite_insert(EmbeddingCache).values([
+                {"model": model, "text_hash": h, "row": start + i} for i, h in enumerate(hashes)
+            ]).on_conflict_do_nothing(index_elements=["model", "text_hash"])
+            db.execute(stmt)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"[EMBED STORE ERROR] write failed: {e}")
+        finally:
+            db.close()
+
+    def reset(self):
+        with self._lock:
+            files = list(self._files.values())
+        for f in files:
+            f.reset()
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                os.remove(os.path.join(self.root, name))
+
+embed_store = EmbeddingStore()
@@ -1,41 +1,61 @@
 import os, httpx
 from .ollama_ready import ensure_model_present
+from .ollama_client import ollama
 from .cache import embed_cache
+from .embed_store import embed_store
+from .db import run_db
+from .indexer import sha256_text
 
 OLLAMA = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 EMB_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
 
-async def embed_batch(texts, max_retries = 1):
-    key = tuple(texts)
-    cached = embed_cache.get(key)
-    if cached is not None:
-        return cached
+async def _embed_remote(texts, max_retries = 1):
     payload = {"model": EMB_MODEL, "input": texts}
     attempt = 0
-    async with httpx.AsyncClient(timeout=60) as client:
-        while True:
-            try:
-                r = await client.post(f"{OLLAMA}/api/embed", json=payload)
-                r.raise_for_status()
-                data = r.json()
-                # check structure of data
-                print(data)
+    while True:
+        try:
+            r = await ollama.post("embed", f"{OLLAMA}/api/embed", json=payload)
+            r.raise_for_status()
+            data = r.json()
 
-                if data and "embeddings" in data:
-                    res = data["embeddings"] 
-                    embed_cache.set(key, res)
-                    return res
-                
-                res = data["embedding"]
-                embed_cache.set(key, res)
-                return res
-            
-            except httpx.HTTPStatusError as e:
-                if e.response is not None and e.response.status_code == 404 and attempt < max_retries:
-                    await ensure_model_present()
-                    attempt += 1
-                    continue
-                raise
+            if data and "embeddings" in data:
+                return data["embeddings"]
+            return data["embedding"]
 
+        except httpx.HTTPStatusError as e:
+            if e.response is not None and e.response.status_code == 404 and attempt < max_retries:
+                await ensure_model_present()
+                attempt += 1
+                continue
+            raise
 
+async def embed_batch(texts, max_retries = 1, persist = True):
+    """
+    Embed texts, looking each one up individually first; only misses go to
+    Ollama. persist=True uses the on-disk store (documents), persist=False
+    the in-memory LRU (one-off query strings).
+    """
+    hashes = [sha256_text(t) for t in texts]
+    if persist:
+        found = await run_db(embed_store.get_many, EMB_MODEL, hashes)
+    else:
+        found = {}
+        for h in hashes:
+            v = embed_cache.get((EMB_MODEL, h))
+            if v is not None:
+                found[h] = v
 
+    misses = {}
+    for h, t in zip(hashes, texts):
+        if h not in found and h not in misses:
+            misses[h] = t
+    if misses:
+        vecs = await _embed_remote(list(misses.values()), max_retries)
+        if persist:
+            await run_db(embed_store.put_many, EMB_MODEL, list(misses.keys()), vecs)
+        for h, v in zip(misses.keys(), vecs):
+            found[h] = v
+            if not persist:
+                embed_cache.set((EMB_MODEL, h), v)
+
+    return [found[h] for h in hashes]
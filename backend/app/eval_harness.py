@@ -24,6 +24,41 @@ def call_qa(base_url, q, k, max_ctx, timeout_s):
     r.raise_for_status()
     return r.json()
 
+def parse_buckets(text, name):
+    """
+    Cumulative (le, count) pairs of histogram `name`, summed over its other
+    labels (e.g. scrapes merged from several workers), sorted by le.
+    """
+    totals = {}
+    pat = re.compile(rf'^{name}_bucket\{{(.*)\}}\s+([0-9.eE+-]+)$', flags=re.M)
+    for labels, value in pat.findall(text):
+        m = re.search(r'le="([^"]+)"', labels)
+        if not m:
+            continue
+        le = float("inf") if m.group(1) == "+Inf" else float(m.group(1))
+        totals[le] = totals.get(le, 0.0) + float(value)
+    return sorted(totals.items())
+
+def bucket_quantile(buckets, q):
+    """
+    Estimate quantile q (0..1) from cumulative buckets by linear
+    interpolation inside the bucket it falls in, like Prometheus'
+    histogram_quantile(). Values past the last finite bound report that bound.
+    """
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    prev_le, prev_count = 0.0, 0.0
+    for le, count in buckets:
+        if count >= rank:
+            if le == float("inf"):
+                return prev_le
+            if count == prev_count:
+                return le
+            return round(prev_le + (le - prev_le) * (rank - prev_count) / (count - prev_count), 1)
+        prev_le, prev_count = le, count
+    return prev_le
+
 def fetch_metrics(base_url):
     try:
         r = requests.get(f"{base_url}/metrics", timeout=10)
@@ -31,10 +66,12 @@ def fetch_metrics(base_url):
             return {}
         text = r.text
         vals = {}
-        for name in ["qa_latency_ms_p50", "qa_latency_ms_p95", "search_latency_ms_p50", "search_latency_ms_p95"]:
-            m = re.search(rf"^{name}\s+([0-9.]+)$", text, flags=re.M)
-            if m:
-                vals[name] = float(m.group(1))
+        for name in ["qa_latency_ms", "search_latency_ms"]:
+            buckets = parse_buckets(text, name)
+            for label, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+                v = bucket_quantile(buckets, q)
+                if v is not None:
+                    vals[f"{name}_{label}"] = v
         return vals
     except Exception:
         return {}
@@ -137,8 +174,10 @@ def run(base_url, yaml_path, out_prefix, timeout_s):
         "answer_coverage": grounded_ratio,
         "qa_p50_ms": metrics.get("qa_latency_ms_p50"),
         "qa_p95_ms": metrics.get("qa_latency_ms_p95"),
+        "qa_p99_ms": metrics.get("qa_latency_ms_p99"),
         "search_p50_ms": metrics.get("search_latency_ms_p50"),
         "search_p95_ms": metrics.get("search_latency_ms_p95"),
+        "search_p99_ms": metrics.get("search_latency_ms_p99"),
     }
     json_path = f"{out_prefix}_summary.json"
     with open(json_path, "w", encoding="utf-8") as f:
@@ -1,10 +1,22 @@
 from __future__ import annotations
-import os, re, io, chardet
+import os, re, io, atexit, chardet, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
 import fitz
 from markdown_it import MarkdownIt
 
 md = MarkdownIt()
 
+PDF_PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_IN_FLIGHT = int(os.getenv("PDF_PAGES_IN_FLIGHT", "32"))  # extracted pages held at once
+PDF_PAGE_BATCH = int(os.getenv("PDF_PAGE_BATCH", "8"))  # pages per worker task
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+
+# this process's page worker budget; pipeline workers get their share of
+# the CPUs per document through set_page_workers (see pipeline.run)
+_page_workers = PDF_PAGE_WORKERS
+
 _HEADER_FOOTER_RE = re.compile(r"(^.{0,80}\s*\n){0,2}|(\n.{0,80}$){0,2}", re.M)
 HYPHEN_LINEBREAK = re.compile(r"(\w)-\n(\w)")
 MULTISPACE = re.compile(r"[ \t]+")
@@ -25,15 +37,84 @@ def _real_text_guess_encoding(path: str):
     except Exception:
         return raw.decode("utf-8", errors="ignore")
     
+def _clean_page(txt: str) -> str:
+    return _normalize_text(_HEADER_FOOTER_RE.sub("", txt))
+
+def _pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Cleaned text of pages [start, stop); runs in a page worker."""
+    with fitz.open(path) as doc:
+        return [_clean_page(doc[i].get_text("text")) for i in range(start, stop)]
+
+_page_pool: ProcessPoolExecutor | None = None
+
+def set_page_workers(n: int):
+    """
+    Cap this process's page workers at `n` (at most PDF_PAGE_WORKERS);
+    1 or less extracts pages in-process. A pool started under another
+    budget is shut down and restarted at the new size when next needed.
+    """
+    global _page_workers
+    n = max(0, min(PDF_PAGE_WORKERS, n))
+    if n != _page_workers:
+        shutdown_page_pool()
+    _page_workers = n
+
+def _get_page_pool():
+    global _page_pool
+    if _page_pool is None:
+        _page_pool = ProcessPoolExecutor(
+            max_workers=_page_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _page_pool
+
+def shutdown_page_pool():
+    global _page_pool
+    if _page_pool is not None:
+        _page_pool.shutdown(cancel_futures=True)
+        _page_pool = None
+
+atexit.register(shutdown_page_pool)
+
+def iter_pdf_pages(path: str) -> Iterator[str]:
+    """
+    Yield each non-empty page's cleaned text in order. Large PDFs are split
+    into PDF_PAGE_BATCH page ranges extracted in worker processes; at most
+    PDF_PAGES_IN_FLIGHT pages are extracted but not yet consumed.
+    """
+    with fitz.open(path) as doc:
+        n = doc.page_count
+        if n < PDF_PARALLEL_MIN_PAGES or _page_workers <= 1:
+            for page in doc:
+                txt = _clean_page(page.get_text("text"))
+                if txt:
+                    yield txt
+            return
+
+    pool = _get_page_pool()
+    batch = max(1, PDF_PAGE_BATCH)
+    max_batches = max(1, PDF_PAGES_IN_FLIGHT // batch)
+    ranges = iter(range(0, n, batch))
+    futures = deque()
+    try:
+        for start in ranges:
+            futures.append(pool.submit(_pdf_pages, path, start, min(start + batch, n)))
+            if len(futures) >= max_batches:
+                break
+        while futures:
+            pages = futures.popleft().result()
+            start = next(ranges, None)
+            if start is not None:
+                futures.append(pool.submit(_pdf_pages, path, start, min(start + batch, n)))
+            for txt in pages:
+                if txt:
+                    yield txt
+    finally:
+        for f in futures:
+            f.cancel()
+
 def extract_pdf(path: str):
-    doc = fitz.open(path)
-    pages = []
-    for p in doc:
-        txt = p.get_text("text")
-        txt = _HEADER_FOOTER_RE.sub("", txt)
-        pages.append(txt.strip())
-    out = "\n\n".join(pages)
-    return _normalize_text(out)
+    return "\n\n".join(iter_pdf_pages(path))
 
 def extract_md(path):
     src = _real_text_guess_encoding(path)
@@ -56,4 +137,14 @@ def extract_text(path):
         return extract_md(path)
     if ext in {".py", ".js", ".ts", ".tsx", ".java", ".go", ".rs", ".cpp", ".c", ".h", ".cs", ".rb", ".php", ".scala", ".kt", ".sql"}:
         return extract_code(path)
-    return extract_plain(path)
\ No newline at end of file
+    return extract_plain(path)
+
+def iter_text(path) -> Iterator[str]:
+    """
+    Extracted text as a stream of pieces that join with blank lines:
+    pages for PDFs, the whole text for everything else.
+    """
+    if os.path.splitext(path)[1].lower() == ".pdf":
+        yield from iter_pdf_pages(path)
+    else:
+        yield extract_text(path)
@@ -1,15 +1,32 @@
 ### Incremental improvements to indexer
 from __future__ import annotations
-import os, ujson, json, hashlib
+import os, ujson, json, hashlib, threading
 import numpy as np
 import faiss
 from typing import Dict, List, Tuple
+from .mmap_matrix import MmapMatrix
 
 DATA_DIR = "data"
 INDEX_PATH = os.path.join(DATA_DIR, "index.faiss")
-META_PATH = os.path.join(DATA_DIR, "chunks.json")
-DOCMAP_PATH = os.path.join(DATA_DIR, "doc_index.json")
 COUNTER_PATH = os.path.join(DATA_DIR, "id_counter.json")
+GENERATION_PATH = os.path.join(DATA_DIR, "index_generation.json")
+INDEX_META_PATH = os.path.join(DATA_DIR, "index_meta.json")
+VECTORS_PATH = os.path.join(DATA_DIR, "vectors.f32")
+
+# FAISS factory string for the searched index, e.g. "Flat", "IVF1024,Flat", "HNSW32"
+INDEX_FACTORY = os.getenv("INDEX_FACTORY", "Flat")
+DEFAULT_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+# compressed indexes (SQ/PQ) fetch k * RERANK_FACTOR candidates and rescore
+# them exactly against vectors.f32; INDEX_RERANK=auto|on|off
+RERANK = os.getenv("INDEX_RERANK", "auto").lower()
+RERANK_FACTOR = int(os.getenv("INDEX_RERANK_FACTOR", "4"))
+# trained indexes (IVF, PQ) are retrained from vectors.f32 once they hold
+# this many times the vectors they were trained on; 0 disables
+RETRAIN_GROWTH = float(os.getenv("INDEX_RETRAIN_GROWTH", "4"))
+
+# full-precision copy of every indexed vector, row = embedding id
+vector_store = MmapMatrix(VECTORS_PATH)
 
 def _ensure_dirs():
     os.makedirs(DATA_DIR, exist_ok=True)
@@ -22,6 +39,56 @@ def _read_counter():
 def _write_counter(v):
     with open(COUNTER_PATH, "w") as f: f.write(str(v))
 
+def _read_generation():
+    if not os.path.exists(GENERATION_PATH):
+        return 0
+    with open(GENERATION_PATH, "r") as f: return int(f.read().strip() or "0")
+
+def _write_generation(v):
+    _ensure_dirs()
+    with open(GENERATION_PATH, "w") as f: f.write(str(v))
+
+def _read_index_meta():
+    if not os.path.exists(INDEX_META_PATH):
+        # indexes written before INDEX_FACTORY existed were always flat
+        return {"factory": "Flat"}
+    with open(INDEX_META_PATH, "r") as f: return json.load(f)
+
+def _write_index_meta(meta):
+    _ensure_dirs()
+    with open(INDEX_META_PATH, "w") as f: json.dump(meta, f)
+
+def _ivf(index):
+    return faiss.try_extract_index_ivf(index)
+
+def _base(index):
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+def _apply_search_defaults(index):
+    ivf = _ivf(index)
+    if ivf is not None:
+        ivf.nprobe = DEFAULT_NPROBE
+    base = _base(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = DEFAULT_EF_SEARCH
+    return index
+
+def new_index(dim: int, factory: str = INDEX_FACTORY):
+    """
+    Empty index for a FAISS factory string (inner product metric).
+    IVF indexes keep their own ids (IDMap2 on top of IVF breaks after
+    remove_ids); everything else is wrapped in IndexIDMap2.
+    """
+    base = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+    ivf = _ivf(base)
+    if ivf is not None:
+        # id -> entry map so ids can be removed and reconstructed
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return _apply_search_defaults(base)
+    return _apply_search_defaults(faiss.IndexIDMap2(base))
+
 def create_or_load_index(dim: int | None = None):
     """
     Ensure IndexMap2 exists and load it or create a fresh one"""
@@ -29,44 +96,315 @@ def create_or_load_index(dim: int | None = None):
 
     if os.path.exists(INDEX_PATH):
         idx = faiss.read_index(INDEX_PATH)
-        # ensure IDMap2 
-        if not isinstance(idx, faiss.IndexIDMap2):
+        # ensure IDMap2 (IVF carries its own ids)
+        if not isinstance(idx, faiss.IndexIDMap2) and _ivf(idx) is None:
             idx = faiss.IndexIDMap2(idx)
-        return idx
+        return _apply_search_defaults(idx)
     if dim is None:
         raise ValueError("First time index build requires dim")
-    base = faiss.IndexFlatIP(dim)
-    return faiss.IndexIDMap2(base)
-
-
-def save_index(index: faiss.Index):
+    return new_index(dim)
+
+def index_ids(index) -> np.ndarray:
+    ivf = _ivf(index)
+    if ivf is None:
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    inv = ivf.invlists
+    parts = [
+        faiss.rev_swig_ptr(inv.get_ids(l), inv.list_size(l)).copy()
+        for l in range(ivf.nlist) if inv.list_size(l)
+    ]
+    return np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+def exact_vectors(ids: np.ndarray) -> np.ndarray:
+    """
+    Full-precision vectors for `ids` from vector_store; rows that are
+    missing come back as zeros (stored vectors are unit length).
+    """
+    out = np.zeros((len(ids), vector_store.dim or 0), dtype="float32")
+    if not len(ids) or not vector_store.dim:
+        return out
+    ids = np.asarray(ids, dtype=np.int64)
+    have = ids < vector_store.rows
+    if have.any():
+        out[have] = vector_store.read(ids[have])
+    return out
+
+def index_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (ids, vectors) of everything stored. Vectors come from vector_store when
+    present and are reconstructed from the index otherwise (approximate for
+    quantized indexes).
+    """
+    ids = index_ids(index)
+    if ids.size == 0:
+        return ids, np.zeros((0, index.d), dtype="float32")
+    vecs = exact_vectors(ids) if vector_store.dim == index.d else np.zeros((0, index.d), dtype="float32")
+    if vecs.shape[0] != ids.size:
+        return ids, index.reconstruct_batch(ids)
+    missing = ~vecs.any(axis=1)
+    if missing.any():
+        vecs[missing] = index.reconstruct_batch(ids[missing])
+    return ids, vecs
+
+def is_compressed(index) -> bool:
+    """
+    True when the index stores vectors in fewer bytes than float32.
+    """
+    base = _base(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    try:
+        return base.sa_code_size() < index.d * 4
+    except RuntimeError:
+        return False
+
+def needs_training(dim: int, factory: str) -> bool:
+    return not faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT).is_trained
+
+def train_and_add(index, vecs: np.ndarray, ids: np.ndarray) -> bool:
+    """
+    Train `index` on `vecs` if it needs it, then add them.
+    Returns False (index untouched) when there are too few vectors to train.
+    """
+    if not index.is_trained:
+        try:
+            index.train(vecs)
+        except RuntimeError as e:
+            print(f"[INDEX] cannot train on {len(vecs)} vectors: {e}")
+            return False
+    index.add_with_ids(vecs, ids)
+    return True
+
+def save_index(index: faiss.Index, factory: str | None = None, trained_on: int | None = None):
     _ensure_dirs()
-    faiss.write_index(index, INDEX_PATH)
+    # write aside and rename so readers never see a half-written file
+    tmp = INDEX_PATH + ".tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, INDEX_PATH)
+    if factory is not None:
+        _write_index_meta({"factory": factory, "dim": int(index.d), "trained_on": trained_on})
+
+class IndexManager:
+    """
+    Process-wide owner of the live FAISS index.
+    Readers take a snapshot and search it without locking. Writers mutate a
+    private copy (see IndexWriter) and publish it with commit(), which bumps
+    the generation. The generation file doubles as a signal to other workers
+    that the index on disk changed and should be reloaded."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index: faiss.Index | None = None
+        self._factory = "Flat"
+        self._trained_on: int | None = None
+        self._generation = 0
+        self._stamp = None
+        self._loaded = False
+
+    def _disk_stamp(self):
+        try:
+            return os.stat(GENERATION_PATH).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _publish(self, index, factory, trained_on=None):
+        self._index = index
+        self._factory = factory
+        self._trained_on = trained_on
+        self._generation = _read_generation()
+        self._stamp = self._disk_stamp()
+        self._loaded = True
+
+    def snapshot(self) -> Tuple[faiss.Index | None, int]:
+        stamp = self._disk_stamp()
+        with self._lock:
+            if not self._loaded or stamp != self._stamp:
+                index = create_or_load_index() if os.path.exists(INDEX_PATH) else None
+                meta = _read_index_meta()
+                self._publish(index, meta.get("factory", "Flat"), meta.get("trained_on"))
+            return self._index, self._generation
+
+    @property
+    def generation(self) -> int:
+        return self.snapshot()[1]
+
+    @property
+    def factory(self) -> str:
+        self.snapshot()
+        return self._factory
+
+    @property
+    def trained_on(self) -> int | None:
+        """Vectors the live index was trained on (None: untrained type or unknown)."""
+        self.snapshot()
+        return self._trained_on
+
+    @property
+    def needs_migration(self) -> bool:
+        index, _ = self.snapshot()
+        return index is not None and self._factory != INDEX_FACTORY
+
+    def writable(self):
+        """
+        Copy of the live index with its factory string and training size for
+        a writer to mutate, or (None, None, None) if there is none yet. The
+        copy is a full clone, so a run that changes anything holds the index
+        in memory twice until it commits."""
+        index, _ = self.snapshot()
+        if index is None:
+            return None, None, None
+        return faiss.clone_index(index), self._factory, self._trained_on
+
+    def commit(self, index: faiss.Index | None, factory: str | None = None,
+               trained_on: int | None = None) -> int:
+        """
+        Persist `index` and swap it in as the new generation.
+        Passing None publishes an empty generation and drops the saved index.
+        The file is written aside and renamed before the lock is taken, so
+        searches keep using the old generation while it is saved."""
+        factory = factory or self._factory
+        if index is not None:
+            save_index(index, factory, trained_on)
+        elif os.path.exists(INDEX_PATH):
+            os.remove(INDEX_PATH)
+        with self._lock:
+            _write_generation(_read_generation() + 1)
+            self._publish(index, factory, trained_on)
+            return self._generation
+
+index_manager = IndexManager()
+
+class IndexWriter:
+    """
+    One indexing run's private copy of the live index, or with fresh=True a
+    new index built from scratch (full reindex) that replaces it on commit.
+    The copy is taken on first change and migrated to INDEX_FACTORY if the
+    live index was built with a different one. Vectors added to an index
+    that still needs training are held back and used to train it on commit;
+    a trained index that has grown RETRAIN_GROWTH times past its training
+    set is retrained on commit.
+    """
 
-def load_meta():
-    if not os.path.exists(META_PATH): return {}
-    with open(META_PATH, "r", encoding='utf-8') as f:
-        return json.load(f)
+    def __init__(self, manager: IndexManager = index_manager, fresh: bool = False):
+        self.manager = manager
+        self.fresh = fresh
+        self.index: faiss.Index | None = None
+        self.factory: str | None = None
+        self.trained_on: int | None = None
+        self._opened = False
+        self._pending: List[Tuple[np.ndarray, np.ndarray]] = []
+
+    def open(self):
+        if self._opened:
+            return self.index
+        self._opened = True
+        if self.fresh:
+            return None  # created by the first add
+        self.index, self.factory, self.trained_on = self.manager.writable()
+        if self.index is not None and self.factory != INDEX_FACTORY:
+            self._migrate()
+        return self.index
+
+    def _rebuild(self, factory: str) -> bool:
+        """
+        Replace the copy with a `factory` index trained on everything it
+        holds; False (copy untouched) when there is too little data.
+        """
+        ids, vecs = index_vectors(self.index)
+        target = new_index(self.index.d, factory)
+        trains = not target.is_trained
+        if ids.size and not train_and_add(target, vecs, ids):
+            return False
+        self.index, self.factory = target, factory
+        self.trained_on = int(ids.size) if trains else None
+        return True
+
+    def _migrate(self):
+        old = self.factory
+        if not self._rebuild(INDEX_FACTORY):
+            print(f"[INDEX] keeping {old} index until there is enough data for {INDEX_FACTORY}")
+            return
+        print(f"[INDEX] migrated {self.index.ntotal} vectors from {old} to {INDEX_FACTORY}")
+
+    def _retrain_due(self) -> bool:
+        if RETRAIN_GROWTH <= 0 or self.index is None or not self.index.ntotal:
+            return False
+        if self.trained_on is None:
+            # indexes saved before training sizes were recorded: retrain once
+            return needs_training(self.index.d, self.factory)
+        return self.index.ntotal > RETRAIN_GROWTH * self.trained_on
+
+    @property
+    def changed(self) -> bool:
+        return self._opened or self.fresh
+
+    def remove(self, ids: List[int]) -> int:
+        if not ids:
+            return 0
+        drop = set(int(i) for i in ids)
+        pending_removed = 0
+        for j, (vecs, pids) in enumerate(self._pending):
+            keep = np.array([int(i) not in drop for i in pids], dtype=bool)
+            pending_removed += int((~keep).sum())
+            self._pending[j] = (vecs[keep], pids[keep])
+        index = self.open()
+        return pending_removed + (remove_ids(index, ids) if index is not None else 0)
+
+    def add(self, vecs: np.ndarray, ids: np.ndarray):
+        if vector_store.dim not in (None, vecs.shape[1]):
+            # embedding model changed; the old rows are useless
+            vector_store.reset()
+        vector_store.write_rows(ids, vecs)
+        index = self.open()
+        if index is None:
+            self.index, self.factory = new_index(vecs.shape[1], INDEX_FACTORY), INDEX_FACTORY
+            index = self.index
+        if index.is_trained and not self._pending:
+            index.add_with_ids(vecs, ids)
+        else:
+            self._pending.append((vecs, ids))
+
+    def commit(self) -> int:
+        if not self.changed:
+            return self.manager.generation
+        if self._pending:
+            vecs = np.concatenate([v for v, _ in self._pending])
+            ids = np.concatenate([i for _, i in self._pending])
+            self._pending = []
+            trains = not self.index.is_trained
+            if len(ids) and not train_and_add(self.index, vecs, ids):
+                # too little data for this factory yet: fall back to flat,
+                # the next run migrates once the corpus is large enough
+                print(f"[INDEX] {len(ids)} vectors are too few for {self.factory}, saving a Flat index for now")
+                old_ids, old_vecs = index_vectors(self.index)
+                flat = new_index(vecs.shape[1], "Flat")
+                flat.add_with_ids(np.concatenate([old_vecs, vecs]), np.concatenate([old_ids, ids]))
+                self.index, self.factory, self.trained_on = flat, "Flat", None
+            elif trains and len(ids):
+                self.trained_on = int(len(ids))
+        elif self._retrain_due():
+            was = self.trained_on
+            if self._rebuild(self.factory):
+                print(f"[INDEX] retrained {self.factory} on {self.trained_on} vectors (was {was})")
+        return self.manager.commit(self.index, self.factory, self.trained_on)
 
-def save_meta(meta):
-    _ensure_dirs()
-    with open(META_PATH, "w", encoding='utf-8') as f:
-        json.dump(meta, f, ensure_ascii=False)
-
-def load_docmap():
-    if not os.path.exists(DOCMAP_PATH):
-        return {}
-    with open(DOCMAP_PATH, "r", encoding='utf-8') as f:
-        return json.load(f)
-    
-def save_docmap(docmap):
-    _ensure_dirs()
-    with open(DOCMAP_PATH, "w", encoding='utf-8') as f:
-        json.dump(docmap,f, ensure_ascii=False)
-    
 def sha256_bytes(b: bytes):
     return hashlib.sha256(b).hexdigest()
 
+def sha256_file(path: str, bufsize: int = 1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(bufsize)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+def file_stat(path: str):
+    st = os.stat(path)
+    return {"size": int(st.st_size), "mtime": st.st_mtime}
+
 def sha256_text(s: str):
     return hashlib.sha256(s.encode("utf-8", "ignore")).hexdigest()
 
@@ -80,18 +418,83 @@ def next_ids(n):
     _write_counter(int(cur+n))
     return ids
 
-def remove_ids(index: faiss.IndexIDMap2, ids: List[int]):
+def remove_ids(index: faiss.Index, ids: List[int]):
     if not ids: 
         return 0
-    sel = faiss.IDSelectorBatch(np.array(ids, dtype=np.int64))
-    return index.remove_ids(sel)
-
-def search(index: faiss.IndexIDMap2, query_vec: np.ndarray, top_k=5):
-    q = np.array([query_vec], dtype="float32")
-    D, I = index.search(q,top_k)
-    return D[0].tolist(), I[0].astype(np.int64).tolist()
+    arr = np.array(ids, dtype=np.int64)
+    if _ivf(index) is not None:
+        # IVF's hashtable direct map only accepts an explicit id array
+        return index.remove_ids(faiss.IDSelectorArray(arr))
+    try:
+        return index.remove_ids(faiss.IDSelectorBatch(arr))
+    except RuntimeError:
+        # graph indexes (HNSW) cannot delete: rebuild from what remains
+        all_ids, vecs = index_vectors(index)
+        keep = ~np.isin(all_ids, arr)
+        index.reset()
+        if keep.any():
+            index.add_with_ids(vecs[keep], all_ids[keep])
+        return int((~keep).sum())
+
+def search_params(index: faiss.Index, nprobe: int | None = None, ef_search: int | None = None,
+                  sel: faiss.IDSelector | None = None):
+    """
+    Per-query FAISS search parameters, or None to use the index defaults.
+    `sel` restricts the search to an id subset (IndexIDMap2 translates it).
+    """
+    ivf = _ivf(index)
+    base = _base(index)
+    kw = {"sel": sel} if sel is not None else {}
+    if ivf is not None:
+        if not (nprobe or kw):
+            return None
+        # a params object overrides every field, so carry the index default
+        params = faiss.SearchParametersIVF(nprobe=int(nprobe or ivf.nprobe), **kw)
+        if isinstance(base, faiss.IndexPreTransform):
+            params = faiss.SearchParametersPreTransform(index_params=params)
+        return params
+    if isinstance(base, faiss.IndexHNSW):
+        if not (ef_search or kw):
+            return None
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or base.hnsw.efSearch), **kw)
+    return faiss.SearchParameters(**kw) if kw else None
+
+def _rerank_enabled(index) -> bool:
+    if RERANK == "off" or not vector_store.dim or vector_store.dim != index.d:
+        return False
+    return RERANK == "on" or is_compressed(index)
+
+def rerank(query_vec: np.ndarray, ids: np.ndarray, top_k: int):
+    """
+    Exact inner products of the query against candidate ids, best first.
+    """
+    vecs = exact_vectors(ids)
+    scores = vecs @ np.asarray(query_vec, dtype="float32")
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return scores[order], ids[order]
 
-    
+def search_many(index: faiss.Index, query_vecs: np.ndarray, top_k=5, nprobe=None, ef_search=None, sel=None):
+    """
+    One matrix search for a batch of query vectors.
+    Returns a (scores, ids) pair of lists per query row.
+    """
+    q = np.ascontiguousarray(query_vecs, dtype="float32").reshape(-1, index.d)
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+    exact = _rerank_enabled(index)
+    D, I = index.search(q, top_k * RERANK_FACTOR if exact else top_k, params=params)
+    out = []
+    for qv, d, i in zip(q, D, I):
+        # IVF/HNSW pad with -1 when fewer than top_k hits
+        keep = i >= 0
+        d, i = d[keep], i[keep].astype(np.int64)
+        if exact:
+            d, i = rerank(qv, i, top_k)
+        out.append((d.tolist(), i.tolist()))
+    return out
+
+def search(index: faiss.Index, query_vec: np.ndarray, top_k=5, nprobe=None, ef_search=None, sel=None):
+    return search_many(index, np.array([query_vec], dtype="float32"), top_k,
+                       nprobe=nprobe, ef_search=ef_search, sel=sel)[0]
 
 
 
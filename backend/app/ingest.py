@@ -0,0 +1,508 @@
+from __future__ import annotations
+import os, asyncio, time, glob, numpy as np
+from datetime import datetime
+from typing import Dict, List
+from sqlalchemy import bindparam, delete, insert, select, update
+
+from .routes.upload import UPLOAD_DIR
+from .indexer import IndexWriter, index_manager, index_ids, file_stat, next_ids, l2_normalize, sha256_text
+from . import pipeline
+from .chunking import chunk_tails
+from .metrics import span
+from .db import (
+    SessionLocal, engine, Document, Chunk, ChunkStage, delete_chunks, index_chunks,
+    reset_chunk_stage, drop_chunk_stage, swap_in_chunk_stage,
+)
+
+# present while a run's DB writes may be ahead of the index (see repair)
+RUN_MARKER = "data/index_run.pending"
+INDEX_FILES = ("data/index.faiss", "data/chunks.json", "data/doc_index.json", "data/id_counter.json", "data/index_meta.json", RUN_MARKER)
+
+WRITE_BATCH_DOCS = int(os.getenv("INDEX_WRITE_BATCH_DOCS", "32"))  # documents per transaction
+WRITE_BATCH_CHUNKS = int(os.getenv("INDEX_WRITE_BATCH_CHUNKS", "20000"))  # or chunk rows, whichever comes first
+
+_IN_BATCH = 500  # stay well under SQLite's bound-parameter limit
+
+def _batches(items, n=_IN_BATCH):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+def _unreferenced(conn, ids):
+    """
+    The subset of `ids` no chunk row points at any more.
+    """
+    ids = list(dict.fromkeys(ids))
+    used = set()
+    for part in _batches(ids):
+        used.update(conn.execute(
+            select(Chunk.embedding_id).where(Chunk.embedding_id.in_(part)).distinct()
+        ).scalars())
+    return [i for i in ids if i not in used]
+
+def chunk_rows(info, chunks, embedding_ids):
+    """
+    Column values for a document's chunks, embedding ids included. Chunks
+    with spans store their offsets and only the text past the previous
+    chunk (see chunking.chunk_tails).
+    """
+    spans = info.get("spans")
+    hashes = info.get("chunk_hashes") or [sha256_text(c) for c in chunks]
+    tails = chunk_tails(spans, chunks) if spans else [None] * len(chunks)
+    rows = []
+    for pos, chunk_text in enumerate(chunks):
+        start, end = spans[pos] if spans else (None, None)
+        rows.append({
+            "position": pos,
+            "text": None if spans else chunk_text,
+            "start_char": start,
+            "end_char": end,
+            "tail": tails[pos],
+            "text_hash": hashes[pos],
+            "embedding_id": int(embedding_ids[pos]),
+        })
+    return rows
+
+def _doc_values(path, info):
+    """
+    Document columns for a changed document, without its hash and stat.
+    """
+    return {
+        "hash": None,
+        "type": path.split(".")[-1].lower(),
+        "size": None,
+        "mtime": None,
+        "raw_hash": None,
+        "modified": datetime.fromtimestamp(info["mtime"]),
+        "text": None,
+    }
+
+class DocBatch:
+    """
+    Document writes buffered by the pipeline's writer stage and persisted
+    together in one transaction: documents are inserted or updated, their
+    old chunks deleted, and every new chunk inserted with its embedding id
+    in a single executemany, then added to the keyword index with the
+    texts the batch already holds. Changed documents are written without
+    their hash and stat; mark_indexed sets those once the index has the
+    vectors. With stage=True (full reindex) chunks go to ChunkStage and
+    existing documents are left alone until swap_in_stage.
+    """
+
+    def __init__(self, stage: bool = False):
+        self.stage = stage
+        self.docs: List[tuple] = []  # (path, info, chunk rows, chunk texts)
+        self.touched: List[tuple] = []  # (path, info)
+        self.rows = 0
+        self.hash_ids: Dict[str, int] = {}  # text_hash -> embedding id of chunks in this batch
+        self.added: List[int] = []  # vectors added for this batch
+        self.stale: List[int] = []  # ids the docs used before, dropped once unreferenced
+
+    def __len__(self):
+        return len(self.docs) + len(self.touched)
+
+    @property
+    def full(self) -> bool:
+        return len(self) >= WRITE_BATCH_DOCS or self.rows >= WRITE_BATCH_CHUNKS
+
+    def touch(self, path, info):
+        """Record new stat/raw hash for a doc whose extracted text did not change."""
+        self.touched.append((path, info))
+
+    def put(self, path, info, rows, old_ids, chunks):
+        self.docs.append((path, info, rows, chunks))
+        self.rows += len(rows)
+        self.stale.extend(old_ids)
+        self.hash_ids.update((r["text_hash"], r["embedding_id"]) for r in rows)
+
+    def flush(self) -> List[int]:
+        """
+        Write everything in one transaction; returns the stale embedding ids
+        nothing references any more (to remove from the index).
+        """
+        if not self:
+            return []
+        with engine.begin() as conn:
+            if self.touched:
+                conn.execute(
+                    update(Document).where(Document.path == bindparam("b_path"))
+                    .values(size=bindparam("b_size"), mtime=bindparam("b_mtime"), raw_hash=bindparam("b_raw_hash")),
+                    [{"b_path": p, "b_size": i["size"], "b_mtime": i["mtime"], "b_raw_hash": i["raw_hash"]}
+                     for p, i in self.touched],
+                )
+            if self.docs:
+                paths = [p for p, _, _, _ in self.docs]
+                doc_ids = dict(conn.execute(
+                    select(Document.path, Document.id).where(Document.path.in_(paths))
+                ).all())
+                values = {p: _doc_values(p, i) for p, i, _, _ in self.docs}
+                existing = [] if self.stage else [p for p in paths if p in doc_ids]
+                if existing:
+                    delete_chunks(conn, doc_ids.values())
+                    conn.execute(
+                        update(Document).where(Document.id == bindparam("b_id"))
+                        .values({k: bindparam(f"b_{k}") for k in values[existing[0]]}),
+                        [{"b_id": doc_ids[p], **{f"b_{k}": v for k, v in values[p].items()}} for p in existing],
+                    )
+                new = [p for p in paths if p not in doc_ids]
+                if new:
+                    conn.execute(insert(Document), [{"path": p, "tags": "", **values[p]} for p in new])
+                    doc_ids.update(conn.execute(
+                        select(Document.path, Document.id).where(Document.path.in_(new))
+                    ).all())
+
+                rows = [
+                    {**r, "document_id": doc_ids[p]}
+                    for p, _, doc_rows, _ in self.docs for r in doc_rows
+                ]
+                if rows and self.stage:
+                    conn.execute(insert(ChunkStage), rows)
+                elif rows:
+                    conn.execute(insert(Chunk), rows)
+                    chunk_ids = {}
+                    for part in _batches(doc_ids[p] for p in paths):
+                        chunk_ids.update(((d, pos), cid) for cid, d, pos in conn.execute(
+                            select(Chunk.id, Chunk.document_id, Chunk.position).where(Chunk.document_id.in_(part))
+                        ))
+                    index_chunks(conn, [
+                        (chunk_ids[(doc_ids[p], pos)], body)
+                        for p, _, _, texts in self.docs for pos, body in enumerate(texts)
+                    ])
+            return _unreferenced(conn, self.stale)
+
+def swap_in_stage(docs, gone):
+    """
+    Publish a full reindex's rows in one transaction: the staged chunks
+    replace all others, `docs` ([(path, info)] it wrote) get their new
+    columns, documents at `gone` paths are dropped and every other one is
+    left unindexed for the next run.
+    """
+    with engine.begin() as conn:
+        swap_in_chunk_stage(conn)
+        conn.execute(update(Document).values(hash=None, size=None, mtime=None, raw_hash=None, text=None))
+        for part in _batches(docs):
+            conn.execute(
+                update(Document).where(Document.path == bindparam("b_path"))
+                .values(type=bindparam("b_type"), modified=bindparam("b_modified")),
+                [{"b_path": p, "b_type": v["type"], "b_modified": v["modified"]}
+                 for p, v in ((p, _doc_values(p, i)) for p, i in part)],
+            )
+        for part in _batches(gone):
+            conn.execute(delete(Document).where(Document.path.in_(part)))
+
+def mark_indexed(docs):
+    """
+    Record hash and stat for documents whose vectors are now in the live
+    index, so later runs can skip them. `docs` is [(path, info)].
+    """
+    if not docs:
+        return
+    with engine.begin() as conn:
+        for part in _batches(docs):
+            conn.execute(
+                update(Document).where(Document.path == bindparam("b_path"))
+                .values(hash=bindparam("b_hash"), size=bindparam("b_size"),
+                        mtime=bindparam("b_mtime"), raw_hash=bindparam("b_raw_hash")),
+                [{"b_path": p, "b_hash": i["doc_hash"], "b_size": i["size"], "b_mtime": i["mtime"],
+                  "b_raw_hash": i["raw_hash"]} for p, i in part],
+            )
+
+def repair(writer) -> int:
+    """
+    Reconcile the DB with the live index after a run that stopped between
+    writing rows and committing the index. Chunks pointing at vectors the
+    index never got are unlinked (their documents, still without a hash,
+    are re-indexed), and vectors no chunk references any more are removed
+    from `writer`. Returns how many links and vectors were dropped.
+    """
+    index = writer.open()
+    live = set(index_ids(index).tolist()) if index is not None else set()
+    with engine.begin() as conn:
+        used = set(conn.execute(
+            select(Chunk.embedding_id).where(Chunk.embedding_id.isnot(None)).distinct()
+        ).scalars())
+        dangling = used - live
+        for part in _batches(dangling):
+            conn.execute(update(Chunk).where(Chunk.embedding_id.in_(part)).values(embedding_id=None))
+    orphans = live - used
+    writer.remove(sorted(orphans))
+    if dangling or orphans:
+        print(f"[INDEX] interrupted run repaired: {len(dangling)} missing vectors unlinked, {len(orphans)} orphaned removed")
+    return len(dangling) + len(orphans)
+
+def load_doc_state(paths=None):
+    """
+    path -> {doc_hash, raw_hash, size, mtime} for every indexed document,
+    or only those in `paths`.
+    """
+    db = SessionLocal()
+    try:
+        q = db.query(Document.path, Document.hash, Document.raw_hash, Document.size, Document.mtime)
+        if paths is not None:
+            q = q.filter(Document.path.in_(list(paths)))
+        rows = q.all()
+        return {
+            path: {"doc_hash": h, "raw_hash": rh, "size": size, "mtime": mtime}
+            for path, h, rh, size, mtime in rows
+        }
+    finally:
+        db.close()
+
+def chunk_embedding_ids(path):
+    """
+    A document's chunk vectors, as [(text_hash, embedding_id)].
+    """
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Chunk.text_hash, Chunk.embedding_id)
+            .join(Document, Chunk.document_id == Document.id)
+            .filter(Document.path == path, Chunk.embedding_id.isnot(None))
+            .all()
+        )
+        return [(h, int(eid)) for h, eid in rows]
+    finally:
+        db.close()
+
+def shared_embedding_ids(hashes, stage=False):
+    """
+    {text_hash: embedding_id} for chunk texts some document already has a
+    vector for; with stage=True, only among a full reindex's staged chunks.
+    """
+    table = ChunkStage.c if stage else Chunk
+    out = {}
+    db = SessionLocal()
+    try:
+        for part in _batches(dict.fromkeys(h for h in hashes if h)):
+            rows = (
+                db.query(table.text_hash, table.embedding_id)
+                .filter(table.text_hash.in_(part), table.embedding_id.isnot(None))
+                .all()
+            )
+            out.update((h, int(eid)) for h, eid in rows)
+        return out
+    finally:
+        db.close()
+
+def delete_documents(paths):
+    """
+    Drop documents and their chunks in one transaction; returns the
+    embedding ids that no other document's chunks still use.
+    """
+    if not paths:
+        return []
+    try:
+        with engine.begin() as conn:
+            doc_ids = []
+            for part in _batches(paths):
+                doc_ids.extend(conn.execute(select(Document.id).where(Document.path.in_(part))).scalars())
+            ids = []
+            for part in _batches(doc_ids):
+                ids.extend(conn.execute(
+                    select(Chunk.embedding_id)
+                    .where(Chunk.document_id.in_(part), Chunk.embedding_id.isnot(None))
+                ).scalars())
+                delete_chunks(conn, part)
+            ids = _unreferenced(conn, ids)
+            for part in _batches(doc_ids):
+                conn.execute(delete(Document).where(Document.id.in_(part)))
+            return ids
+    except Exception as e:
+        print(f"[DB ERROR] Failed to delete {len(paths)} documents: {e}")
+        return []
+
+def _stat_unchanged(path, entry):
+    if not entry or entry.get("size") is None or entry.get("mtime") is None:
+        return False
+    try:
+        st = file_stat(path)
+    except OSError:
+        return False
+    return st["size"] == entry["size"] and st["mtime"] == entry["mtime"]
+
+async def incremental(job=None, paths=None, rebuild=False):
+    """
+    Incremental indexing:
+        - add/replace chunks for new/changed docs
+        - remove chunks for deleted pics
+    Extraction, embedding and writes run as a staged pipeline (see pipeline.run).
+    `job` (see jobs.Job) receives progress and is polled for cancellation;
+    a cancelled run commits the documents it already wrote.
+    `paths` limits the run to those files (e.g. from the watcher): existing
+    ones are (re)indexed, missing ones removed, nothing else is looked at.
+    Rows are written batch by batch but a document only counts as indexed
+    (hash and stat set) after the index commit. A run that fails still
+    commits the batches it flushed; one that dies before that leaves
+    RUN_MARKER behind and the next run repairs the difference.
+    Everything that blocks (file scans, DB writes, index clone, training and
+    save) runs in threads, so the event loop keeps serving requests.
+    `rebuild` (full reindex) re-chunks and re-embeds every file into a new
+    index and ChunkStage (the embedding store still saves unchanged texts a
+    round trip); searches keep the live index and rows until the run
+    succeeds and both are swapped in. A failed or cancelled rebuild leaves
+    them as they were.
+    """
+    started = time.time()
+    # writes go to a private copy, taken on first change (or a new index
+    # when rebuilding); readers keep the live index until commit
+    writer = IndexWriter(fresh=rebuild)
+    index_dim = None
+
+    def prepare():
+        if paths is None:
+            files = sorted(glob.glob(os.path.join(UPLOAD_DIR, "*")))
+        else:
+            files = sorted(p for p in set(paths) if os.path.isfile(p))
+
+        # path -> {doc_hash, raw_hash, size, mtime}; chunk ids are fetched per doc
+        docmap = load_doc_state(paths)
+        to_delete = [dp for dp in docmap.keys() if dp not in files]
+        if rebuild:
+            # nothing live changes before swap_in_stage; every file is redone
+            reset_chunk_stage()
+            return files, {}, to_delete, 0, files
+
+        if os.path.exists(RUN_MARKER):
+            repair(writer)
+        else:
+            os.makedirs(os.path.dirname(RUN_MARKER), exist_ok=True)
+            open(RUN_MARKER, "w").close()
+        if index_manager.needs_migration:
+            writer.open()  # migrates the copy to INDEX_FACTORY
+        removed = int(writer.remove(delete_documents(to_delete))) if to_delete else 0
+
+        # unchanged size + mtime: skip without opening the file
+        candidates = [p for p in files if not _stat_unchanged(p, docmap.get(p))]
+        return files, docmap, to_delete, removed, candidates
+
+    files, docmap, to_delete_doc_paths, remove_ids_total, candidates = await asyncio.to_thread(prepare)
+
+    changed_docs = 0
+    shared_chunks = 0
+    add_ids = []
+    written = []  # (path, info) of changed docs flushed so far
+
+    batch = DocBatch(stage=rebuild)
+
+    def flush():
+        nonlocal batch
+        done, batch = batch, DocBatch(stage=rebuild)
+        try:
+            stale = done.flush()
+        except Exception as e:
+            print(f"[DB ERROR] Failed to write {len(done)} documents: {e}")
+            # rolled back: the docs keep their old rows and are retried next run
+            writer.remove(done.added)
+            return
+        written.extend((p, i) for p, i, _, _ in done.docs)
+        writer.remove(stale)
+
+    def write(path, info, chunks, embeddings):
+        # single writer stage: only one call runs at a time
+        nonlocal index_dim, changed_docs, shared_chunks
+        if chunks is None:
+            # content unchanged, only the stat moved
+            batch.touch(path, info)
+        else:
+            changed_docs += 1
+            # a rebuild shares ids only among its own staged chunks
+            old = [] if rebuild else chunk_embedding_ids(path)
+            # identical chunk text shares one vector: reuse the doc's previous
+            # ids, other documents' and this batch's; embed only new texts
+            hashes = info.get("chunk_hashes") or [sha256_text(c) for c in chunks]
+            info["chunk_hashes"] = hashes
+            known_ids = {h: eid for h, eid in old if h}
+            known_ids.update(shared_embedding_ids(hashes, stage=rebuild))
+            known_ids.update(batch.hash_ids)
+            fresh = {}
+            for pos, h in enumerate(hashes):
+                if h not in known_ids and h not in fresh:
+                    fresh[h] = pos
+            if fresh:
+                arr = l2_normalize(np.asarray([embeddings[pos] for pos in fresh.values()], dtype="float32"))
+                index_dim = arr.shape[1]
+                ids = next_ids(len(fresh)).tolist()
+                writer.add(arr, np.asarray(ids, dtype=np.int64))
+                known_ids.update(zip(fresh, ids))
+                batch.added.extend(ids)
+                add_ids.extend(ids)
+            shared_chunks += len(chunks) - len(fresh)
+            # the doc's old vectors go once nothing references them
+            batch.put(path, info, chunk_rows(info, chunks, [known_ids[h] for h in hashes]), [eid for _, eid in old], chunks)
+        if batch.full:
+            flush()
+
+    def write_tracked(path, info, chunks, embeddings):
+        write(path, info, chunks, embeddings)
+        job.file_done(len(chunks or []))
+
+    def finish():
+        with span("persist"):
+            flush()
+        if rebuild:
+            return swap()
+        # on cancel this still publishes the docs written so far, keeping the
+        # index in step with the DB rows they already updated
+        generation = writer.commit()
+        mark_indexed(written)
+        os.remove(RUN_MARKER)
+        return generation
+
+    def swap():
+        if job is not None and job.stop.is_set():
+            # a cancelled rebuild is dropped; the live index and rows stay
+            drop_chunk_stage()
+            return index_manager.generation
+        # rows first, as in an incremental run: a crash before the index
+        # commit leaves RUN_MARKER for repair
+        os.makedirs(os.path.dirname(RUN_MARKER), exist_ok=True)
+        open(RUN_MARKER, "w").close()
+        swap_in_stage(written, to_delete_doc_paths)
+        generation = writer.commit()
+        mark_indexed(written)
+        os.remove(RUN_MARKER)
+        return generation
+
+    def abandon():
+        if rebuild:
+            drop_chunk_stage()
+            return
+        # the unflushed batch's vectors go; the flushed docs are published so
+        # the index stays in step with their rows
+        writer.remove(batch.added)
+        writer.commit()
+        mark_indexed(written)
+        os.remove(RUN_MARKER)
+
+    try:
+        if job is None:
+            await pipeline.run(candidates, docmap, write)
+        else:
+            job.begin(files_total=len(files), files_skipped=len(files) - len(candidates))
+            await pipeline.run(candidates, docmap, write_tracked, stop=job.stop, on_embedded=job.embedded)
+    except BaseException:
+        try:
+            await asyncio.to_thread(abandon)
+        except Exception as e:
+            # RUN_MARKER stays; the next run repairs the difference
+            print(f"[INDEX ERROR] Failed to publish {len(written)} documents written before the failure: {e}")
+        raise
+    generation = await asyncio.to_thread(finish)
+
+    elapsed = round(time.time() - started, 3)
+    return {
+        "ok": True,
+        "files_seen": len(files), 
+        "files_scanned": len(candidates),
+        "docs_deleted": len(to_delete_doc_paths),
+        "ids_removed": remove_ids_total,
+        "new_or_changed_docs": changed_docs,
+        "chunks_added": len(add_ids),
+        "chunks_shared": shared_chunks,
+        "index_dim": index_dim or ("unchanged" if writer.changed else None),
+        "index_factory": writer.factory or index_manager.factory,
+        "generation": generation,
+        "cancelled": bool(job and job.stop.is_set()),
+        "elapsed_s": elapsed
+    }
+
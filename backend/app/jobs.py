@@ -0,0 +1,174 @@
+from __future__ import annotations
+import os, asyncio, contextvars, threading, time, uuid
+from collections import OrderedDict
+from typing import Dict, List
+
+from . import ingest, profiling
+
+JOB_HISTORY = int(os.getenv("INDEX_JOB_HISTORY", "50"))
+
+class Job:
+    """
+    One indexing run. Counters are updated from the pipeline's writer thread
+    and read by the status endpoint; single int updates need no lock.
+    """
+
+    def __init__(self, kind: str, paths=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind  # incremental | reindex
+        self.paths = set(paths) if paths is not None else None  # None = whole upload dir
+        self.state = "queued"  # queued | running | done | failed | cancelled
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.requests = 1  # submissions coalesced into this job
+        self.files_total = 0
+        self.files_skipped = 0
+        self.files_done = 0
+        self.chunks_embedded = 0
+        self.chunks_written = 0
+        self.result: Dict | None = None
+        self.error: str | None = None
+        self.profile = False  # run under the profiler (see profiling.py)
+        self.profile_name: str | None = None
+        self.stop = threading.Event()
+        self.done = asyncio.Event()
+
+    def begin(self, files_total: int, files_skipped: int):
+        self.files_total = files_total
+        self.files_skipped = files_skipped
+        self.files_done = files_skipped
+
+    def file_done(self, chunks: int):
+        self.files_done += 1
+        self.chunks_written += chunks
+
+    def embedded(self, n: int):
+        self.chunks_embedded += n
+
+    @property
+    def finished_state(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    def to_dict(self) -> Dict:
+        now = self.finished or time.time()
+        elapsed = (now - self.started) if self.started else 0.0
+        processed = self.files_done - self.files_skipped
+        remaining = max(0, self.files_total - self.files_done)
+        files_per_s = processed / elapsed if elapsed > 0 else None
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "scope": "all" if self.paths is None else len(self.paths),
+            "state": self.state,
+            "requests": self.requests,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "elapsed_s": round(elapsed, 3),
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "files_skipped": self.files_skipped,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_written": self.chunks_written,
+            "files_per_s": round(files_per_s, 3) if files_per_s else None,
+            "chunks_per_s": round(self.chunks_embedded / elapsed, 3) if elapsed > 0 else None,
+            "eta_s": round(remaining / files_per_s, 1) if files_per_s and self.state == "running" else None,
+            "result": self.result,
+            "error": self.error,
+            "profile": self.profile_name,
+        }
+
+class JobManager:
+    """
+    Runs indexing jobs one at a time on the event loop. At most one job waits
+    behind the running one: later submissions are folded into it (a reindex
+    request upgrades a pending incremental), so bursts of requests become a
+    single follow-up run instead of parallel writers.
+    """
+
+    def __init__(self, history: int = JOB_HISTORY):
+        self.history = history
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.running: Job | None = None
+        self.pending: Job | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def busy(self) -> bool:
+        return self.running is not None or self.pending is not None
+
+    def submit(self, kind: str = "incremental", paths=None, profile: bool = False) -> tuple[Job, bool]:
+        """
+        Queue a run over `paths` (None = every upload); returns (job, coalesced).
+        """
+        if self.pending is not None:
+            pending = self.pending
+            pending.requests += 1
+            pending.profile = pending.profile or profile
+            if kind == "reindex":
+                pending.kind = "reindex"
+            if pending.kind == "reindex" or paths is None:
+                pending.paths = None
+            elif pending.paths is not None:
+                pending.paths.update(paths)
+            return pending, True
+
+        job = Job(kind, paths if kind == "incremental" else None)
+        job.profile = profile
+        self.pending = job
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            old_id, old = next(iter(self.jobs.items()))
+            if not old.finished_state:
+                break
+            self.jobs.pop(old_id)
+        if self._task is None or self._task.done():
+            # fresh context: jobs outlive the request that queued them, and
+            # must not add their stages to its trace
+            self._task = asyncio.create_task(self._worker(), context=contextvars.Context())
+        return job, False
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        return list(reversed(self.jobs.values()))
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self.jobs.get(job_id)
+        if job is None or job.finished_state:
+            return job
+        if job is self.pending:
+            self.pending = None
+            job.state = "cancelled"
+            job.finished = time.time()
+            job.done.set()
+        else:
+            # the run stops starting new documents and commits what it wrote
+            # (a reindex is dropped instead)
+            job.stop.set()
+        return job
+
+    async def _worker(self):
+        while self.pending is not None:
+            job, self.pending = self.pending, None
+            self.running = job
+            job.state = "running"
+            job.started = time.time()
+            session = profiling.start(f"{job.kind}-{job.id}") if job.profile else None
+            try:
+                job.result = await ingest.incremental(job, job.paths, rebuild=job.kind == "reindex")
+                job.state = "cancelled" if job.stop.is_set() else "done"
+            except Exception as e:
+                print(f"[INDEX JOB ERROR] {job.id}: {e}")
+                job.error = str(e)
+                job.state = "failed"
+            finally:
+                if session is not None:
+                    job.profile_name = session.stop()
+                job.finished = time.time()
+                self.running = None
+                job.done.set()
+
+index_jobs = JobManager()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+import re
+from typing import List, Tuple
+from sqlalchemy import func, literal_column, table, column
+
+from .db import SessionLocal, Document, Chunk
+from .utils.filters import apply_filters
+
+chunks_fts = table("chunks_fts", column("rowid"))
+_fts = literal_column("chunks_fts")
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+def fts_query(q: str) -> str | None:
+    """
+    Turn free text into an FTS5 MATCH expression: every token quoted (so
+    operators, dashes and colons in identifiers are taken literally), any
+    token may match, BM25 ranks the rest.
+    """
+    tokens = _TOKEN.findall(q or "")
+    if not tokens:
+        return None
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(tokens))
+
+def lexical_search(q: str, k: int = 5, file_type=None, tag=None, modified_after=None) -> List[Tuple[float, int]]:
+    """
+    Top-k chunks by BM25 as [(score, embedding_id)], best first.
+    Scores are negated bm25() values, so higher is better. A chunk text
+    shared by several documents counts once, at its best rank.
+    """
+    expr = fts_query(q)
+    if expr is None or k <= 0:
+        return []
+    db = SessionLocal()
+    try:
+        rank = func.bm25(_fts)
+        query = apply_filters(
+            db.query(Chunk.embedding_id, rank.label("rank"))
+            .select_from(chunks_fts)
+            .join(Chunk, Chunk.id == chunks_fts.c.rowid)
+            .join(Document, Chunk.document_id == Document.id)
+            .filter(_fts.op("MATCH")(expr), Chunk.embedding_id.isnot(None)),
+            file_type, tag, modified_after,
+        )
+        out = {}
+        for eid, r in query.order_by(rank).yield_per(max(k, 64)):
+            if eid not in out:
+                out[eid] = -float(r)
+                if len(out) >= k:
+                    break
+        return [(score, int(eid)) for eid, score in out.items()]
+    except Exception as e:
+        print(f"[FTS ERROR] {e}")
+        return []
+    finally:
+        db.close()
@@ -1,11 +1,17 @@
 from fastapi import FastAPI, Request
-from .routes import upload, indexing, search, qa, context
+from .routes import upload, indexing, search, qa, context, profiles
+from .routes.upload import UPLOAD_DIR
 from .ollama_ready import ensure_model_present, EMBEDDING_MODEL, GEN_MODEL
 from fastapi.middleware.cors import CORSMiddleware
-import logging, os, time
-from .metrics import incr, observe, render_prom
+import logging, os, re, time
+from .metrics import incr, observe, render_prom, register_collector, register_histogram, start_trace, RATE_BUCKETS
+from .ollama_client import ollama
+from .semantic_cache import qa_semantic_cache
+from .cache import cache_stats
+from .watcher import upload_watcher
 from fastapi.responses import PlainTextResponse
 from app.db import init_db, DB_PATH
+from . import pipeline, profiling
 
 
 app = FastAPI()
@@ -16,10 +22,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID", "X-Profile"],
 )
 
+register_collector(ollama.stats)
+register_collector(qa_semantic_cache.stats)
+register_collector(cache_stats)
+register_collector(upload_watcher.stats)
+register_histogram("qa_tokens_per_s", RATE_BUCKETS)
+
 @app.on_event("startup")
 async def _startup():
+    await ollama.start()
     await ensure_model_present()
     logging.getLogger("uvicorn").info("Ollama embedding model ensures : %s", EMBEDDING_MODEL)
     logging.getLogger("uvicorn").info("Ollama text generation model ensures : %s", GEN_MODEL)
@@ -32,16 +46,68 @@ async def verify_db():
     else:
         logging.getLogger("uvicorn").warning(f"DB file does not exist at {DB_PATH}")
     
+@app.on_event("startup")
+async def _start_watcher():
+    upload_watcher.start()
+    if upload_watcher.enabled:
+        logging.getLogger("uvicorn").info("Watching %s for changes (%s)", UPLOAD_DIR, upload_watcher.backend)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await upload_watcher.stop()
+    pipeline.shutdown()
+    await ollama.close()
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+def _observe_stream(request: Request, resp):
+    """
+    Streamed responses return before the body is sent; record total
+    latency, time to first token and decode rate once it has been drained.
+    """
+    body = resp.body_iterator
+
+    async def wrapped():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            stats = getattr(request.state, "qa_stream", None)
+            if stats:
+                done = time.perf_counter()
+                incr("qa_stream_requests_total")
+                observe("qa_stream_latency_ms", (done - stats["started"]) * 1000.0)
+                first = stats.get("first_token")
+                if first is not None:
+                    observe("qa_ttft_ms", (first - stats["started"]) * 1000.0)
+                    rate = stats.get("tokens_per_s")
+                    if rate is None and stats["tokens"] > 1 and done > first:
+                        rate = (stats["tokens"] - 1) / (done - first)
+                    if rate is not None:
+                        observe("qa_tokens_per_s", rate)
+
+    resp.body_iterator = wrapped()
+    return resp
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
 @app.middleware("http")
 async def metrics_mw(request: Request, call_next):
     t0 = time.perf_counter()
+    # stages (see metrics.span) add themselves to this request's trace
+    rid = request.headers.get("x-request-id", "")
+    trace = start_trace(rid if _REQUEST_ID_RE.match(rid) else None)
     resp = await call_next(request)
     ms = (time.perf_counter() - t0) * 1000.0
+    resp.headers["X-Request-ID"] = trace.request_id
     path = request.url.path or ""
+    if path.startswith("/qa/stream"):
+        # headers go out before the stream runs its stages; those are
+        # only in the stage histograms
+        return _observe_stream(request, resp)
+    resp.headers["Server-Timing"] = trace.server_timing()
     if path.startswith("/search"):
         observe("search_latency_ms", ms); incr("search_requests_total")
     elif path.startswith("/qa"):
@@ -50,6 +116,43 @@ async def metrics_mw(request: Request, call_next):
         observe("index_latency_ms", ms); incr("index_requests_total")
     return resp
 
+if profiling.PROFILING_ENABLED:
+    # only installed when enabled, so requests pay nothing otherwise
+    @app.middleware("http")
+    async def profiling_mw(request: Request, call_next):
+        path = request.url.path or ""
+        if not path.startswith(profiling.PROFILED_PREFIXES) or not profiling.wanted(request):
+            return await call_next(request)
+        if path.startswith("/index"):
+            # the work runs in a background job; the job profiles itself
+            profiling.request_profile()
+            return await call_next(request)
+        session = profiling.start(f"{request.method}-{path.strip('/')}")
+        if session is None:
+            resp = await call_next(request)
+            resp.headers["X-Profile"] = "busy"
+            return resp
+        try:
+            resp = await call_next(request)
+        except BaseException:
+            session.stop()
+            raise
+        body = resp.body_iterator
+
+        async def wrapped():
+            # stop once the body is sent, so streamed answers are covered
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                session.stop()
+
+        resp.body_iterator = wrapped()
+        resp.headers["X-Profile"] = session.name
+        return resp
+
+    app.include_router(profiles.router, prefix="/profiles")
+
 @app.get("/metrics")    
 async def metrics():
     return PlainTextResponse(render_prom(), media_type="text/plain")
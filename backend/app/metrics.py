@@ -1,52 +1,172 @@
 # backend/app/metrics.py
 from __future__ import annotations
-import threading, bisect
-from collections import defaultdict, deque
-from typing import Deque, Dict, List
+import os, threading, bisect, time, uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Sequence, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _buckets(env: str, default: str) -> Tuple[float, ...]:
+    return tuple(sorted(float(b) for b in os.getenv(env, default).split(",") if b.strip()))
+
+# upper bounds in ms; fixed so histograms from several workers can be summed
+LATENCY_BUCKETS_MS = _buckets(
+    "METRICS_LATENCY_BUCKETS_MS",
+    "1,2.5,5,10,25,50,100,250,500,1000,2500,5000,10000,30000,60000",
+)
+RATE_BUCKETS = _buckets("METRICS_RATE_BUCKETS", "1,2,5,10,20,30,50,75,100,150,200,500")
 
 _lock = threading.Lock()
-counters: Dict[str, int] = defaultdict(int)
-timers: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=1000))  # store last 1000 ms samples per metric
+counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+histograms: Dict[str, "Histogram"] = {}
+collectors: List[Callable[[], Dict[str, float]]] = []  # called on scrape, return {name or name{labels}: value}
+
+class Histogram:
+    """
+    Prometheus histogram: per label set, a count per bucket plus sum and
+    count. Buckets are stored non-cumulative and summed on render.
+    """
+
+    def __init__(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.series: Dict[Labels, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, labels: Labels = ()):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def render(self, lines: List[str]):
+        lines.append(f"# TYPE {self.name} histogram")
+        for labels, s in self.series.items():
+            cum = 0
+            for le, n in zip(self.buckets, s):
+                cum += n
+                lines.append(f"{self.name}_bucket{_fmt(labels + (('le', _num(le)),))} {cum}")
+            cum += s[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_fmt(labels + (('le', '+Inf'),))} {cum}")
+            lines.append(f"{self.name}_sum{_fmt(labels)} {s[-1]:.3f}")
+            lines.append(f"{self.name}_count{_fmt(labels)} {cum}")
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in labels) + "}"
+
+def _labels(kw: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in kw.items() if v is not None))
+
+def register_histogram(name: str, buckets: Sequence[float]) -> Histogram:
+    """Declare a histogram with its own buckets (default: LATENCY_BUCKETS_MS)."""
+    with _lock:
+        h = histograms.get(name)
+        if h is None:
+            h = histograms[name] = Histogram(name, buckets)
+        return h
 
-def incr(name: str, n: int = 1) -> None:
+def incr(name: str, n: int = 1, **labels) -> None:
     with _lock:
-        counters[name] += n
+        counters[name][_labels(labels)] += n
 
-def observe(name: str, ms: float) -> None:
+def observe(name: str, ms: float, **labels) -> None:
     # guard against bogus/negative durations
     if ms is None or ms != ms or ms < 0:
         return
     with _lock:
-        timers[name].append(ms)
+        h = histograms.get(name)
+        if h is None:
+            h = histograms[name] = Histogram(name)
+        h.observe(ms, _labels(labels))
+
+def register_collector(fn: Callable[[], Dict[str, float]]) -> None:
+    collectors.append(fn)
+
+# ---- request tracing ----
+
+class Trace:
+    """
+    Stage timings for one request, in the order they finished.
+    """
+    __slots__ = ("request_id", "started", "spans")
+
+    def __init__(self, request_id: str | None = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: per-stage totals, then the whole request."""
+        totals: Dict[str, float] = {}
+        for stage, ms in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + ms
+        parts = [f"{stage};dur={ms:.1f}" for stage, ms in totals.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000.0:.1f}")
+        return ", ".join(parts)
 
-def _percentile(data: List[float], p: float) -> float | None:
-    """Nearest-rank percentile (p in [0,1])."""
-    if not data:
-        return None
-    data = sorted(data)
-    # nearest-rank index (1-based), clamp to bounds
-    rank = max(1, min(len(data), int(round(p * len(data)))))
-    return data[rank - 1]
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+def start_trace(request_id: str | None = None) -> Trace:
+    t = Trace(request_id)
+    _trace.set(t)
+    return t
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+def record_stage(stage: str, ms: float) -> None:
+    """
+    Record a stage duration in stage_latency_ms and on the current request's trace.
+    """
+    observe("stage_latency_ms", ms, stage=stage)
+    t = _trace.get()
+    if t is not None:
+        t.spans.append((stage, ms))
+
+@contextmanager
+def span(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, (time.perf_counter() - t0) * 1000.0)
 
 def render_prom() -> str:
     lines: List[str] = []
     with _lock:
         # Counters
-        for k, v in counters.items():
-            lines.append(f"# TYPE {k} counter")
-            lines.append(f"{k} {int(v)}")
-
-        # Timers -> percentiles
-        for k, dq in timers.items():
-            arr = list(dq)
-            p50 = _percentile(arr, 0.50)
-            p95 = _percentile(arr, 0.95)
-            p99 = _percentile(arr, 0.99)
-            for suffix, val in (("p50", p50), ("p95", p95), ("p99", p99)):
-                name = f"{k}_{suffix}"
-                lines.append(f"# TYPE {name} gauge")
-                if val is None:
-                    lines.append(f"{name} 0")
-                else:
-                    lines.append(f"{name} {val:.3f}")
+        for name, series in counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, v in series.items():
+                lines.append(f"{name}{_fmt(labels)} {int(v)}")
+
+        # Histograms (cumulative buckets, aggregatable across workers)
+        for h in histograms.values():
+            h.render(lines)
+
+    # Collector values (outside the lock; they read their own state): *_total
+    # are monotonic counters, everything else a gauge. Samples of one metric
+    # must be contiguous, so group by base name.
+    families: Dict[str, List[str]] = defaultdict(list)
+    for fn in collectors:
+        try:
+            values = fn()
+        except Exception as e:
+            print(f"[METRICS ERROR] collector failed: {e}")
+            continue
+        for k, v in values.items():
+            families[k.split("{", 1)[0]].append(f"{k} {v}")
+    for base, samples in families.items():
+        lines.append(f"# TYPE {base} {'counter' if base.endswith('_total') else 'gauge'}")
+        lines.extend(samples)
     return "\n".join(lines) + "\n"
@@ -0,0 +1,101 @@
+from __future__ import annotations
+import os, json, fcntl, threading
+import numpy as np
+from typing import Sequence
+
+class MmapMatrix:
+    """
+    float32 matrix in a flat file, appended to or written by row and read
+    back through np.memmap.
+    The column count is kept in a small JSON sidecar next to the data file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._meta_path = path + ".json"
+        self._lock = threading.Lock()
+        self._mm: np.memmap | None = None
+        self.dim: int | None = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as f:
+                self.dim = int(json.load(f)["dim"])
+
+    def _init_dim(self, dim: int):
+        if self.dim is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.dim = int(dim)
+            with open(self._meta_path, "w") as f:
+                json.dump({"dim": self.dim}, f)
+        if dim != self.dim:
+            raise ValueError(f"{self.path} holds dim {self.dim}, got {dim}")
+
+    @property
+    def rows(self) -> int:
+        if not self.dim or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (self.dim * 4)
+
+    def append(self, arr: np.ndarray) -> int:
+        """
+        Append rows and return the row number of the first one.
+        """
+        arr = np.ascontiguousarray(arr, dtype="float32")
+        with self._lock:
+            self._init_dim(arr.shape[1])
+            with open(self.path, "ab") as f:
+                # other workers may append to the same file
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0, os.SEEK_END)
+                    start = f.tell() // (self.dim * 4)
+                    f.write(arr.tobytes())
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            return start
+
+    def write_rows(self, rows: Sequence[int], arr: np.ndarray):
+        """
+        Write arr[i] at row rows[i], growing the file as needed. Rows that
+        were never written read back as zeros.
+        """
+        arr = np.ascontiguousarray(arr, dtype="float32")
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0:
+            return
+        with self._lock:
+            self._init_dim(arr.shape[1])
+            mode = "r+b" if os.path.exists(self.path) else "wb"
+            with open(self.path, mode) as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    # one write per run of consecutive rows
+                    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+                    for idx in np.split(np.arange(rows.size), breaks):
+                        f.seek(int(rows[idx[0]]) * self.dim * 4)
+                        f.write(arr[idx[0]:idx[-1] + 1].tobytes())
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self, rows: Sequence[int]) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0 or not self.dim:
+            return np.zeros((0, self.dim or 0), dtype="float32")
+        with self._lock:
+            need = int(rows.max()) + 1
+            if self._mm is None or self._mm.shape[0] < need:
+                n = self.rows
+                if n < need:
+                    raise IndexError(f"row {need - 1} beyond end of {self.path} ({n} rows)")
+                self._mm = np.memmap(self.path, dtype="float32", mode="r", shape=(n, self.dim))
+            mm = self._mm
+        return np.array(mm[rows])
+
+    def reset(self):
+        with self._lock:
+            self._mm = None
+            self.dim = None
+            for p in (self.path, self._meta_path):
+                if os.path.exists(p):
+                    os.remove(p)
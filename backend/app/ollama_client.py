@@ -0,0 +1,116 @@
+from __future__ import annotations
+import os, asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict
+import httpx
+
+MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "30"))
+
+# per traffic class: (max concurrent requests or None, timeout seconds or None)
+LIMITS = {
+    "embed": (int(os.getenv("OLLAMA_EMBED_CONCURRENCY", "8")), float(os.getenv("OLLAMA_EMBED_TIMEOUT", "60"))),
+    "generate": (int(os.getenv("OLLAMA_GENERATE_CONCURRENCY", "2")), float(os.getenv("OLLAMA_GENERATE_TIMEOUT", "300"))),
+    "admin": (None, float(os.getenv("OLLAMA_ADMIN_TIMEOUT", "30"))),
+}
+
+class OllamaClient:
+    """
+    One pooled keep-alive httpx client shared by the whole app.
+    Embedding and generation traffic get separate semaphores so a burst of
+    indexing embeds cannot starve /qa generation (and vice versa).
+    """
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+        self._sems: Dict[str, asyncio.Semaphore | None] = {}
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.waiting = defaultdict(int)
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        self._sems = {
+            kind: asyncio.Semaphore(n) if n else None for kind, (n, _) in LIMITS.items()
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @asynccontextmanager
+    async def _slot(self, kind: str):
+        if self._client is None:
+            await self.start()
+        sem = self._sems.get(kind)
+        self.waiting[kind] += 1
+        try:
+            if sem is not None:
+                await sem.acquire()
+        finally:
+            self.waiting[kind] -= 1
+        self.requests[kind] += 1
+        self.in_flight[kind] += 1
+        try:
+            yield self._client
+        except Exception:
+            self.errors[kind] += 1
+            raise
+        finally:
+            self.in_flight[kind] -= 1
+            if sem is not None:
+                sem.release()
+
+    def _timeout(self, kind: str, kw: dict):
+        if "timeout" not in kw:
+            kw["timeout"] = LIMITS.get(kind, (None, None))[1]
+        return kw
+
+    async def request(self, kind: str, method: str, url: str, **kw) -> httpx.Response:
+        async with self._slot(kind) as client:
+            r = await client.request(method, url, **self._timeout(kind, kw))
+        if r.status_code >= 400:
+            self.errors[kind] += 1
+        return r
+
+    async def get(self, kind: str, url: str, **kw) -> httpx.Response:
+        return await self.request(kind, "GET", url, **kw)
+
+    async def post(self, kind: str, url: str, **kw) -> httpx.Response:
+        return await self.request(kind, "POST", url, **kw)
+
+    @asynccontextmanager
+    async def stream(self, kind: str, method: str, url: str, **kw):
+        async with self._slot(kind) as client:
+            async with client.stream(method, url, **self._timeout(kind, kw)) as r:
+                yield r
+
+    def stats(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for kind in LIMITS:
+            out[f'ollama_requests_total{{kind="{kind}"}}'] = self.requests[kind]
+            out[f'ollama_errors_total{{kind="{kind}"}}'] = self.errors[kind]
+            out[f'ollama_in_flight{{kind="{kind}"}}'] = self.in_flight[kind]
+            out[f'ollama_waiting{{kind="{kind}"}}'] = self.waiting[kind]
+        # connection counts live on httpcore's pool; not public API, so best effort
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        conns = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for c in conns if getattr(c, "is_idle", lambda: False)())
+        out["ollama_pool_connections"] = len(conns)
+        out["ollama_pool_idle_connections"] = idle
+        out["ollama_pool_max_connections"] = MAX_CONNECTIONS
+        return out
+
+ollama = OllamaClient()
@@ -0,0 +1,208 @@
+from __future__ import annotations
+import os, asyncio, hashlib, multiprocessing, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from .extract import iter_text, set_page_workers
+from .chunking import PIECE_SEP, SpanChunker, chunk_spans, chunk_tails, join_tails
+from .embeddings import embed_batch
+from .indexer import sha256_text, sha256_bytes, sha256_file, file_stat
+from .metrics import record_stage, span
+
+EXTRACT_WORKERS = int(os.getenv("INDEX_EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+EMBED_CONCURRENCY = int(os.getenv("INDEX_EMBED_CONCURRENCY", "4"))
+EMBED_BATCH = int(os.getenv("INDEX_EMBED_BATCH", "64"))
+DOCS_IN_FLIGHT = int(os.getenv("INDEX_DOCS_IN_FLIGHT", str(EXTRACT_WORKERS * 2)))
+WRITE_QUEUE = int(os.getenv("INDEX_WRITE_QUEUE", "8"))
+
+_pool: ProcessPoolExecutor | None = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the server process already runs faiss/OpenMP threads
+        _pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def page_budget(n_docs: int) -> int:
+    """
+    PDF page workers each extract worker may start when a run has n_docs
+    documents: its share of the CPUs beyond itself. A run with a document
+    per worker or more leaves none; a single big PDF gets all of them.
+    """
+    busy = max(1, min(EXTRACT_WORKERS, n_docs))
+    return max(0, (os.cpu_count() or 1) // busy - 1)
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+def prepare_document(path: str, known: Dict | None = None, page_workers: int | None = None):
+    """
+    Hash + extract + chunk stage, runs in a worker process.
+    Returns (path, info, tails) where info carries doc_hash, raw_hash, size,
+    mtime, each chunk's (start, end) span in the normalized text and each
+    chunk's text hash, plus per-stage timings in ms. tails are the chunk
+    texts without their overlap (see chunking.join_tails), None when the
+    doc is unchanged; text is only extracted when the raw bytes differ from
+    `known["raw_hash"]`. PDFs are chunked page by page as they are
+    extracted (see extract.iter_pdf_pages), and only the text a pending
+    chunk can still reach is held, so the full text is never built here.
+    `page_workers` sets this worker's PDF page budget (see page_budget).
+    """
+    known = known or {}
+    if page_workers is not None:
+        set_page_workers(page_workers)
+    t0 = time.perf_counter()
+    # stat before reading, so a write racing with us shows up next run
+    info = file_stat(path)
+    info["raw_hash"] = sha256_file(path)
+    t1 = time.perf_counter()
+    timings = info["timings"] = {"hash": (t1 - t0) * 1000.0}
+    if known.get("doc_hash") and info["raw_hash"] == known.get("raw_hash"):
+        info["doc_hash"] = known["doc_hash"]
+        return path, info, None
+
+    # pages stream from extraction into the chunker; the hash matches
+    # sha256_text of the pieces joined with blank lines
+    h = hashlib.sha256()
+    def hashed(pieces):
+        for i, piece in enumerate(pieces):
+            h.update(((PIECE_SEP if i else "") + piece).encode("utf-8", "ignore"))
+            yield piece
+
+    spans, hashes, tails = [], [], []
+    def take(new, texts):
+        tails.extend(chunk_tails(new, texts, spans[-1][1] if spans else None))
+        spans.extend(new)
+        hashes.extend(sha256_text(c) for c in texts)
+
+    chunk_s = 0.0
+    try:
+        chunker = SpanChunker(target_tokens=350, overlap_tokens=50)
+        for piece in hashed(iter_text(path)):
+            c0 = time.perf_counter()
+            new = chunker.feed(piece)
+            take(new, chunker.chunks(new))
+            chunker.release()
+            chunk_s += time.perf_counter() - c0
+        c0 = time.perf_counter()
+        new = chunker.close()
+        take(new, chunker.chunks(new))
+        chunk_s += time.perf_counter() - c0
+        info["doc_hash"] = h.hexdigest()
+    except Exception:
+        spans, hashes, tails = [], [], []
+        with open(path, "rb") as f:
+            raw = f.read()
+        info["doc_hash"] = sha256_bytes(raw)
+        c0 = time.perf_counter()
+        text, new = chunk_spans(raw.decode("utf-8", errors="ignore"), target_tokens=350, overlap_tokens=50)
+        take(new, [text[s:e] for s, e in new])
+        chunk_s += time.perf_counter() - c0
+    # extraction and chunking interleave; extract is the rest of the wall time
+    timings["extract"] = ((time.perf_counter() - t1) - chunk_s) * 1000.0
+    timings["chunk"] = chunk_s * 1000.0
+
+    if info["doc_hash"] == known.get("doc_hash"):
+        return path, info, None
+    info["spans"] = spans
+    info["chunk_hashes"] = hashes
+    return path, info, tails
+
+def _first_error(e: BaseException):
+    while isinstance(e, BaseExceptionGroup):
+        e = e.exceptions[0]
+    return e
+
+async def run(
+    paths: Iterable[str],
+    known: Dict[str, Dict],
+    write: Callable[[str, Dict, List[str] | None, List[List[float]]], None],
+    stop: threading.Event | None = None,
+    on_embedded: Callable[[int], None] | None = None,
+):
+    """
+    Staged ingestion:
+      1) extract + chunk in a process pool
+      2) embed batches concurrently, at most EMBED_CONCURRENCY requests in flight
+      3) a single writer applies FAISS adds and DB writes in arrival order
+
+    `write(path, info, chunks, vectors)` is called once per path, from one
+    thread at a time. chunks is None for docs whose content did not change,
+    so the writer only refreshes their stat/hash bookkeeping.
+
+    Once `stop` is set no new document is started and queued ones are not
+    written; the run returns after in-flight work drains. `on_embedded(n)`
+    is called as chunk batches come back from the embedder.
+    """
+    stopped = stop.is_set if stop is not None else (lambda: False)
+    loop = asyncio.get_running_loop()
+    paths = list(paths)
+    pool = _get_pool()
+    page_workers = page_budget(len(paths))
+    embed_sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    docs_sem = asyncio.Semaphore(DOCS_IN_FLIGHT)
+    queue: asyncio.Queue[Tuple | None] = asyncio.Queue(maxsize=WRITE_QUEUE)
+
+    async def embed(batch):
+        async with embed_sem:
+            with span("index_embed"):
+                vecs = await embed_batch(batch)
+        if on_embedded is not None:
+            on_embedded(len(batch))
+        return vecs
+
+    async def process(path):
+        async with docs_sem:
+            if stopped():
+                return
+            path, info, tails = await loop.run_in_executor(
+                pool, prepare_document, path, known.get(path), page_workers
+            )
+            for stage, ms in info.pop("timings", {}).items():
+                record_stage(stage, ms)
+            if tails is None:
+                await queue.put((path, info, None, []))
+                return
+            chunks = join_tails(info["spans"], tails)
+            parts = await asyncio.gather(*(
+                embed(chunks[i:i+EMBED_BATCH]) for i in range(0, len(chunks), EMBED_BATCH)
+            ))
+            vecs = [v for part in parts for v in part]
+            await queue.put((path, info, chunks, vecs))
+
+    async def produce():
+        async with asyncio.TaskGroup() as tg:
+            for p in paths:
+                tg.create_task(process(p))
+        await queue.put(None)
+
+    async def writer():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if stopped():
+                continue
+            with span("persist"):
+                # a write that started is finished even when the run is torn
+                # down: callers rely on none still running once run() returns
+                task = asyncio.ensure_future(asyncio.to_thread(write, *item))
+                try:
+                    await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    await task
+                    raise
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            tg.create_task(writer())
+    except BaseExceptionGroup as eg:
+        raise _first_error(eg)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import os, re, time, threading, uuid
+from contextvars import ContextVar
+from typing import Dict, List
+
+from .db import DB_DIR
+
+# off unless configured; when off, no middleware or routes are installed
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes", "on")
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")  # if set, required to profile or read profiles
+PROFILER = os.getenv("PROFILER", "auto").lower()  # auto | pyinstrument | cprofile
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.001"))  # pyinstrument sample interval (s)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))  # newest files kept
+PROFILE_DIR = os.path.join(DB_DIR, "profiles")
+PROFILED_PREFIXES = ("/qa", "/search", "/index")
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9._-]+\.(html|prof)$")
+_LABEL_RE = re.compile(r"[^A-Za-z0-9_-]+")
+
+_lock = threading.Lock()
+_active = False  # one profiler at a time: both backends hook the thread's profile function
+
+# set for the request that asked for profiling; index routes hand it to their job
+_requested: ContextVar[bool] = ContextVar("profile_requested", default=False)
+
+def _backend() -> str:
+    if PROFILER in ("auto", "pyinstrument"):
+        try:
+            import pyinstrument  # optional dependency
+            return "pyinstrument"
+        except ImportError:
+            if PROFILER == "pyinstrument":
+                print("[PROFILE] pyinstrument not installed, using cProfile")
+    return "cprofile"
+
+def wanted(request) -> bool:
+    """
+    True if this request asks to be profiled (X-Profile header or ?profile=1)
+    and is allowed to.
+    """
+    flag = request.headers.get("x-profile") or request.query_params.get("profile")
+    if not flag or flag.lower() in ("0", "false", "no", "off"):
+        return False
+    return authorized(request)
+
+def authorized(request) -> bool:
+    if not PROFILING_TOKEN:
+        return True
+    token = request.headers.get("x-profile-token") or request.query_params.get("profile_token")
+    return token == PROFILING_TOKEN
+
+def request_profile():
+    _requested.set(True)
+
+def requested() -> bool:
+    return _requested.get()
+
+class Session:
+    """
+    One running profile. pyinstrument samples the event loop thread and, in
+    async mode, attributes time to the awaiting task only; cProfile traces
+    every call on the thread, other requests included. Work in the DB pool,
+    writer thread or extract processes is not seen by either.
+    """
+
+    def __init__(self, label: str):
+        label = _LABEL_RE.sub("_", label).strip("_")[:60] or "request"
+        self.backend = _backend()
+        self.started = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        ext = "html" if self.backend == "pyinstrument" else "prof"
+        # known up front so it can go in the response headers
+        self.name = f"{stamp}-{label}-{uuid.uuid4().hex[:6]}.{ext}"
+        if self.backend == "pyinstrument":
+            from pyinstrument import Profiler
+            self._p = Profiler(interval=PROFILING_INTERVAL, async_mode="enabled")
+            self._p.start()
+        else:
+            import cProfile
+            self._p = cProfile.Profile()
+            self._p.enable()
+
+    def stop(self) -> str | None:
+        """
+        Stop, write the profile under PROFILE_DIR and return its file name
+        (None if it could not be written; the request is not failed for it).
+        """
+        global _active
+        try:
+            if self.backend == "pyinstrument":
+                self._p.stop()
+            else:
+                self._p.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, self.name)
+            if self.backend == "pyinstrument":
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(self._p.output_html())
+            else:
+                self._p.dump_stats(path)
+            _prune()
+            return self.name
+        except Exception as e:
+            print(f"[PROFILE ERROR] {self.name}: {e}")
+            return None
+        finally:
+            with _lock:
+                _active = False
+
+def start(label: str) -> Session | None:
+    """A running Session, or None if another profile is in progress."""
+    global _active
+    with _lock:
+        if _active:
+            return None
+        _active = True
+    try:
+        return Session(label)
+    except Exception:
+        with _lock:
+            _active = False
+        raise
+
+def _prune():
+    files = list_profiles()
+    for p in files[PROFILE_KEEP:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, p["name"]))
+        except OSError:
+            pass
+
+def list_profiles() -> List[Dict]:
+    """Stored profiles, newest first."""
+    out = []
+    try:
+        with os.scandir(PROFILE_DIR) as it:
+            for e in it:
+                if e.is_file() and _NAME_RE.match(e.name):
+                    st = e.stat()
+                    out.append({"name": e.name, "size": st.st_size, "created": st.st_mtime})
+    except FileNotFoundError:
+        return []
+    out.sort(key=lambda p: -p["created"])
+    return out
+
+def profile_path(name: str) -> str | None:
+    if not _NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
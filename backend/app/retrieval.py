@@ -0,0 +1,167 @@
+from __future__ import annotations
+import os, asyncio
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+
+from .embeddings import embed_batch
+from .indexer import index_manager, l2_normalize, search as faiss_search, search_many
+from .utils.filters import allowed_ids_async
+from .db import get_chunks_by_ids_async, run_db
+from .lexical import lexical_search
+from .metrics import span
+
+RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_DEPTH = int(os.getenv("HYBRID_DEPTH", "4"))
+MAX_K = int(os.getenv("SEARCH_MAX_K", "100"))  # results per query a request may ask for
+
+async def embed_query(q: str) -> np.ndarray:
+    with span("query_embed"):
+        vec = await embed_batch([q], persist=False)
+    return l2_normalize(np.array(vec, dtype="float32"))[0]
+
+async def embed_queries(qs: Sequence[str]) -> np.ndarray:
+    if not qs:
+        return np.zeros((0, 0), dtype="float32")
+    with span("query_embed"):
+        vecs = await embed_batch(list(qs), persist=False)
+    return l2_normalize(np.array(vecs, dtype="float32"))
+
+def _with_scores(hits: Tuple[List[float], List[int]], rows: Dict[int, dict]) -> List[dict]:
+    out = []
+    for score, eid in zip(*hits):
+        row = rows.get(int(eid))
+        if row is not None:
+            out.append({**row, "score": float(score), "id": int(eid)})
+    return out
+
+async def vector_hits(qv: np.ndarray, k: int = 5, file_type=None, tag=None, modified_after=None,
+                nprobe=None, ef_search=None) -> Tuple[int, Tuple[List[float], List[int]]]:
+    """
+    Top-k (scores, embedding ids) for a query vector, as (generation, hits).
+    Filters are resolved to an id set and applied inside FAISS, so a filtered
+    query still returns k hits when k matching chunks exist.
+    """
+    index, generation = index_manager.snapshot()
+    if index is None:
+        return generation, ([], [])
+    with span("filter"):
+        allowed = await allowed_ids_async(file_type, tag, modified_after, generation)
+    sel = None
+    if allowed is not None:
+        if allowed[0].size == 0:
+            return generation, ([], [])
+        sel = allowed[1]
+    with span("faiss_search"):
+        return generation, faiss_search(index, qv, top_k=k, nprobe=nprobe, ef_search=ef_search, sel=sel)
+
+async def load_hits(hits: Tuple[List[float], List[int]], file_type=None, tag=None,
+                    modified_after=None) -> List[dict]:
+    """
+    Chunk rows for hits, described by documents that pass the filters.
+    """
+    with span("db_fetch"):
+        rows = {
+            int(c["embedding_id"]): c
+            for c in await get_chunks_by_ids_async(list(hits[1]), file_type, tag, modified_after)
+        }
+    return _with_scores(hits, rows)
+
+async def vector_search(qv: np.ndarray, k: int = 5, file_type=None, tag=None, modified_after=None,
+                  nprobe=None, ef_search=None) -> Tuple[int, List[dict]]:
+    """
+    Top-k chunks for a query vector, best first, as (generation, chunks).
+    """
+    generation, hits = await vector_hits(qv, k, file_type, tag, modified_after, nprobe, ef_search)
+    return generation, await load_hits(hits, file_type, tag, modified_after)
+
+def rrf(rankings: Sequence[List[int]], k: int = RRF_K) -> Tuple[List[float], List[int]]:
+    """
+    Reciprocal-rank fusion of id lists (each best first): sum of 1/(k + rank).
+    """
+    fused: Dict[int, float] = {}
+    for ids in rankings:
+        for rank, eid in enumerate(ids, start=1):
+            fused[eid] = fused.get(eid, 0.0) + 1.0 / (k + rank)
+    order = sorted(fused.items(), key=lambda x: -x[1])
+    return [s for _, s in order], [eid for eid, _ in order]
+
+async def _bm25(q, k, **filters):
+    with span("bm25"):
+        return await run_db(lexical_search, q, k, **filters)
+
+async def retrieve(q: str, k: int = 5, mode: str = "vector", file_type=None, tag=None,
+                   modified_after=None, nprobe=None, ef_search=None, qv=None) -> Tuple[int, List[dict]]:
+    """
+    Top-k chunks for a query string, as (generation, chunks). `qv` is the
+    normalized query embedding if the caller already has it.
+      vector  - embedding similarity (FAISS)
+      lexical - BM25 over chunk text (FTS5); no embedding call
+      hybrid  - both lists, HYBRID_DEPTH * k deep, merged by reciprocal-rank fusion
+    """
+    filters = dict(file_type=file_type, tag=tag, modified_after=modified_after)
+    if mode == "vector":
+        qv = await embed_query(q) if qv is None else qv
+        return await vector_search(qv, k, nprobe=nprobe, ef_search=ef_search, **filters)
+
+    if mode == "lexical":
+        lex = await _bm25(q, k, **filters)
+        generation = index_manager.snapshot()[1]
+        return generation, await load_hits(([s for s, _ in lex], [i for _, i in lex]), **filters)
+
+    depth = k * HYBRID_DEPTH
+    qv = await embed_query(q) if qv is None else qv
+    (generation, (_, vec_ids)), lex = await asyncio.gather(
+        vector_hits(qv, depth, nprobe=nprobe, ef_search=ef_search, **filters),
+        _bm25(q, depth, **filters),
+    )
+    scores, ids = rrf([vec_ids, [i for _, i in lex]])
+    return generation, await load_hits((scores[:k], ids[:k]), **filters)
+
+async def batch_vector_search(qvs: np.ndarray, specs: Sequence[dict]) -> Tuple[int, List[List[dict]]]:
+    """
+    Top-k chunks for many query vectors at once, as (generation, [chunks per query]).
+    Each spec carries k and optional file_type/tag/modified_after/nprobe/ef_search.
+    Queries sharing filters and search params go through one matrix search
+    (at the group's largest k); chunk rows are loaded in one query per filter set.
+    """
+    index, generation = index_manager.snapshot()
+    if index is None or not len(specs):
+        return generation, [[] for _ in specs]
+
+    groups: Dict[tuple, List[int]] = {}
+    for qi, spec in enumerate(specs):
+        key = (spec.get("file_type"), spec.get("tag"), spec.get("modified_after"),
+               spec.get("nprobe"), spec.get("ef_search"))
+        groups.setdefault(key, []).append(qi)
+
+    hits: List[Tuple[List[float], List[int]]] = [([], [])] * len(specs)
+    for (file_type, tag, modified_after, nprobe, ef_search), rows in groups.items():
+        with span("filter"):
+            allowed = await allowed_ids_async(file_type, tag, modified_after, generation)
+        sel = None
+        if allowed is not None:
+            if allowed[0].size == 0:
+                continue
+            sel = allowed[1]
+        k = max(int(specs[qi].get("k", 5)) for qi in rows)
+        with span("faiss_search"):
+            res = search_many(index, qvs[rows], top_k=k, nprobe=nprobe, ef_search=ef_search, sel=sel)
+        for qi, (scores, ids) in zip(rows, res):
+            kq = int(specs[qi].get("k", 5))
+            hits[qi] = (scores[:kq], ids[:kq])
+
+    # a shared chunk is described by a document that passes the query's filters
+    by_filter: Dict[tuple, set] = {}
+    for spec, (_, ids) in zip(specs, hits):
+        key = (spec.get("file_type"), spec.get("tag"), spec.get("modified_after"))
+        by_filter.setdefault(key, set()).update(ids)
+    rows_by_filter = {}
+    with span("db_fetch"):
+        for key, ids in by_filter.items():
+            rows_by_filter[key] = {
+                int(c["embedding_id"]): c for c in await get_chunks_by_ids_async(sorted(ids), *key)
+            }
+    return generation, [
+        _with_scores(h, rows_by_filter[(s.get("file_type"), s.get("tag"), s.get("modified_after"))])
+        for s, h in zip(specs, hits)
+    ]
@@ -1,47 +1,137 @@
+import os
+from typing import List
 from fastapi import APIRouter, Query, HTTPException
-from ..db import SessionLocal, Document, Chunk
+from pydantic import BaseModel, Field
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import aliased
+from ..db import SessionLocal, Document, Chunk, TEXT_COLUMNS, PREFIX_ROWS, chunk_texts, run_db
+from ..metrics import span
 
 
 router = APIRouter()
 
+MAX_BATCH = int(os.getenv("CONTEXT_MAX_BATCH", "100"))
+
+class ContextItem(BaseModel):
+    id: int
+    doc_path: str | None = None
+
+class ContextBatch(BaseModel):
+    items: List[ContextItem]
+    radius: int = Field(1, ge=0, le=3)
+
+def _windows(db, items, radius):
+    """
+    (centers, windows) for (embedding id, doc_path) pairs, in one query:
+    each center chunk is joined to the rows around it over the
+    (document_id, position) index. centers follow `items` as
+    (document_id, position, path), or None when not found; windows maps
+    (document_id, position) to the window's chunks. A chunk shared by
+    several documents is read in doc_path's copy if given, else in the
+    first document that has it. The range starts PREFIX_ROWS early so the
+    first chunk's overlap can be rebuilt.
+    """
+    items = list(items)
+    if not items:
+        return [], {}
+    center, other = aliased(Chunk), aliased(Chunk)
+    first = (
+        select(other.id).where(other.embedding_id == center.embedding_id)
+        .order_by(other.document_id, other.position).limit(1)
+        .correlate(center).scalar_subquery()
+    )
+    rows = (
+        db.query(center.embedding_id.label("center_id"), center.position.label("center_pos"), Document.path,
+                 Chunk.embedding_id, *TEXT_COLUMNS)
+        .select_from(center)
+        .join(Document, Document.id == center.document_id)
+        .join(Chunk, and_(
+            Chunk.document_id == center.document_id,
+            Chunk.position.between(center.position - radius - PREFIX_ROWS, center.position + radius),
+        ))
+        .filter(or_(*(
+            and_(center.embedding_id == eid, Document.path == path if path else center.id == first)
+            for eid, path in dict.fromkeys(items)
+        )))
+        .order_by(Chunk.document_id, center.position, Chunk.position)
+        .all()
+    )
+    found, windows = {}, {}
+    for r in rows:
+        key = (r.document_id, r.center_pos)
+        found.setdefault((r.center_id, r.path), key + (r.path,))
+        found.setdefault((r.center_id, None), key + (r.path,))
+        w = windows.setdefault(key, [])
+        if abs(r.position - r.center_pos) <= radius:
+            w.append(r)
+    texts = chunk_texts(db, [(r.document_id, r.position) for w in windows.values() for r in w], rows)
+    return [found.get(i) for i in items], {
+        key: [{"id": r.embedding_id, "position": r.position, "text": (texts[(r.document_id, r.position)] or "").strip()} for r in w]
+        for key, w in windows.items()
+    }
+
+def _read(items, radius):
+    """
+    (centers, windows) for `items`, in one session (see _windows).
+    """
+    db = SessionLocal()
+    try:
+        return _windows(db, items, radius)
+    finally:
+        db.close()
+
 @router.get("")
-def get_context(id:int = Query(..., description="Embedding ID of center chunk"), radius: int = Query(1, ge=0, le=3)):
+async def get_context(
+    id:int = Query(..., description="Embedding ID of center chunk"),
+    radius: int = Query(1, ge=0, le=3),
+    doc_path: str | None = Query(None, description="Document to read around, when several contain the chunk"),
+):
     """
     Get context chunks around a given chunk identified by its embedding ID."""
-    db = SessionLocal()
     try: 
-        center = db.query(Chunk).filter(Chunk.embedding_id == id).first()
-        if not center:
-            raise HTTPException(status_code=404, detail=f"Chunk with embedding ID {id} not found")
-        
-        all_chunks = db.query(Chunk).filter(Chunk.document_id == center.document_id).order_by(Chunk.position).all()
-        pos = center.position
-        start = max(0, pos - radius)
-        end = min(len(all_chunks), pos+radius+1)
-        window = all_chunks[start:end]
-
-        doc = db.query(Document).filter(Document.id == center.document_id).first()
-
-        context_items = [
-            {
-                "id": c.embedding_id,
-                "position": c.position,
-                "text": c.text.strip()
-            }
-            for c in window
-        ]
-    
-        return {
-            "ok": True, 
-            "center": id, 
-            "doc_path": doc.path if doc else "unknown",
-            "position": pos, 
-            "context": context_items
-        }
-    except HTTPException:
-        raise
+        with span("db_fetch"):
+            centers, windows = await run_db(_read, [(id, doc_path)], radius)
     except Exception as e:
         print(f"[DB ERROR] Failed to get context for chunk with embedding ID {id}: {e}")
         raise HTTPException(status_code=500, detail="Internal error retrieving context")
-    finally:
-        db.close()
+    if not centers[0]:
+        raise HTTPException(status_code=404, detail=f"Chunk with embedding ID {id} not found")
+    doc_id, pos, path = centers[0]
+    return {
+        "ok": True, 
+        "center": id, 
+        "doc_path": path,
+        "position": pos, 
+        "context": windows[(doc_id, pos)]
+    }
+
+@router.post("/batch")
+async def get_context_batch(body: ContextBatch):
+    """
+    Context windows for many chunks (e.g. every hit of a search response)
+    in one query. Results follow the order of `items`; unknown IDs get
+    ok=false instead of failing the batch.
+    """
+    if len(body.items) > MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH} items per batch")
+    items = [(it.id, it.doc_path) for it in body.items]
+    try:
+        with span("db_fetch"):
+            centers, windows = await run_db(_read, items, body.radius)
+    except Exception as e:
+        print(f"[DB ERROR] Failed to get context batch: {e}")
+        raise HTTPException(status_code=500, detail="Internal error retrieving context")
+    results = []
+    for (eid, _), center in zip(items, centers):
+        if center is None:
+            results.append({"ok": False, "center": eid, "detail": "not found"})
+            continue
+        doc_id, pos, path = center
+        results.append({
+            "ok": True,
+            "center": eid,
+            "doc_path": path,
+            "position": pos,
+            "context": windows[(doc_id, pos)],
+        })
+    return {"ok": True, "radius": body.radius, "results": results}
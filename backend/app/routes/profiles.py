@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse
+from ..profiling import authorized, list_profiles, profile_path, PROFILER, PROFILE_DIR
+
+router = APIRouter()
+
+def _check(request: Request):
+    if not authorized(request):
+        raise HTTPException(status_code=403, detail="Profiling token required")
+
+@router.get("")
+async def profiles(request: Request):
+    """
+    Stored request/job profiles, newest first. .html files are pyinstrument
+    reports; .prof files are cProfile stats (open with pstats or snakeviz).
+    """
+    _check(request)
+    return {"profiler": PROFILER, "dir": PROFILE_DIR, "profiles": list_profiles()}
+
+@router.get("/{name}")
+async def download_profile(name: str, request: Request):
+    _check(request)
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile {name} not found")
+    media = "text/html" if name.endswith(".html") else "application/octet-stream"
+    return FileResponse(path, media_type=media, filename=name)
@@ -1,48 +1,99 @@
-from fastapi import APIRouter, Query
-import numpy as np, os, httpx
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+import os, json, time
 
-from ..utils.filters import filter_chunks
-from ..embeddings import embed_batch
-from ..indexer import create_or_load_index, load_meta, search as faiss_search
+from ..retrieval import MAX_K, retrieve, embed_query
+from ..indexer import index_manager
+from ..semantic_cache import qa_semantic_cache
 from ..prompts import build_qa_prompt
 from ..cache import qa_cache
-from app.db import get_chunks_by_ids
+from ..ollama_client import ollama
+from ..metrics import record_stage, span
 
 router = APIRouter()
 
 OLLAMA = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 GEN_MODEL = os.getenv("GEN_MODEL", "llama3.1:8b")
+GEN_OPTIONS = {
+    "num_ctx": 4096,
+    "temperature": 0.6,
+    "top_p": 0.9
+}
 
-def l2_normalize(arr):
-    n = np.linalg.norm(arr, axis=1, keepdims=True) + 1e-12
-    return arr / n
+def _sources(chunks):
+    return [
+        {
+            "id": c["embedding_id"],
+            "score": c["score"],
+            "doc_path": c["doc_path"],
+            "position": c["position"],
+            "preview": c["text_preview"][:240],
+            "tags": c.get("tags", ""),
+            "type": c.get("type", ""),
+            "modified": c.get("modified", ""),
+        }
+        for c in chunks
+    ]
+
+async def _semantic_lookup(q, mode, params):
+    """
+    Embed the question once and check the semantic cache with it.
+    Returns (qv or None, payload or None); lexical mode never embeds.
+    """
+    if mode == "lexical" or not qa_semantic_cache.enabled:
+        return None, None
+    qv = await embed_query(q)
+    hit = qa_semantic_cache.get(qv, params, index_manager.generation)
+    if hit is None:
+        return qv, None
+    payload, similarity = hit
+    return qv, {**payload, "question": q, "cached_question": payload["question"], "similarity": similarity}
+
+def _payload(q, answer, generation, mode, chunks, file_type, tag, modified_after):
+    return {
+        "question": q,
+        "answer": answer,
+        "generation": generation,
+        "mode": mode,
+        "filters": {
+            "file_type": file_type,
+            "tag": tag,
+            "modified_after": modified_after
+        },
+        "sources": _sources(chunks),
+    }
 
 @router.get("")
 async def qa(q: str = Query(..., description="User question"),
-             k: int = 5,
+             k: int = Query(5, ge=1, le=MAX_K),
+             mode: str = Query("vector", pattern="^(vector|lexical|hybrid)$"),
              max_ctx_chars: int = 1800,
              file_type: str | None = Query(None),
              tag: str | None = Query(None),
-             modified_after: str | None = Query(None)
+             modified_after: str | None = Query(None),
+             nprobe: int | None = Query(None, ge=1),
+             ef_search: int | None = Query(None, ge=1)
 ):
     """
     Minimal RAG:
-      1) embed question
-      2) retrieve top-k chunks
+      1) embed question (skipped in lexical mode)
+      2) retrieve top-k chunks (vector, lexical or hybrid)
       3) trim context so prompt stays small
       4) call Ollama generate
     """
     ## cache
-    ck = (q, k, max_ctx_chars, file_type, tag, modified_after)
+    ck = (q, k, mode, max_ctx_chars, file_type, tag, modified_after, nprobe, ef_search)
     cached = qa_cache.get(ck)
     if cached: return cached
-    # 1) Embed query
-    vec = await embed_batch([q])
-    qv = l2_normalize(np.array(vec, dtype="float32"))[0]
+    # 1) Embed query; a near-duplicate question reuses its answer
+    qv, similar = await _semantic_lookup(q, mode, ck[1:])
+    if similar: return similar
 
-    # 2) Retrieve
-    index = create_or_load_index(qv.shape[0])
-    scores, ids = faiss_search(index, qv, top_k=k)
+    # 2) Retrieve (filters applied inside FAISS / FTS)
+    generation, chunks = await retrieve(
+        q, k, mode=mode, file_type=file_type, tag=tag, modified_after=modified_after,
+        nprobe=nprobe, ef_search=ef_search, qv=qv,
+    )
 
     # Fetch chunk + doc info from DB : Replace by DB retrieval using FAISS IDs
     # meta = load_meta()
@@ -58,30 +109,23 @@ async def qa(q: str = Query(..., description="User question"),
     #     contexts.append({**m, "text_preview": trimmed})
     #     total += len(trimmed)
 
-    chunks = get_chunks_by_ids(ids)
-    chunks = filter_chunks(chunks, file_type=file_type, tag=tag, modified_after=modified_after)
-    chunks = sorted(chunks, key=lambda x: -scores[chunks.index(x)])[:k]
-    
     context_text = "\n\n".join(c["text_preview"] for c in chunks)
     # prompt = f"Question: {q}\n\nContext:\n{context_text}\n\nAnswer clearly and concisely based on the context provided."
 
     # 3) Build prompt
-    prompt = build_qa_prompt(q, chunks)
+    with span("prompt_build"):
+        prompt = build_qa_prompt(q, chunks)
 
     # 4) Generate with Ollama
-    async with httpx.AsyncClient(timeout=300) as client:
-        r = await client.post(f"{OLLAMA}/api/generate", json={
+    with span("llm_generate"):
+        r = await ollama.post("generate", f"{OLLAMA}/api/generate", json={
             "model": GEN_MODEL,
             "prompt": prompt,
             "stream": False,
-            "options": {
-                "num_ctx": 4096,
-                "temperature": 0.6,
-                "top_p": 0.9
-            }
+            "options": GEN_OPTIONS,
         })
-        r.raise_for_status()
-        answer = r.json().get("response", "").strip()
+    r.raise_for_status()
+    answer = r.json().get("response", "").strip()
 
     ## Builds from meta, to be replaced by DB fetch above
     # payload = {
@@ -100,28 +144,107 @@ async def qa(q: str = Query(..., description="User question"),
     #     ]
     # }
 
-    payload = {
-        "question": q,
-        "answer": answer,
-        "filters": {
-            "file_type": file_type,
-            "tag": tag,
-            "modified_after": modified_after
-        },
-        "sources": [
-            {
-                "id": c["embedding_id"],
-                "doc_path": c["doc_path"],
-                "position": c["position"],
-                "preview": c["text_preview"][:240],
-                "tags": c.get("tags", ""),
-                "type": c.get("type", ""),
-                "modified": c.get("modified", ""),
-            }
-            for c in chunks
-        ]
-    }
+    payload = _payload(q, answer, generation, mode, chunks, file_type, tag, modified_after)
 
     qa_cache.set(ck, payload)
+    if qv is not None:
+        qa_semantic_cache.set(qv, ck[1:], generation, payload)
 
     return payload
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.get("/stream")
+async def qa_stream(request: Request,
+                    q: str = Query(..., description="User question"),
+                    k: int = Query(5, ge=1, le=MAX_K),
+                    mode: str = Query("vector", pattern="^(vector|lexical|hybrid)$"),
+                    max_ctx_chars: int = 1800,
+                    file_type: str | None = Query(None),
+                    tag: str | None = Query(None),
+                    modified_after: str | None = Query(None),
+                    nprobe: int | None = Query(None, ge=1),
+                    ef_search: int | None = Query(None, ge=1)
+):
+    """
+    /qa over Server-Sent Events:
+      event: sources  - retrieved chunks, before generation starts
+      event: token    - {"t": text} per generated piece
+      event: done     - the same payload /qa returns (cached, shared with /qa)
+      event: error    - {"detail": message} if generation fails
+    Timings for the metrics middleware go on request.state.qa_stream.
+    """
+    t0 = time.perf_counter()
+    stats = request.state.qa_stream = {"started": t0, "first_token": None, "tokens": 0, "tokens_per_s": None}
+    ck = (q, k, mode, max_ctx_chars, file_type, tag, modified_after, nprobe, ef_search)
+    cached = qa_cache.get(ck)
+
+    async def replay(payload):
+        stats["first_token"] = time.perf_counter()
+        yield _sse("sources", {"generation": payload["generation"], "sources": payload["sources"], "cached": True})
+        yield _sse("token", {"t": payload["answer"]})
+        yield _sse("done", payload)
+
+    async def events():
+        if cached:
+            async for frame in replay(cached):
+                yield frame
+            return
+        qv, similar = await _semantic_lookup(q, mode, ck[1:])
+        if similar:
+            async for frame in replay(similar):
+                yield frame
+            return
+
+        generation, chunks = await retrieve(
+            q, k, mode=mode, file_type=file_type, tag=tag, modified_after=modified_after,
+            nprobe=nprobe, ef_search=ef_search, qv=qv,
+        )
+        yield _sse("sources", {"generation": generation, "sources": _sources(chunks)})
+
+        with span("prompt_build"):
+            prompt = build_qa_prompt(q, chunks)
+        parts = []
+        gen_started = time.perf_counter()
+        try:
+            async with ollama.stream("generate", "POST", f"{OLLAMA}/api/generate", json={
+                "model": GEN_MODEL,
+                "prompt": prompt,
+                "stream": True,
+                "options": GEN_OPTIONS,
+            }) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line.strip():
+                        continue
+                    frame = json.loads(line)
+                    piece = frame.get("response", "")
+                    if piece:
+                        if stats["first_token"] is None:
+                            stats["first_token"] = time.perf_counter()
+                        stats["tokens"] += 1
+                        parts.append(piece)
+                        yield _sse("token", {"t": piece})
+                    if frame.get("done"):
+                        # Ollama reports its own decode rate; prefer it over wall clock
+                        if frame.get("eval_count") and frame.get("eval_duration"):
+                            stats["tokens"] = frame["eval_count"]
+                            stats["tokens_per_s"] = frame["eval_count"] / (frame["eval_duration"] / 1e9)
+                        break
+        except Exception as e:
+            print(f"[QA STREAM ERROR] {e}")
+            yield _sse("error", {"detail": str(e)})
+            return
+        finally:
+            record_stage("llm_generate", (time.perf_counter() - gen_started) * 1000.0)
+
+        payload = _payload(q, "".join(parts).strip(), generation, mode, chunks, file_type, tag, modified_after)
+        qa_cache.set(ck, payload)
+        if qv is not None:
+            qa_semantic_cache.set(qv, ck[1:], generation, payload)
+        yield _sse("done", payload)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
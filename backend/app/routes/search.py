@@ -1,68 +1,76 @@
-from fastapi import APIRouter, Query
+import os
+from fastapi import APIRouter, Query, HTTPException
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List
 
-from ..utils.filters import filter_chunks
-from ..embeddings import embed_batch
-from ..indexer import create_or_load_index, search as faiss_search, load_meta
+from ..retrieval import MAX_K, retrieve, embed_queries, batch_vector_search
 from ..cache import search_cache
-import ujson
-import numpy as np
-from app.db import get_chunks_by_ids, SessionLocal, Document, Chunk
-from datetime import datetime
 
 router = APIRouter()
 
-def l2_normalize(arr):
-    n = np.linalg.norm(arr, axis=1, keepdims=True) + 1e-12
-    return arr/n
+MAX_BATCH = int(os.getenv("SEARCH_MAX_BATCH", "256"))
+
+class BatchQuery(BaseModel):
+    # batch search is vector-only; reject fields it would otherwise ignore
+    # (e.g. mode) instead of silently running a different search
+    model_config = ConfigDict(extra="forbid")
+
+    q: str
+    k: int = Field(5, ge=1, le=MAX_K)
+    file_type: str | None = None
+    tag: str | None = None
+    modified_after: str | None = None
+    nprobe: int | None = Field(None, ge=1)
+    ef_search: int | None = Field(None, ge=1)
+
+class BatchSearch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    queries: List[BatchQuery]
 
 @router.get("")
 async def search(
     q = Query(...), 
-    k: int=5,
+    k: int = Query(5, ge=1, le=MAX_K),
+    mode: str = Query("vector", pattern="^(vector|lexical|hybrid)$", description="vector, lexical (BM25) or hybrid"),
     file_type: str | None = Query(None, description="Filter by file type"),
     tag: str | None = Query(None, description="Filter by tag"),
     modified_after: str | None = Query(None, description="Filter documents modified after this date"),
+    nprobe: int | None = Query(None, ge=1, description="IVF lists to probe (IVF indexes)"),
+    ef_search: int | None = Query(None, ge=1, description="HNSW search depth (HNSW indexes)"),
 ):
     """
     Search for relevant chunks given a query string."""
     ## search cache
-    ck = (q, k, file_type, tag, modified_after)
+    ck = (q, k, mode, file_type, tag, modified_after, nprobe, ef_search)
     cached = search_cache.get(ck)
 
     if cached: return cached
 
-    vec = await embed_batch([q])
-    arr = l2_normalize(np.array(vec, dtype="float32"))[0]
-
-    # load index
-    index= create_or_load_index(arr.shape[0])
-    scores, ids = faiss_search(index, arr, top_k=k*3) # retrieve more to filter later
-
-    ## read metadata linearly : replace by DB retrieval using FAISS IDs
-    # meta = load_meta()
-    # # meta check
-    # # print(meta)
-    # out = []
-    # seen = set()
-    # for s,i in sorted(zip(scores, ids), key=lambda x: -x[0]):
-    #     m = meta.get(str(i))
-    #     if not m:
-    #         continue
-    #     key = (m["doc_path"], m["position"])
-    #     if key in seen:
-    #         continue
-    #     seen.add(key)
-    #     out.append({"score": float(s), "id":int(i), **m})
-
-    chunks = get_chunks_by_ids(ids)
-    # sanity print
-    chunks = filter_chunks(chunks, file_type=file_type, tag=tag, modified_after=modified_after)
-    
-    out = sorted(chunks, key=lambda x: -scores[chunks.index(x)])
-    for i, c in enumerate(out):
-        c["score"] = float(scores[chunks.index(c)])
-        c["id"] = int(c["embedding_id"])
-    payload = {"query": q, "results": out}
+    # filters are pushed down into FAISS / the FTS query, so k hits come back in one pass
+    generation, out = await retrieve(
+        q, k, mode=mode, file_type=file_type, tag=tag, modified_after=modified_after,
+        nprobe=nprobe, ef_search=ef_search,
+    )
+    payload = {"query": q, "mode": mode, "generation": generation, "results": out}
     search_cache.set(ck, payload)
 
-    return payload
\ No newline at end of file
+    return payload
+
+@router.post("/batch")
+async def search_batch(body: BatchSearch):
+    """
+    Search many queries in one pass: one embed call, one FAISS search per
+    distinct filter set and one DB lookup. Results come back in query order.
+    """
+    if len(body.queries) > MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH} queries per batch")
+    specs = [bq.model_dump() for bq in body.queries]
+    qvs = await embed_queries([s["q"] for s in specs])
+    generation, per_query = await batch_vector_search(qvs, specs)
+    return {
+        "generation": generation,
+        "results": [
+            {"query": s["q"], "results": res} for s, res in zip(specs, per_query)
+        ],
+    }
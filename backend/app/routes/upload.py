@@ -1,16 +1,233 @@
-from fastapi import APIRouter, UploadFile, File
-
-import shutil
-import os
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query
+from typing import List
+import asyncio, hashlib, os, re, shutil, uuid, zipfile
 
 router = APIRouter()
 UPLOAD_DIR = "uploads/"
+# content-addressed blobs; names in UPLOAD_DIR are hardlinks to them.
+# Dot-prefixed so the indexer's glob and the watcher skip it.
+OBJECTS_DIR = os.path.join(UPLOAD_DIR, ".objects")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(OBJECTS_DIR, exist_ok=True)
+
+UPLOAD_CHUNK = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1 << 20)))
+ZIP_MAX_MEMBERS = int(os.getenv("UPLOAD_ZIP_MAX_MEMBERS", "10000"))
+ZIP_MAX_BYTES = int(os.getenv("UPLOAD_ZIP_MAX_BYTES", str(4 << 30)))  # total uncompressed
+
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+def _safe_name(filename: str) -> str | None:
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name or name.startswith("."):
+        return None
+    return name
+
+def _unique_name(name: str, source: str, taken: set) -> str:
+    """
+    `name`, or if an earlier file in the same upload already took it, a
+    variant with the source's directories folded in (b/notes.md ->
+    b_notes.md), numbered if that is taken too.
+    """
+    if name not in taken:
+        taken.add(name)
+        return name
+    stem, ext = os.path.splitext(name)
+    dirs = [_UNSAFE_RE.sub("_", d).strip("._") for d in (source or "").replace("\\", "/").split("/")[:-1]]
+    base = "_".join([d for d in dirs if d] + [stem])
+    candidate, n = base + ext, 2
+    while candidate in taken:
+        candidate, n = f"{base}-{n}{ext}", n + 1
+    taken.add(candidate)
+    return candidate
+
+def _object_path(digest: str) -> str:
+    return os.path.join(OBJECTS_DIR, digest[:2], digest)
+
+def _tmp_path() -> str:
+    return os.path.join(OBJECTS_DIR, f".tmp-{uuid.uuid4().hex}")
+
+def _write_chunk(f, h, chunk: bytes):
+    h.update(chunk)
+    f.write(chunk)
+
+async def _spool(read) -> tuple[str, str, int]:
+    """
+    Stream `await read(n)` chunks to a temp file, hashing as they pass.
+    File writes and hashing run off the event loop. Returns (tmp, sha256, size).
+    """
+    tmp = _tmp_path()
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp, "wb") as f:
+            while True:
+                chunk = await read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                await asyncio.to_thread(_write_chunk, f, h, chunk)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return tmp, h.hexdigest(), size
+
+def _link(tmp: str, digest: str, name: str) -> str:
+    """
+    Move a spooled file into the object store and point `name` at it.
+    Returns stored | duplicate | unchanged | replaced.
+    """
+    obj = _object_path(digest)
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    if os.path.exists(obj):
+        os.remove(tmp)
+        status = "duplicate"
+    else:
+        os.replace(tmp, obj)
+        status = "stored"
+
+    dest = os.path.join(UPLOAD_DIR, name)
+    if os.path.exists(dest):
+        if os.path.samefile(dest, obj):
+            return "unchanged"
+        status = "replaced"
+
+    # link under a temp name, then rename over `dest` so readers never see a partial file
+    staged = _tmp_path()
+    try:
+        os.link(obj, staged)
+    except OSError:
+        shutil.copy2(obj, staged)  # filesystem without hardlinks
+    os.replace(staged, dest)
+    return status
+
+async def _store(read, name: str, source: str, taken: set) -> dict:
+    stored = _unique_name(name, source, taken)
+    tmp, digest, size = await _spool(read)
+    status = await asyncio.to_thread(_link, tmp, digest, stored)
+    out = {"filename": stored, "sha256": digest, "size": size, "status": status}
+    if stored != name:
+        out["source"] = source
+        out["detail"] = f"renamed: {name} was already used in this upload"
+    return out
+
+async def _expand_zip(archive: str, taken: set) -> List[dict]:
+    """
+    Store every regular member of a ZIP, flattened to its base name; a
+    name used twice is renamed (see _unique_name) rather than overwritten.
+    Members are decompressed as streams, never fully in memory.
+    """
+    results = []
+    zf = await asyncio.to_thread(zipfile.ZipFile, archive)
+    try:
+        members = [m for m in zf.infolist() if not m.is_dir() and "__MACOSX/" not in m.filename]
+        if len(members) > ZIP_MAX_MEMBERS:
+            raise HTTPException(status_code=413, detail=f"ZIP has more than {ZIP_MAX_MEMBERS} files")
+        if sum(m.file_size for m in members) > ZIP_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="ZIP expands beyond the upload limit")
+        for m in members:
+            name = _safe_name(m.filename)
+            if name is None:
+                results.append({"filename": m.filename, "status": "skipped", "detail": "invalid filename"})
+                continue
+            src = zf.open(m)
+            try:
+                results.append(await _store(lambda n: asyncio.to_thread(src.read, n), name, m.filename, taken))
+            finally:
+                src.close()
+    finally:
+        zf.close()
+    return results
+
+async def _handle(upload: UploadFile, expand_zip: bool, taken: set) -> List[dict]:
+    name = _safe_name(upload.filename)
+    if name is None:
+        return [{"filename": upload.filename, "status": "skipped", "detail": "invalid filename"}]
+    if expand_zip and name.lower().endswith(".zip"):
+        # the central directory sits at the end, so spool the archive first
+        tmp, _, _ = await _spool(upload.read)
+        try:
+            return await _expand_zip(tmp, taken)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail=f"{name} is not a valid ZIP archive")
+        finally:
+            os.remove(tmp)
+    return [await _store(upload.read, name, upload.filename, taken)]
 
 @router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    return {"filename": file.filename, "status": "uploaded"}
+async def upload_file(
+    file: UploadFile | None = File(None),
+    files: List[UploadFile] | None = File(None),
+    expand_zip: bool = Query(True, description="Store the files inside .zip uploads instead of the archive"),
+):
+    """
+    Upload one or more files (`file` and/or repeated `files` fields).
+    Bytes are streamed to disk and hashed on the way; content is stored once
+    under uploads/.objects/ and each name is a hardlink to it, so uploading
+    identical bytes under the same name changes nothing on disk. A name used
+    twice within one request (e.g. a/notes.md and b/notes.md in a ZIP) is
+    stored under a renamed variant and reported with its source.
+    """
+    uploads = ([file] if file else []) + list(files or [])
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No file uploaded")
+    results = []
+    taken = set()  # names stored by this request
+    for up in uploads:
+        try:
+            results.extend(await _handle(up, expand_zip, taken))
+        finally:
+            await up.close()
+    if len(results) == 1:
+        return {**results[0], "files": results}
+    return {"files": results}
+
+def _digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+@router.post("/gc")
+async def collect_objects():
+    """
+    Delete stored objects no upload name refers to any more: none links to
+    them, and none holds a copy of their bytes (names are copies on
+    filesystems without hardlinks, see _link). Only names with the size of
+    an unlinked object are hashed.
+    """
+    def gc():
+        unlinked = {}  # path -> (digest, size)
+        for root, _, names in os.walk(OBJECTS_DIR):
+            for n in names:
+                p = os.path.join(root, n)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                if not n.startswith(".tmp-") and st.st_nlink == 1:
+                    unlinked[p] = (n, st.st_size)
+        if not unlinked:
+            return 0
+
+        sizes = {size for _, size in unlinked.values()}
+        copied = set()
+        for entry in os.scandir(UPLOAD_DIR):
+            try:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                if st.st_nlink == 1 and st.st_size in sizes:
+                    copied.add(_digest(entry.path))
+            except OSError:
+                pass
 
+        removed = 0
+        for p, (digest, _) in unlinked.items():
+            if digest in copied:
+                continue
+            try:
+                os.remove(p)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+    return {"removed": await asyncio.to_thread(gc)}
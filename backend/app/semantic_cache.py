@@ -0,0 +1,119 @@
+from __future__ import annotations
+import os, threading, time
+from collections import OrderedDict
+from typing import Dict, Tuple
+import faiss
+import numpy as np
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("QA_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("QA_SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("QA_SEMANTIC_CACHE_SIZE", "1024"))  # 0 disables
+SEMANTIC_CACHE_NEIGHBORS = 8
+
+class SemanticCache:
+    """
+    Answers keyed by question embedding. A lookup returns the stored payload
+    of the most similar past question whose cosine similarity is at least
+    `threshold` and whose retrieval params (k, mode, filters, ...) are equal.
+    Entries expire after `ttl` seconds, the oldest-used go first past
+    `max_size`, and everything is dropped when the index generation changes.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, max_size=SEMANTIC_CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._index: faiss.IndexIDMap2 | None = None
+        self._entries: "OrderedDict[int, Tuple[float, tuple, dict]]" = OrderedDict()
+        self._next_id = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def _clear(self):
+        self._index = None
+        self._entries.clear()
+
+    def _drop(self, ids):
+        for i in ids:
+            self._entries.pop(i, None)
+        if self._index is not None and ids:
+            self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def _sync(self, generation, dim):
+        if generation != self.generation or (self._index is not None and self._index.d != dim):
+            self._clear()
+            self.generation = generation
+
+    def get(self, qv: np.ndarray, params: tuple, generation) -> Tuple[dict, float] | None:
+        """
+        (payload, similarity) of the closest matching entry, or None.
+        """
+        if not self.enabled:
+            return None
+        q = np.asarray(qv, dtype="float32").reshape(1, -1)
+        with self._lock:
+            self._sync(generation, q.shape[1])
+            if self._index is None or self._index.ntotal == 0:
+                self.misses += 1
+                return None
+            D, I = self._index.search(q, min(SEMANTIC_CACHE_NEIGHBORS, self._index.ntotal))
+            now = time.time()
+            expired = []
+            found = None
+            for score, eid in zip(D[0], I[0]):
+                if eid < 0 or score < self.threshold:
+                    break
+                entry = self._entries.get(int(eid))
+                if entry is None:
+                    continue
+                expires, p, payload = entry
+                if expires < now:
+                    expired.append(int(eid))
+                    continue
+                if p == params:
+                    self._entries.move_to_end(int(eid))
+                    found = (payload, float(score))
+                    break
+            self._drop(expired)
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return found
+
+    def set(self, qv: np.ndarray, params: tuple, generation, payload: dict):
+        if not self.enabled:
+            return
+        q = np.asarray(qv, dtype="float32").reshape(1, -1)
+        with self._lock:
+            self._sync(generation, q.shape[1])
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(q.shape[1]))
+            eid = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(q, np.array([eid], dtype=np.int64))
+            self._entries[eid] = (time.time() + self.ttl, params, payload)
+            over = len(self._entries) - self.max_size
+            if over > 0:
+                old = list(self._entries.keys())[:over]
+                self._drop(old)
+                self.evictions += len(old)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "qa_semantic_cache_hits_total": self.hits,
+            "qa_semantic_cache_misses_total": self.misses,
+            "qa_semantic_cache_evictions_total": self.evictions,
+            "qa_semantic_cache_entries": len(self._entries),
+            "qa_semantic_cache_hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+qa_semantic_cache = SemanticCache()
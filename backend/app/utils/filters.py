@@ -1,52 +1,60 @@
-from ..db import SessionLocal, Document, Chunk
-from datetime import datetime
+from ..db import SessionLocal, Document, Chunk, document_filter, run_db
+from ..cache import LRU
+import numpy as np
+import faiss
 
-def filter_chunks(chunks, file_type=None, tag=None, modified_after=None):
+_allowed_cache = LRU(64)
+
+def apply_filters(q, file_type=None, tag=None, modified_after=None):
+    """
+    Add the filter criteria to a query that already joins Document.
+    """
+    conds = document_filter(file_type, tag, modified_after)
+    return q.filter(*conds) if conds else q
+
+def _allowed_key(file_type, tag, modified_after, generation):
+    return ((file_type or "").lower(), (tag or "").lower(), modified_after, generation)
+
+def allowed_ids(file_type=None, tag=None, modified_after=None, generation=0):
     """
-    Filter chunks using optional critetria: file_type, tag, modified_after.
+    Resolve filters to the embedding IDs they allow, as (ids, IDSelector) for
+    FAISS to search within. None when no filter is set. Cached per filter
+    and index generation.
     """
     if not (file_type or tag or modified_after):
-        return chunks
-    
+        return None
+    cached = _allowed_cache.get(_allowed_key(file_type, tag, modified_after, generation))
+    if cached is not None:
+        return cached
+
     db = SessionLocal()
-    filtered = [] 
-    
     try:
-        doc_paths = {c["doc_path"] for c in chunks}
-        docs = {
-            d.path: d
-            for d in db.query(Document).filter(Document.path.in_(doc_paths)).all()
-        }
-        for c in chunks:
-            doc = docs.get(c["doc_path"])
-            if not doc:
-                continue
-
-            if file_type and (doc.type or "").lower() != file_type.lower():
-                continue
-            
-            # filter by tags
-            if tag and tag.lower() not in (doc.tags or "").lower():
-                continue
-            
-            # filter by modified date
-            if modified_after:
-                try:
-                    dt = datetime.fromisoformat(modified_after)
-                    if doc.modified and doc.modified < dt:
-                        continue
-                except Exception as e:
-                    print(f"[WARN] Invalid modified_after param: {e}")
-                    pass
-            
-            filtered.append({
-                **c,
-                "tags": doc.tags,
-                "type": doc.type,
-                "modified": str(doc.modified),
-            })
-        return filtered
+        q = apply_filters(
+            db.query(Chunk.embedding_id)
+            .join(Document, Chunk.document_id == Document.id)
+            .filter(Chunk.embedding_id.isnot(None)),
+            file_type, tag, modified_after,
+        ).distinct()
+        ids = np.fromiter((r[0] for r in q.all()), dtype=np.int64)
     except Exception as e:
         print(f"[FILTER ERROR] {e}")
+        # match nothing rather than silently ignoring the filter
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, faiss.IDSelectorBatch(empty)
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+    out = (ids, faiss.IDSelectorBatch(ids))
+    _allowed_cache.set(_allowed_key(file_type, tag, modified_after, generation), out)
+    return out
+
+async def allowed_ids_async(file_type=None, tag=None, modified_after=None, generation=0):
+    """
+    allowed_ids without blocking the event loop; cache hits skip the DB pool.
+    """
+    if not (file_type or tag or modified_after):
+        return None
+    cached = _allowed_cache.get(_allowed_key(file_type, tag, modified_after, generation))
+    if cached is not None:
+        return cached
+    return await run_db(allowed_ids, file_type, tag, modified_after, generation)
@@ -0,0 +1,138 @@
+from __future__ import annotations
+import os, asyncio, time
+from typing import Dict, Set, Tuple
+
+from .routes.upload import UPLOAD_DIR
+from .jobs import index_jobs
+
+INDEX_WATCH = os.getenv("INDEX_WATCH", "off").lower()  # off | auto | inotify | poll
+WATCH_DEBOUNCE = float(os.getenv("INDEX_WATCH_DEBOUNCE", "1.0"))  # seconds of quiet before indexing
+WATCH_MAX_DELAY = float(os.getenv("INDEX_WATCH_MAX_DELAY", "10"))  # flush even if events keep coming
+WATCH_POLL_INTERVAL = float(os.getenv("INDEX_WATCH_POLL_INTERVAL", "2.0"))
+
+def _upload_path(path: str) -> str | None:
+    """
+    Map an event path to the form the indexer stores ("uploads/<name>"), or
+    None for paths it does not index (subdirectories, dotfiles).
+    """
+    name = os.path.basename(path)
+    if not name or name.startswith("."):
+        return None
+    if os.path.abspath(os.path.dirname(path)) != os.path.abspath(UPLOAD_DIR):
+        return None
+    return os.path.join(UPLOAD_DIR, name)
+
+class UploadWatcher:
+    """
+    Watches UPLOAD_DIR and queues incremental jobs for just the paths that
+    were created, modified or deleted. Events are batched until the directory
+    has been quiet for WATCH_DEBOUNCE seconds (at most WATCH_MAX_DELAY).
+    Uses inotify via the optional `watchfiles` package, else polls
+    directory entries' size/mtime every WATCH_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, mode: str = INDEX_WATCH):
+        self.mode = mode
+        self.backend: str | None = None
+        self._task: asyncio.Task | None = None
+        self._flusher: asyncio.Task | None = None
+        self._pending: Set[str] = set()
+        self._first = 0.0
+        self._last = 0.0
+        self.events = 0
+        self.jobs = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        watch = None
+        if self.mode in ("auto", "inotify"):
+            try:
+                import watchfiles  # optional dependency
+                watch = self._watch_inotify(watchfiles)
+                self.backend = "inotify"
+            except ImportError:
+                print("[WATCH] watchfiles not installed, polling instead")
+        if watch is None:
+            watch = self._watch_poll()
+            self.backend = "poll"
+        self._task = asyncio.create_task(watch)
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        for t in (self._task, self._flusher):
+            if t is not None:
+                t.cancel()
+        for t in (self._task, self._flusher):
+            if t is not None:
+                try:
+                    await t
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._task = self._flusher = None
+
+    def _record(self, path: str):
+        p = _upload_path(path)
+        if p is None:
+            return
+        now = time.monotonic()
+        if not self._pending:
+            self._first = now
+        self._pending.add(p)
+        self._last = now
+        self.events += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(min(WATCH_DEBOUNCE, 0.25))
+            if not self._pending:
+                continue
+            now = time.monotonic()
+            if now - self._last < WATCH_DEBOUNCE and now - self._first < WATCH_MAX_DELAY:
+                continue
+            paths, self._pending = self._pending, set()
+            index_jobs.submit("incremental", paths)
+            self.jobs += 1
+
+    async def _watch_inotify(self, watchfiles):
+        # watchfiles has its own debounce; ours still batches across its yields
+        async for changes in watchfiles.awatch(UPLOAD_DIR, recursive=False, debounce=200):
+            for _, path in changes:
+                self._record(path)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        out = {}
+        with os.scandir(UPLOAD_DIR) as it:
+            for e in it:
+                if e.is_file():
+                    st = e.stat()
+                    out[e.path] = (st.st_size, st.st_mtime_ns)
+        return out
+
+    async def _watch_poll(self):
+        seen = await asyncio.to_thread(self._scan)
+        while True:
+            await asyncio.sleep(WATCH_POLL_INTERVAL)
+            try:
+                cur = await asyncio.to_thread(self._scan)
+            except OSError as e:
+                print(f"[WATCH ERROR] {e}")
+                continue
+            for p in cur.keys() | seen.keys():
+                if cur.get(p) != seen.get(p):
+                    self._record(p)
+            seen = cur
+
+    def stats(self):
+        return {
+            "index_watch_enabled": int(self.enabled and self._task is not None),
+            "index_watch_events_total": self.events,
+            "index_watch_jobs_total": self.jobs,
+            "index_watch_pending_paths": len(self._pending),
+        }
+
+upload_watcher = UploadWatcher()
@@ -53,8 +53,8 @@ UPLOAD_RES=$(curl -fsS -X POST \
 echo "$UPLOAD_RES" | pp_json
 
 # ---- 2) Reindex (fresh build) ----
-log "2) Rebuilding index via /index/reindex (first run may trigger Ollama model pull)..."
-REINDEX_RES=$(curl -fsS -X POST "${BASE_URL}/index/reindex")
+log "2) Rebuilding index via /index/reindex?wait=true (first run may trigger Ollama model pull)..."
+REINDEX_RES=$(curl -fsS -X POST "${BASE_URL}/index/reindex?wait=true")
 echo "$REINDEX_RES" | pp_json
 
 # ---- 3) Smoke test: /search (optional) ----
@@ -0,0 +1,114 @@
+"""
+Shared test setup. The app keeps its index, uploads and database under the
+working directory, so the whole session runs in a scratch directory and
+each test starts from empty data. tiktoken is replaced by a byte-level
+encoding (no download) before anything imports it.
+"""
+import os, sys, shutil, tempfile, types
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+SCRATCH = tempfile.mkdtemp(prefix="pkm-tests-")
+os.chdir(SCRATCH)
+os.environ["DB_DIR"] = os.path.join(SCRATCH, "data")
+
+class _ByteEncoding:
+    """One token per UTF-8 byte; offsets stay exact, which is all the chunker needs."""
+
+    def encode_ordinary(self, text):
+        return list(text.encode("utf-8"))
+
+    encode = encode_ordinary
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="ignore")
+
+_tiktoken = types.ModuleType("tiktoken")
+_tiktoken.get_encoding = lambda name: _ByteEncoding()
+sys.modules["tiktoken"] = _tiktoken
+
+import asyncio, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+EMBED_DIM = 16
+
+@pytest.fixture(scope="session", autouse=True)
+def pipeline_threads():
+    """Run the pipeline's extract stage on threads: spawned workers would not see the stubs."""
+    from app import pipeline
+    pipeline._pool = ThreadPoolExecutor(max_workers=2)
+    yield
+    pipeline.shutdown()
+
+@pytest.fixture(autouse=True)
+def clean_data():
+    """Empty data and upload dirs, a fresh schema and a manager that has not loaded anything yet."""
+    from app import indexer
+    from app.db import engine, init_db
+    from app.embed_store import embed_store
+    from app.routes.upload import OBJECTS_DIR
+    engine.dispose()
+    for d in ("data", "uploads"):
+        shutil.rmtree(d, ignore_errors=True)
+    os.makedirs("data", exist_ok=True)
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
+    indexer.vector_store.reset()
+    embed_store.reset()
+    indexer.index_manager._loaded = False
+    init_db()
+    yield
+    engine.dispose()
+
+class FakeOllama:
+    """
+    Stands in for the embedding endpoint: a deterministic unit vector per
+    text. `fail_on` makes that call (1-based) raise, as a dropped
+    connection would; `on_call(n)` runs before each call.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.texts = 0
+        self.fail_on: int | None = None
+        self.on_call = None
+
+    async def embed(self, texts, max_retries=1):
+        self.calls += 1
+        if self.on_call is not None:
+            self.on_call(self.calls)
+        if self.fail_on is not None and self.calls == self.fail_on:
+            raise RuntimeError("embed failed")
+        self.texts += len(texts)
+        await asyncio.sleep(0)
+        return [self.vector(t).tolist() for t in texts]
+
+    @staticmethod
+    def vector(text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        v = np.random.default_rng(seed).standard_normal(EMBED_DIM).astype("float32")
+        return v / np.linalg.norm(v)
+
+@pytest.fixture
+def ollama(monkeypatch):
+    from app import embeddings
+    fake = FakeOllama()
+    monkeypatch.setattr(embeddings, "_embed_remote", fake.embed)
+    return fake
+
+@pytest.fixture
+def uploads():
+    """Write a file into the upload dir: uploads(name, text) -> path."""
+    from app.routes.upload import UPLOAD_DIR
+
+    def put(name, text):
+        path = os.path.join(UPLOAD_DIR, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+    return put
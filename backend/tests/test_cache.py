@@ -0,0 +1,89 @@
+import json, pickle
+
+from app import metrics
+from app.cache import Cache, LocalBackend, LocalRedis, RedisBackend
+
+def _blob(v):
+    return json.dumps(v, separators=(",", ":")).encode("utf-8")
+
+def test_local_backend_stays_under_its_byte_bound():
+    value = {"text": "x" * 100}
+    size = len(_blob(value))
+    cache = Cache("t", max_bytes=3 * size, backend=LocalBackend(3 * size))
+    for i in range(5):
+        cache.set(("q", i), value)
+
+    assert cache.backend.bytes <= 3 * size
+    assert len(cache.backend) == 3
+    assert cache.evictions == 2
+    # least recently used went first
+    assert cache.get(("q", 0)) is None
+    assert cache.get(("q", 4)) == value
+
+def test_oversize_values_are_skipped_without_evicting():
+    size = len(_blob([1.0, 2.0]))
+    cache = Cache("t", max_bytes=3 * size, backend=LocalBackend(3 * size))
+    cache.set("a", [1.0, 2.0])
+    cache.set("b", [1.0, 2.0])
+    cache.set("big", {"text": "x" * (3 * size)})
+
+    assert cache.evictions == 0
+    assert len(cache.backend) == 2 and cache.backend.bytes == 2 * size
+    assert cache.get("big") is None
+    assert cache.get("a") == [1.0, 2.0]
+
+def test_recently_read_entries_survive_eviction():
+    size = len(_blob([1.0, 2.0]))
+    cache = Cache("t", max_bytes=2 * size, backend=LocalBackend(2 * size))
+    cache.set("a", [1.0, 2.0])
+    cache.set("b", [1.0, 2.0])
+    cache.get("a")
+    cache.set("c", [1.0, 2.0])
+    assert cache.get("a") == [1.0, 2.0]
+    assert cache.get("b") is None
+
+def test_new_generation_invalidates_entries():
+    generation = [1]
+    cache = Cache("t", max_bytes=1 << 20, generation=lambda: generation[0], backend=LocalBackend(1 << 20))
+    cache.set("q", {"results": [1, 2]})
+    assert cache.get("q") == {"results": [1, 2]}
+
+    generation[0] = 2
+    assert cache.get("q") is None
+    assert cache.invalidations == 1
+    assert len(cache.backend) == 0
+    assert cache.hits == 1 and cache.misses == 1
+
+def test_shared_backend_round_trips_json():
+    backend = RedisBackend(LocalRedis(), "pkm:t", max_bytes=1 << 20)
+    cache = Cache("t", max_bytes=1 << 20, backend=backend)
+    cache.set("q", {"answer": "ok", "sources": [{"score": 0.5}]})
+    assert cache.get("q") == {"answer": "ok", "sources": [{"score": 0.5}]}
+
+def test_foreign_blobs_are_never_unpickled():
+    client = LocalRedis()
+    cache = Cache("t", max_bytes=1 << 20, backend=RedisBackend(client, "pkm:t", max_bytes=1 << 20))
+
+    class Boom:
+        def __reduce__(self):
+            return (exec, ("raise SystemExit('unpickled')",))
+    client.set(f"pkm:t:{cache._key('q')}", pickle.dumps(Boom()))
+
+    assert cache.get("q") is None
+    assert cache.misses == 1
+
+def test_values_that_are_not_json_are_not_stored():
+    cache = Cache("t", max_bytes=1 << 20, backend=LocalBackend(1 << 20))
+    cache.set("q", {"when": object()})
+    assert len(cache.backend) == 0
+    assert cache.get("q") is None
+
+def test_cache_totals_are_exported_as_counters(monkeypatch):
+    cache = Cache("t", max_bytes=1 << 20, backend=LocalBackend(1 << 20))
+    cache.get("q")
+    monkeypatch.setattr(metrics, "collectors", [cache.stats])
+    text = metrics.render_prom()
+    assert "# TYPE cache_misses_total counter" in text
+    assert "# TYPE cache_evictions_total counter" in text
+    assert "# TYPE cache_bytes gauge" in text
+    assert 'cache_misses_total{cache="t"} 1' in text
@@ -0,0 +1,102 @@
+import asyncio, os
+from sqlalchemy import func, select, text
+
+from app import db, ingest, pipeline
+from app.chunking import join_tails
+from app.db import engine, Chunk, Document, get_chunks_by_ids
+from app.lexical import lexical_search
+from app.routes import context
+
+def _doc(i, n=40):
+    # words unique to the paragraph, so every chunk's text differs
+    return "\n\n".join(f"Paragraph {i}-{p}: " + " ".join(f"w{i}x{p}y{j}" for j in range(12)) for p in range(n))
+
+def _expected(path):
+    _, info, tails = pipeline.prepare_document(path)
+    return join_tails(info["spans"], tails)
+
+def _stored(path):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(Chunk.embedding_id, Chunk.position, Chunk.tail)
+            .join(Document, Chunk.document_id == Document.id)
+            .where(Document.path == path).order_by(Chunk.position)
+        ).all()
+
+def test_chunk_texts_are_rebuilt_from_tails(ollama, uploads):
+    body = _doc(0)
+    path = uploads("a.md", body)
+    asyncio.run(ingest.incremental())
+    expected = _expected(path)
+    stored = _stored(path)
+    assert len(stored) == len(expected) > 3
+
+    # the overlaps are stored once
+    assert sum(len(t) for _, _, t in stored) < sum(len(c) for c in expected)
+    rows = {r["position"]: r["text"] for r in get_chunks_by_ids([eid for eid, _, _ in stored])}
+    assert [rows[p] for p in range(len(expected))] == expected
+
+    centers, windows = context._read([(stored[5].embedding_id, None)], 3)
+    doc_id, pos, _ = centers[0]
+    assert [c["text"] for c in windows[(doc_id, pos)]] == [c.strip() for c in expected[2:9]]
+
+def test_long_overlaps_read_further_back(monkeypatch, ollama, uploads):
+    body = _doc(1)
+    path = uploads("b.md", body)
+    asyncio.run(ingest.incremental())
+    monkeypatch.setattr(db, "PREFIX_ROWS", 0)
+    stored = _stored(path)
+    rows = {r["position"]: r["text"] for r in get_chunks_by_ids([eid for eid, _, _ in stored])}
+    assert [rows[p] for p in range(len(stored))] == _expected(path)
+
+def _fts_hits(word):
+    # straight from the index: a delete given the wrong text leaves tokens behind
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM chunks_fts WHERE chunks_fts MATCH :w"), {"w": word}).scalar()
+
+def test_keyword_index_follows_rewrites_and_deletes(ollama, uploads):
+    path = uploads("c.md", _doc(2))
+    uploads("d.md", _doc(3))
+    asyncio.run(ingest.incremental())
+    assert lexical_search("w2x7y3", k=5)
+    assert not lexical_search("replaced", k=5)
+
+    uploads("c.md", "Replaced content. " * 40)
+    asyncio.run(ingest.incremental())
+    assert lexical_search("replaced", k=5)
+    assert not lexical_search("w2x7y3", k=5)
+    assert _fts_hits("w2x7y3") == 0
+
+    os.remove(path)
+    asyncio.run(ingest.incremental())
+    assert not lexical_search("replaced", k=5)
+    assert _fts_hits("replaced") == 0
+    assert lexical_search("w3x7y3", k=5)
+    with engine.connect() as conn:
+        # every remaining chunk has exactly one index entry
+        assert conn.execute(text("SELECT count(*) FROM chunks_fts")).scalar() == conn.execute(
+            select(func.count(Chunk.id))).scalar()
+
+def test_span_rows_without_tails_are_migrated(ollama, uploads):
+    body = _doc(4)
+    path = uploads("e.md", body)
+    asyncio.run(ingest.incremental())
+    _, info, tails = pipeline.prepare_document(path)
+    # the blank lines between chunks are all that is lost from the text
+    norm = [" "] * info["spans"][-1][1]
+    for (start, end), chunk in zip(info["spans"], join_tails(info["spans"], tails)):
+        norm[start:end] = chunk
+    norm = "".join(norm)
+    # back to the earlier layout: bare spans into documents.text, FTS triggers
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE chunks SET tail = NULL"))
+        conn.execute(Document.__table__.update().values(text=norm))
+        conn.execute(text("CREATE TRIGGER chunks_fts_ai AFTER INSERT ON chunks BEGIN SELECT 1; END"))
+
+    db.init_db()
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM sqlite_master WHERE type='trigger'")).scalar() == 0
+        assert conn.execute(select(Document.text)).scalar() is None
+    stored = _stored(path)
+    rows = {r["position"]: r["text"] for r in get_chunks_by_ids([eid for eid, _, _ in stored])}
+    assert [rows[p] for p in range(len(stored))] == _expected(path)
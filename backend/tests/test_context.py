@@ -0,0 +1,64 @@
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import event, func, select
+
+from app import ingest
+from app.db import engine, Chunk, Document
+from app.routes import context
+
+# a whole chunk on its own, at the start of both documents
+SHARED = " ".join(["This license text appears in several documents without any change at all."] * 4)
+
+def _client():
+    app = FastAPI()
+    app.include_router(context.router, prefix="/context")
+    return TestClient(app)
+
+def _doc(name):
+    return "\n\n".join(f"{name} paragraph {p}: " + " ".join(f"{name}w{p}x{j}" for j in range(20)) for p in range(8))
+
+def _statements():
+    seen = []
+    def count(conn, cursor, statement, *args):
+        seen.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    return seen, lambda: event.remove(engine, "before_cursor_execute", count)
+
+def test_single_and_batch_context_read_in_one_query(ollama, uploads):
+    uploads("a.txt", SHARED + "\n\n" + _doc("alpha"))
+    uploads("b.txt", SHARED + "\n\n" + _doc("beta"))
+    asyncio.run(ingest.incremental())
+    with engine.connect() as conn:
+        eid = conn.execute(
+            select(Chunk.embedding_id).group_by(Chunk.embedding_id)
+            .having(func.count(Chunk.document_id.distinct()) > 1)
+        ).scalar_one()
+        paths = conn.execute(
+            select(Document.path).join(Chunk, Chunk.document_id == Document.id)
+            .where(Chunk.embedding_id == eid).order_by(Document.id)
+        ).scalars().all()
+    c = _client()
+
+    seen, stop = _statements()
+    try:
+        single = c.get("/context", params={"id": eid, "radius": 3}).json()
+        assert len(seen) == 1
+        seen.clear()
+        batch = c.post("/context/batch", json={"radius": 3, "items": [
+            {"id": eid}, {"id": eid, "doc_path": paths[1]}, {"id": 10 ** 6},
+        ]}).json()
+        assert len(seen) == 1
+    finally:
+        stop()
+
+    # without doc_path the first document's copy is read
+    assert single["doc_path"] == paths[0]
+    first, second, missing = batch["results"]
+    assert first == {k: single[k] for k in first}
+    assert second["doc_path"] == paths[1] and second["context"] != first["context"]
+    assert not missing["ok"]
+    for window in (first["context"], second["context"]):
+        assert any(ch["text"] == SHARED for ch in window)
+        assert [ch["position"] for ch in window] == sorted(ch["position"] for ch in window)
+    assert c.get("/context", params={"id": 10 ** 6}).status_code == 404
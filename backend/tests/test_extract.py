@@ -0,0 +1,72 @@
+import fitz
+import pytest
+
+from app import extract, pipeline
+from app.chunking import PIECE_SEP, SpanChunker, chunk_text, join_tails
+
+@pytest.fixture
+def big_pdf(tmp_path):
+    path = str(tmp_path / "big.pdf")
+    doc = fitz.open()
+    for i in range(extract.PDF_PARALLEL_MIN_PAGES + 6):
+        page = doc.new_page()
+        # short lines read as headers/footers and are stripped
+        page.insert_text((36, 100), f"Page {i} body text " + "long enough to survive cleaning " * 3, fontsize=6)
+    doc.save(path)
+    doc.close()
+    return path
+
+@pytest.fixture
+def page_workers():
+    yield extract.set_page_workers
+    extract.set_page_workers(extract.PDF_PAGE_WORKERS)
+    extract.shutdown_page_pool()
+
+def test_no_page_pool_without_a_worker_budget(big_pdf, page_workers, monkeypatch):
+    def no_pool():
+        raise AssertionError("page pool started")
+    monkeypatch.setattr(extract, "_get_page_pool", no_pool)
+    page_workers(0)
+    pages = list(extract.iter_pdf_pages(big_pdf))
+    assert len(pages) == extract.PDF_PARALLEL_MIN_PAGES + 6
+    assert "Page 0 body text" in pages[0]
+
+def test_page_pool_output_matches_in_process(big_pdf, page_workers, monkeypatch):
+    monkeypatch.setattr(extract, "PDF_PAGE_WORKERS", 2)
+    page_workers(0)
+    serial = list(extract.iter_pdf_pages(big_pdf))
+    page_workers(2)
+    assert list(extract.iter_pdf_pages(big_pdf)) == serial
+    assert extract._page_pool is not None
+
+def test_workers_return_tails_and_hold_only_reachable_text(big_pdf, page_workers, monkeypatch):
+    held = []
+    real_release = SpanChunker.release
+
+    def release(self):
+        real_release(self)
+        held.append(len(self.text))
+    monkeypatch.setattr(SpanChunker, "release", release)
+    page_workers(0)
+
+    _, info, tails = pipeline.prepare_document(big_pdf)
+    assert "text" not in info
+    whole = PIECE_SEP.join(extract.iter_pdf_pages(big_pdf))
+    assert join_tails(info["spans"], tails) == chunk_text(whole)
+    assert sum(map(len, tails)) <= len(whole)
+    assert max(held) < len(whole) // 4
+
+def test_page_budget_follows_the_document_count(monkeypatch):
+    monkeypatch.setattr(pipeline.os, "cpu_count", lambda: 8)
+    monkeypatch.setattr(pipeline, "EXTRACT_WORKERS", 8)
+    assert pipeline.page_budget(1) == 7
+    assert pipeline.page_budget(3) == 1
+    assert pipeline.page_budget(8) == pipeline.page_budget(500) == 0
+
+def test_worker_takes_the_runs_page_budget(big_pdf, page_workers, monkeypatch):
+    monkeypatch.setattr(extract, "PDF_PAGE_WORKERS", 2)
+    page_workers(0)
+    pipeline.prepare_document(big_pdf, page_workers=2)
+    assert extract._page_pool is not None
+    pipeline.prepare_document(big_pdf, page_workers=0)
+    assert extract._page_pool is None
@@ -0,0 +1,80 @@
+import numpy as np
+
+from app import indexer
+from app.indexer import IndexManager, IndexWriter
+
+def _vecs(n, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return indexer.l2_normalize(rng.standard_normal((n, dim)).astype("float32"))
+
+def _build(manager, n, start=0, seed=0):
+    writer = IndexWriter(manager)
+    writer.add(_vecs(n, seed=seed), np.arange(start, start + n, dtype=np.int64))
+    writer.commit()
+    return writer
+
+def test_migrates_flat_index_to_configured_factory(monkeypatch):
+    manager = IndexManager()
+    _build(manager, 200)
+    assert manager.factory == "Flat"
+    assert manager.trained_on is None
+
+    monkeypatch.setattr(indexer, "INDEX_FACTORY", "IVF4,Flat")
+    assert manager.needs_migration
+    writer = IndexWriter(manager)
+    writer.open()
+    writer.commit()
+
+    index, _ = manager.snapshot()
+    assert manager.factory == "IVF4,Flat"
+    assert manager.trained_on == 200
+    assert index.ntotal == 200
+    # ids survive the migration and the copy still answers exactly
+    q = _vecs(1, seed=0)[0]
+    _, ids = indexer.search(index, q, top_k=1, nprobe=4)
+    assert ids == [0]
+
+def test_too_little_data_falls_back_to_flat_then_migrates(monkeypatch):
+    monkeypatch.setattr(indexer, "INDEX_FACTORY", "IVF64,Flat")
+    manager = IndexManager()
+    _build(manager, 10)
+    assert manager.factory == "Flat"
+    assert manager.trained_on is None
+    assert manager.snapshot()[0].ntotal == 10
+
+    # enough vectors now: the next run migrates and trains on all of them
+    writer = IndexWriter(manager)
+    writer.add(_vecs(300, seed=1), np.arange(10, 310, dtype=np.int64))
+    assert writer.factory == "Flat"
+    writer.commit()
+    _build(manager, 1, start=310, seed=2)
+    assert manager.factory == "IVF64,Flat"
+    assert manager.trained_on == 310
+    assert manager.snapshot()[0].ntotal == 311
+
+def test_retrains_once_grown_past_training_set(monkeypatch):
+    monkeypatch.setattr(indexer, "INDEX_FACTORY", "IVF4,Flat")
+    monkeypatch.setattr(indexer, "RETRAIN_GROWTH", 4.0)
+    manager = IndexManager()
+    _build(manager, 40)
+    assert manager.trained_on == 40
+
+    _build(manager, 100, start=40, seed=1)
+    assert manager.trained_on == 40  # 140 <= 160: not yet
+
+    _build(manager, 100, start=140, seed=2)
+    assert manager.trained_on == 240
+    index, _ = manager.snapshot()
+    assert sorted(indexer.index_ids(index).tolist()) == list(range(240))
+
+def test_unknown_training_size_retrains_once(monkeypatch):
+    monkeypatch.setattr(indexer, "INDEX_FACTORY", "IVF4,Flat")
+    manager = IndexManager()
+    _build(manager, 40)
+    # an index saved before training sizes were recorded
+    indexer._write_index_meta({"factory": "IVF4,Flat", "dim": 8})
+    manager = IndexManager()
+    assert manager.trained_on is None
+
+    _build(manager, 5, start=40, seed=1)
+    assert manager.trained_on == 45
@@ -0,0 +1,85 @@
+import threading
+import numpy as np
+
+from app import indexer
+from app.indexer import IndexManager, IndexWriter
+
+def _vecs(n, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return indexer.l2_normalize(rng.standard_normal((n, dim)).astype("float32"))
+
+def test_commit_publishes_new_generation():
+    manager = IndexManager()
+    assert manager.snapshot() == (None, 0)
+
+    writer = IndexWriter(manager)
+    writer.add(_vecs(4), np.arange(4, dtype=np.int64))
+    assert writer.commit() == 1
+
+    index, generation = manager.snapshot()
+    assert generation == 1
+    assert index.ntotal == 4
+
+def test_readers_keep_their_snapshot_while_a_writer_mutates():
+    manager = IndexManager()
+    writer = IndexWriter(manager)
+    writer.add(_vecs(4), np.arange(4, dtype=np.int64))
+    writer.commit()
+    live, generation = manager.snapshot()
+
+    writer = IndexWriter(manager)
+    writer.add(_vecs(2, seed=1), np.array([10, 11], dtype=np.int64))
+    writer.remove([0])
+    # nothing is visible before commit, and the old object is never mutated
+    assert manager.snapshot() == (live, generation)
+    assert live.ntotal == 4
+
+    writer.commit()
+    index, new_generation = manager.snapshot()
+    assert new_generation == generation + 1
+    assert index is not live
+    assert sorted(indexer.index_ids(index).tolist()) == [1, 2, 3, 10, 11]
+    assert live.ntotal == 4
+
+def test_snapshot_does_not_wait_for_the_index_write(monkeypatch):
+    manager = IndexManager()
+    writer = IndexWriter(manager)
+    writer.add(_vecs(4), np.arange(4, dtype=np.int64))
+    writer.commit()
+    live, generation = manager.snapshot()
+
+    saving, release = threading.Event(), threading.Event()
+    real_save = indexer.save_index
+
+    def slow_save(*args):
+        saving.set()
+        release.wait(5)
+        real_save(*args)
+
+    monkeypatch.setattr(indexer, "save_index", slow_save)
+    writer = IndexWriter(manager)
+    writer.add(_vecs(1, seed=2), np.array([20], dtype=np.int64))
+    t = threading.Thread(target=writer.commit)
+    t.start()
+    try:
+        assert saving.wait(5)
+        # the lock is free while the file is written: readers get the old generation
+        assert manager.snapshot() == (live, generation)
+    finally:
+        release.set()
+        t.join(5)
+    assert manager.snapshot()[1] == generation + 1
+
+def test_other_managers_reload_after_commit():
+    a, b = IndexManager(), IndexManager()
+    writer = IndexWriter(a)
+    writer.add(_vecs(3), np.arange(3, dtype=np.int64))
+    writer.commit()
+    assert b.snapshot()[0].ntotal == 3
+
+    writer = IndexWriter(a)
+    writer.remove([0])
+    writer.commit()
+    index, generation = b.snapshot()
+    assert generation == 2
+    assert index.ntotal == 2
@@ -0,0 +1,131 @@
+import asyncio, os
+import pytest
+from sqlalchemy import select
+
+from app import indexer, ingest, pipeline
+from app.db import engine, Chunk
+from app.indexer import index_manager, index_ids
+
+def _docs(uploads, n):
+    return [
+        uploads(f"doc{i}.txt", f"Document {i}.\n\n" + f"text only doc {i} has. " * 5)
+        for i in range(n)
+    ]
+
+def _ids():
+    """(embedding ids the chunk rows use, ids in the live index)"""
+    index, _ = index_manager.snapshot()
+    live = set(index_ids(index).tolist()) if index is not None else set()
+    with engine.connect() as conn:
+        used = set(conn.execute(select(Chunk.embedding_id).where(Chunk.embedding_id.isnot(None))).scalars())
+    return used, live
+
+def _indexed():
+    return {p for p, s in ingest.load_doc_state().items() if s["doc_hash"]}
+
+@pytest.fixture
+def one_doc_at_a_time(monkeypatch):
+    monkeypatch.setattr(ingest, "WRITE_BATCH_DOCS", 1)
+    monkeypatch.setattr(pipeline, "DOCS_IN_FLIGHT", 1)
+
+def test_failure_mid_run_publishes_flushed_docs(one_doc_at_a_time, ollama, uploads):
+    paths = _docs(uploads, 6)
+    ollama.fail_on = 4
+    with pytest.raises(RuntimeError):
+        asyncio.run(ingest.incremental())
+    # the docs flushed before the failure are indexed, rows and index agree
+    done = _indexed()
+    assert done and done < set(paths)
+    used, live = _ids()
+    assert used == live
+    assert not os.path.exists(ingest.RUN_MARKER)
+
+    ollama.fail_on = None
+    asyncio.run(ingest.incremental())
+    used, live = _ids()
+    assert used and used == live
+    assert _indexed() == set(paths)
+    assert not os.path.exists(ingest.RUN_MARKER)
+
+    again = asyncio.run(ingest.incremental())
+    assert again["files_scanned"] == 0
+
+def test_failed_index_commit_is_repaired(one_doc_at_a_time, monkeypatch, ollama, uploads):
+    paths = _docs(uploads, 4)
+    asyncio.run(ingest.incremental())
+    os.remove(paths[0])
+    with open(paths[1], "a", encoding="utf-8") as f:
+        f.write("\n\nA new paragraph.")
+
+    def broken(*args):
+        raise OSError("disk full")
+    with monkeypatch.context() as m, pytest.raises(OSError):
+        m.setattr(indexer, "save_index", broken)
+        asyncio.run(ingest.incremental())
+    # rows moved on, the live index did not
+    used, live = _ids()
+    assert used != live
+    assert paths[1] not in _indexed()
+
+    asyncio.run(ingest.incremental())
+    used, live = _ids()
+    assert used == live
+    assert _indexed() == set(paths[1:])
+
+def test_failed_batch_is_rolled_back(one_doc_at_a_time, monkeypatch, ollama, uploads):
+    paths = _docs(uploads, 4)
+    real_flush = ingest.DocBatch.flush
+    failed = []
+
+    def flaky(self):
+        if not failed and self.docs:
+            failed.append(self.docs[0][0])
+            raise RuntimeError("database is locked")
+        return real_flush(self)
+    monkeypatch.setattr(ingest.DocBatch, "flush", flaky)
+    asyncio.run(ingest.incremental())
+
+    # the failed doc has no rows and its vectors never reached the index
+    assert _indexed() == set(paths) - set(failed)
+    assert failed[0] not in ingest.load_doc_state()
+    used, live = _ids()
+    assert used == live
+
+    again = asyncio.run(ingest.incremental())
+    assert again["files_scanned"] == 1
+    assert _indexed() == set(paths)
+
+def test_unflushed_batch_is_dropped_on_failure(monkeypatch, ollama, uploads):
+    # one batch for the whole run: nothing is flushed before the failure
+    monkeypatch.setattr(pipeline, "DOCS_IN_FLIGHT", 1)
+    paths = _docs(uploads, 4)
+    ollama.fail_on = 3
+    with pytest.raises(RuntimeError):
+        asyncio.run(ingest.incremental())
+    assert ingest.load_doc_state() == {}
+    index, _ = index_manager.snapshot()
+    assert index is None or index.ntotal == 0
+
+    ollama.fail_on = None
+    asyncio.run(ingest.incremental())
+    used, live = _ids()
+    assert used == live
+    assert _indexed() == set(paths)
+
+def test_failed_publish_leaves_the_marker_for_repair(one_doc_at_a_time, monkeypatch, ollama, uploads):
+    paths = _docs(uploads, 4)
+    ollama.fail_on = 3
+
+    def broken(*args):
+        raise OSError("disk full")
+    with monkeypatch.context() as m, pytest.raises(RuntimeError):
+        m.setattr(indexer, "save_index", broken)
+        asyncio.run(ingest.incremental())
+    assert _indexed() == set()
+    assert os.path.exists(ingest.RUN_MARKER)
+
+    ollama.fail_on = None
+    asyncio.run(ingest.incremental())
+    used, live = _ids()
+    assert used == live
+    assert _indexed() == set(paths)
@@ -0,0 +1,117 @@
+import asyncio, time, types
+import pytest
+
+from app import indexer, ingest, pipeline
+from app.jobs import JobManager
+
+@pytest.fixture
+def blocked_runs(monkeypatch):
+    """Replace the indexing run with one that waits for `release`; records each call."""
+    gate = types.SimpleNamespace(calls=[], release=asyncio.Event())
+
+    async def run(job=None, paths=None, rebuild=False):
+        gate.calls.append((job.kind, None if paths is None else set(paths)))
+        await gate.release.wait()
+        return {"ok": True}
+
+    monkeypatch.setattr(ingest, "incremental", run)
+    return gate
+
+async def _until(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def test_submissions_while_running_coalesce_into_one_job(blocked_runs):
+    async def main():
+        manager = JobManager()
+        first, coalesced = manager.submit("incremental", paths=["uploads/a.txt"])
+        assert not coalesced
+        await _until(lambda: first.state == "running")
+
+        second, c2 = manager.submit("incremental", paths=["uploads/b.txt"])
+        third, c3 = manager.submit("incremental", paths=["uploads/c.txt"])
+        assert (c2, c3) == (False, True)
+        assert third is second
+        assert second.requests == 2
+        assert second.paths == {"uploads/b.txt", "uploads/c.txt"}
+
+        # a reindex upgrades the waiting job and widens it to every upload
+        fourth, c4 = manager.submit("reindex")
+        assert c4 and fourth is second
+        assert second.kind == "reindex" and second.paths is None
+
+        blocked_runs.release.set()
+        await asyncio.wait_for(second.done.wait(), 5)
+        assert blocked_runs.calls == [("incremental", {"uploads/a.txt"}), ("reindex", None)]
+        assert first.state == second.state == "done"
+        assert not manager.busy
+    asyncio.run(main())
+
+def test_cancel_pending_job_never_runs(blocked_runs):
+    async def main():
+        manager = JobManager()
+        first, _ = manager.submit("incremental")
+        await _until(lambda: first.state == "running")
+        second, _ = manager.submit("incremental")
+
+        assert manager.cancel(second.id) is second
+        assert second.state == "cancelled" and second.done.is_set()
+        assert manager.pending is None
+
+        blocked_runs.release.set()
+        await asyncio.wait_for(first.done.wait(), 5)
+        assert len(blocked_runs.calls) == 1
+        assert manager.cancel("missing") is None
+    asyncio.run(main())
+
+def test_cancel_running_job_commits_what_it_wrote(monkeypatch, ollama, uploads):
+    monkeypatch.setattr(ingest, "WRITE_BATCH_DOCS", 1)
+    monkeypatch.setattr(pipeline, "DOCS_IN_FLIGHT", 1)
+    for i in range(8):
+        uploads(f"doc{i}.txt", f"Document {i} says something only it says. " * 3)
+
+    async def main():
+        manager = JobManager()
+        job, _ = manager.submit("incremental")
+        ollama.on_call = lambda n: n == 3 and manager.cancel(job.id)
+        await asyncio.wait_for(job.done.wait(), 10)
+        return job
+
+    job = asyncio.run(main())
+    assert job.state == "cancelled"
+    assert job.result["cancelled"]
+    indexed = [p for p, s in ingest.load_doc_state().items() if s["doc_hash"]]
+    assert 0 < len(indexed) < 8
+    index, generation = indexer.index_manager.snapshot()
+    assert generation == job.result["generation"]
+    assert index.ntotal == job.result["chunks_added"]
+
+def test_slow_index_save_does_not_block_the_event_loop(monkeypatch, ollama, uploads):
+    for i in range(3):
+        uploads(f"doc{i}.txt", f"Document {i}. " * 10)
+    real_save = indexer.save_index
+
+    def slow_save(*args):
+        time.sleep(0.5)
+        real_save(*args)
+    monkeypatch.setattr(indexer, "save_index", slow_save)
+
+    async def main():
+        gaps, last = [], time.perf_counter()
+
+        async def ticker():
+            nonlocal last
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        t = asyncio.create_task(ticker())
+        await ingest.incremental()
+        t.cancel()
+        return max(gaps)
+
+    assert asyncio.run(main()) < 0.25
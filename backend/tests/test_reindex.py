@@ -0,0 +1,92 @@
+import asyncio, os
+import pytest
+from sqlalchemy import inspect
+
+from app import indexer, ingest, pipeline
+from app.db import engine, get_chunks_by_ids
+from app.indexer import index_manager, index_ids
+from app.jobs import JobManager
+from app.lexical import lexical_search
+
+def _docs(uploads, n):
+    return [uploads(f"doc{i}.txt", f"Document {i} talks about topic{i} at length. " * 4) for i in range(n)]
+
+def _live():
+    """(generation, live ids, chunk rows those ids resolve to)"""
+    index, generation = index_manager.snapshot()
+    ids = index_ids(index).tolist()
+    return generation, sorted(ids), len(get_chunks_by_ids(ids))
+
+def _staged():
+    return inspect(engine).has_table("chunks_next")
+
+@pytest.fixture
+def indexed(monkeypatch, ollama, uploads):
+    monkeypatch.setattr(ingest, "WRITE_BATCH_DOCS", 1)
+    monkeypatch.setattr(pipeline, "DOCS_IN_FLIGHT", 1)
+    paths = _docs(uploads, 4)
+    asyncio.run(ingest.incremental())
+    return paths
+
+def test_searches_see_the_old_index_until_the_swap(indexed, monkeypatch, uploads):
+    before = _live()
+    assert before[2] == len(before[1]) > 0
+    real_flush = ingest.DocBatch.flush
+    seen = []
+
+    def watched(self):
+        out = real_flush(self)
+        seen.append(_live())
+        assert lexical_search("topic1", k=1)
+        return out
+    monkeypatch.setattr(ingest.DocBatch, "flush", watched)
+    os.remove(indexed[0])
+    uploads("new.txt", "A new document about something else entirely. " * 4)
+
+    result = asyncio.run(ingest.incremental(rebuild=True))
+    assert seen and all(s == before for s in seen)
+
+    generation, ids, rows = _live()
+    assert generation == result["generation"] > before[0]
+    assert rows == len(ids) and not set(ids) & set(before[1])
+    assert result["docs_deleted"] == 1
+    assert set(ingest.load_doc_state()) == set(indexed[1:]) | {os.path.join(os.path.dirname(indexed[0]), "new.txt")}
+    assert all(s["doc_hash"] for s in ingest.load_doc_state().values())
+    assert lexical_search("entirely", k=1) and not lexical_search("topic0", k=1)
+    assert not _staged() and not os.path.exists(ingest.RUN_MARKER)
+
+def test_failed_reindex_changes_nothing(indexed, ollama, uploads):
+    before = _live()
+    state = ingest.load_doc_state()
+    uploads("new.txt", "Text the embedder has not seen yet, so it gets called. " * 4)
+    ollama.fail_on = ollama.calls + 1
+    with pytest.raises(RuntimeError):
+        asyncio.run(ingest.incremental(rebuild=True))
+
+    assert _live() == before
+    assert {p: s for p, s in ingest.load_doc_state().items() if p in state} == state
+    assert lexical_search("topic2", k=1)
+    assert not _staged()
+
+def test_cancelled_reindex_changes_nothing(indexed, monkeypatch, ollama):
+    before = _live()
+    manager = JobManager()
+    real_put = ingest.DocBatch.put
+
+    def put(self, *args):
+        # cancel as soon as the run starts writing
+        manager.cancel(job.id)
+        return real_put(self, *args)
+    monkeypatch.setattr(ingest.DocBatch, "put", put)
+
+    async def main():
+        nonlocal job
+        job, _ = manager.submit("reindex")
+        await asyncio.wait_for(job.done.wait(), 10)
+
+    job = None
+    asyncio.run(main())
+    assert job.state == "cancelled" and job.result["cancelled"]
+    assert _live() == before
+    assert all(s["doc_hash"] for s in ingest.load_doc_state().values())
+    assert not _staged()
@@ -0,0 +1,40 @@
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import ingest
+from app.routes import search
+
+def _client():
+    app = FastAPI()
+    app.include_router(search.router, prefix="/search")
+    return TestClient(app)
+
+def test_batch_rejects_fields_it_does_not_support():
+    r = _client().post("/search/batch", json={"queries": [{"q": "faiss", "mode": "hybrid"}]})
+    assert r.status_code == 422
+    assert r.json()["detail"][0]["loc"][-1] == "mode"
+
+def test_k_and_batch_size_are_bounded(monkeypatch):
+    c = _client()
+    assert c.get("/search", params={"q": "faiss", "k": search.MAX_K + 1}).status_code == 422
+    assert c.get("/search", params={"q": "faiss", "k": 0}).status_code == 422
+    r = c.post("/search/batch", json={"queries": [{"q": "faiss", "k": search.MAX_K + 1}]})
+    assert r.status_code == 422 and r.json()["detail"][0]["loc"][-1] == "k"
+
+    monkeypatch.setattr(search, "MAX_BATCH", 2)
+    r = c.post("/search/batch", json={"queries": [{"q": "faiss"}] * 3})
+    assert r.status_code == 413
+
+def test_batch_runs_vector_search_per_query(ollama, uploads):
+    uploads("a.txt", "Vector indexes answer nearest neighbour queries.")
+    asyncio.run(ingest.incremental())
+
+    r = _client().post("/search/batch", json={"queries": [
+        {"q": "Vector indexes answer nearest neighbour queries.", "k": 1, "nprobe": 2},
+        {"q": "something else", "k": 1},
+    ]})
+    assert r.status_code == 200
+    results = r.json()["results"]
+    assert [q["query"] for q in results] == ["Vector indexes answer nearest neighbour queries.", "something else"]
+    assert results[0]["results"][0]["doc_path"].endswith("a.txt")
@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+
+from app import ingest
+from app.retrieval import batch_vector_search, embed_queries, retrieve
+
+SHARED = "This license text appears in several documents without any change at all."
+
+@pytest.fixture
+def shared_chunk(ollama, uploads):
+    uploads("a.md", SHARED)
+    uploads("b.txt", SHARED)
+    asyncio.run(ingest.incremental())
+
+@pytest.mark.parametrize("mode", ["vector", "lexical", "hybrid"])
+def test_shared_chunk_is_described_by_a_document_passing_the_filter(shared_chunk, mode):
+    _, rows = asyncio.run(retrieve(SHARED, k=1, mode=mode, file_type="txt"))
+    assert len(rows) == 1
+    assert rows[0]["doc_path"].endswith("b.txt")
+    assert rows[0]["type"] == "txt"
+    assert [d["doc_path"] for d in rows[0]["documents"]] == [rows[0]["doc_path"]]
+    assert rows[0]["text"] == SHARED
+
+    _, rows = asyncio.run(retrieve(SHARED, k=1, mode=mode))
+    assert sorted(d["doc_path"][-4:] for d in rows[0]["documents"]) == [".txt", "a.md"]
+
+def test_batch_search_applies_each_querys_filter(shared_chunk):
+    async def main():
+        qvs = await embed_queries([SHARED, SHARED])
+        return await batch_vector_search(qvs, [{"q": SHARED, "k": 1, "file_type": "md"},
+                                               {"q": SHARED, "k": 1, "file_type": "txt"}])
+    _, (md, txt) = asyncio.run(main())
+    assert md[0]["id"] == txt[0]["id"]
+    assert (md[0]["type"], txt[0]["type"]) == ("md", "txt")
+    assert [len(md[0]["documents"]), len(txt[0]["documents"])] == [1, 1]
@@ -0,0 +1,119 @@
+import io, os, zipfile
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routes import upload
+from app.routes.upload import UPLOAD_DIR, OBJECTS_DIR
+
+def _client():
+    app = FastAPI()
+    app.include_router(upload.router, prefix="/files")
+    return TestClient(app)
+
+def _zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+def _objects():
+    return sorted(n for _, _, names in os.walk(OBJECTS_DIR) for n in names)
+
+def _read(name):
+    with open(os.path.join(UPLOAD_DIR, name), "rb") as f:
+        return f.read()
+
+def test_same_bytes_are_stored_once():
+    c = _client()
+    first = c.post("/files/upload", files={"file": ("a.txt", b"hello")}).json()
+    again = c.post("/files/upload", files={"file": ("a.txt", b"hello")}).json()
+    other = c.post("/files/upload", files={"file": ("b.txt", b"hello")}).json()
+    assert (first["status"], again["status"], other["status"]) == ("stored", "unchanged", "duplicate")
+    assert len(_objects()) == 1
+    assert os.path.samefile(os.path.join(UPLOAD_DIR, "a.txt"), os.path.join(UPLOAD_DIR, "b.txt"))
+
+    changed = c.post("/files/upload", files={"file": ("a.txt", b"hello again")}).json()
+    assert changed["status"] == "replaced"
+    assert _read("a.txt") == b"hello again"
+    assert _read("b.txt") == b"hello"
+
+    assert c.post("/files/gc").json() == {"removed": 0}
+    os.remove(os.path.join(UPLOAD_DIR, "b.txt"))
+    assert c.post("/files/gc").json() == {"removed": 1}
+
+def test_gc_keeps_objects_copied_without_hardlinks(monkeypatch):
+    def no_link(src, dst):
+        raise OSError("hardlinks not supported")
+    monkeypatch.setattr(upload.os, "link", no_link)
+    c = _client()
+    c.post("/files/upload", files={"file": ("a.txt", b"hello")})
+    c.post("/files/upload", files={"file": ("other.txt", b"world")})
+    assert os.stat(os.path.join(UPLOAD_DIR, "a.txt")).st_nlink == 1
+
+    assert c.post("/files/gc").json() == {"removed": 0}
+    assert len(_objects()) == 2
+    assert c.post("/files/upload", files={"file": ("b.txt", b"hello")}).json()["status"] == "duplicate"
+
+    os.remove(os.path.join(UPLOAD_DIR, "a.txt"))
+    assert c.post("/files/gc").json() == {"removed": 0}
+    os.remove(os.path.join(UPLOAD_DIR, "b.txt"))
+    assert c.post("/files/gc").json() == {"removed": 1}
+    assert _read("other.txt") == b"world"
+
+def test_zip_members_with_the_same_name_are_all_kept():
+    archive = _zip([("a/notes.md", b"from a"), ("b/notes.md", b"from b"), ("c/b/notes.md", b"from c")])
+    r = _client().post("/files/upload", files={"file": ("bundle.zip", archive)}).json()
+
+    names = [f["filename"] for f in r["files"]]
+    assert names == ["notes.md", "b_notes.md", "c_b_notes.md"]
+    assert [_read(n) for n in names] == [b"from a", b"from b", b"from c"]
+    assert "source" not in r["files"][0]
+    assert r["files"][1]["source"] == "b/notes.md"
+    assert "renamed" in r["files"][1]["detail"]
+
+def test_names_are_unique_across_one_request():
+    archive = _zip([("x/report.txt", b"zipped")])
+    r = _client().post("/files/upload", files=[
+        ("files", ("report.txt", b"plain")),
+        ("files", ("bundle.zip", archive)),
+    ]).json()
+    assert [f["filename"] for f in r["files"]] == ["report.txt", "x_report.txt"]
+    assert _read("report.txt") == b"plain"
+
+def test_zip_skips_unsafe_and_hidden_members():
+    archive = _zip([
+        ("../../escape.txt", b"flattened"),
+        ("docs/", b""),
+        ("__MACOSX/docs/._guide.md", b"resource fork"),
+        ("docs/.hidden", b"dotfile"),
+        ("docs/guide.md", b"guide"),
+    ])
+    r = _client().post("/files/upload", files={"file": ("bundle.zip", archive)}).json()
+    by_status = {}
+    for f in r["files"]:
+        by_status.setdefault(f["status"], []).append(f["filename"])
+    assert by_status == {"stored": ["escape.txt", "guide.md"], "skipped": ["docs/.hidden"]}
+    assert _read("escape.txt") == b"flattened"
+    assert not os.path.exists(os.path.join(UPLOAD_DIR, "..", "escape.txt"))
+
+def test_zip_limits_and_bad_archives(monkeypatch):
+    c = _client()
+    monkeypatch.setattr(upload, "ZIP_MAX_MEMBERS", 2)
+    archive = _zip([(f"f{i}.txt", b"x") for i in range(3)])
+    assert c.post("/files/upload", files={"file": ("big.zip", archive)}).status_code == 413
+
+    monkeypatch.setattr(upload, "ZIP_MAX_MEMBERS", 100)
+    monkeypatch.setattr(upload, "ZIP_MAX_BYTES", 10)
+    archive = _zip([("big.txt", b"x" * 100)])
+    assert c.post("/files/upload", files={"file": ("big.zip", archive)}).status_code == 413
+
+    assert c.post("/files/upload", files={"file": ("broken.zip", b"not a zip")}).status_code == 400
+    # nothing half-written is left behind
+    assert [n for n in _objects() if n.startswith(".tmp-")] == []
+
+def test_zip_kept_as_is_without_expansion():
+    archive = _zip([("a.txt", b"a")])
+    r = _client().post("/files/upload?expand_zip=false", files={"file": ("bundle.zip", archive)}).json()
+    assert r["filename"] == "bundle.zip"
+    assert _read("bundle.zip") == archive
@@ -30,16 +30,31 @@ export async function uploadFile(file) {
     return r.json();
 }
 
-export async function reindex() {
+const JOB_POLL_MS = 1000;
+
+// indexing runs as a background job: poll its status until it finishes
+async function waitForJob(job, onProgress) {
+    while (!["done", "failed", "cancelled"].includes(job.state)) {
+        if (onProgress) onProgress(job);
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_MS));
+        const r = await fetch(`${API_BASE}/index/jobs/${job.job_id}`);
+        if (!r.ok) throw new Error(`Job status failed: ${r.status}`);
+        job = await r.json();
+    }
+    if (job.state === "failed") throw new Error(job.error || "Indexing job failed");
+    return job;
+}
+
+export async function reindex(onProgress) {
     const r = await fetch(`${API_BASE}/index/reindex`, {method: "POST"});
     if (!r.ok) throw new Error(`Reindex failed: ${r.status}`);
-    return r.json();
+    return waitForJob(await r.json(), onProgress);
 }
 
-export async function incremental() {
+export async function incremental(onProgress) {
     const r = await fetch(`${API_BASE}/index/incremental`, {method: "POST"});
     if (!r.ok) throw new Error(`Incremental failed: ${r.status}`);
-    return r.json();
+    return waitForJob(await r.json(), onProgress);
 }
 
 export async function health() {
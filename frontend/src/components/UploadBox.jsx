@@ -5,13 +5,16 @@ export default function UploadBox() {
     const [file, setFile] = useState(null);
     const [msg, setMsg] = useState("");
 
+    const progress = (label) => (job) =>
+        setMsg(`${label} ${job.files_done}/${job.files_total || "?"} files`);
+
     const doUpload = async() => {
         if (!file) return setMsg("Pick a file first.");
         setMsg("Uploading..");
         try {
             await uploadFile(file);
             setMsg("Uploaded. Reindexing...");
-            await reindex();
+            await reindex(progress("Reindexing..."));
             setMsg("Reindexed successfully");
         }catch (e){
             setMsg("Error " + e.message);
@@ -34,7 +37,7 @@ export default function UploadBox() {
                     Upload & Reindex
                 </button>
                 <button
-                    onClick={async () => { setMsg("Incremental reindex..."); try { await incremental(); setMsg("Incremental done."); } catch(e){ setMsg("Error: " + e.message);} }}
+                    onClick={async () => { setMsg("Incremental reindex..."); try { await incremental(progress("Incremental reindex...")); setMsg("Incremental done."); } catch(e){ setMsg("Error: " + e.message);} }}
                     className="px-3 py-2 rounded-md border border-zinc-700 w-full sm:w-auto"
                     title="Scan for new/changed/deleted files"
                 >